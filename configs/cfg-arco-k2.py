@@ -180,11 +180,27 @@ class GPModelConfig:
     discard_threshold_gps: int = 110000  # max number of mechanisms to keep in model
     discard_threshold_topo_orders: int = 10000  # max number of mechanisms to keep in model
     linear: bool = False  # linear GP kernel
+    sq_diff_cache_max_samples: int = 0  # cache per-dim squared data differences up to this size, O(d n^2) (0: off)
+    cholesky_cache_size: int = 0  # max number of per-mechanism Cholesky factors kept per node, O(n^2) each (0: off)
+    cholesky_cache_max_samples: int = 1000  # keep Cholesky factors only up to this data size
+
+    # gp approximation
+    approximation: str = 'exact'  # 'exact', 'sparse' (SGPR with inducing points shared per target node), 'rff' or 'cg'
+    num_inducing_points: int = 256
+    inducing_point_strategy: str = 'kmeans'  # 'random' or 'kmeans'
+    num_fourier_features: int = 128  # number of random frequencies of the RQ kernel in 'rff' mode
+    rff_seed: int = 0
+    cg_tolerance: float = 1e-2  # relative residual tolerance of the conjugate gradient solves in 'cg' mode
+    cg_max_iterations: int = 100  # also bounds the size of the Lanczos tridiagonal matrices
+    num_probe_vectors: int = 10  # probe vectors of the stochastic trace/log-determinant estimates in 'cg' mode
+    preconditioner_rank: int = 5  # rank of the pivoted Cholesky preconditioner in 'cg' mode
+    cg_seed: int = 0
 
     # gp hyperparam training
     num_steps: int = 100
     log_interval: int = 0
     lr: float = 5e-2
+    optimizer: str = 'rmsprop'  # 'rmsprop' or 'adam', used for the batched HP updates of shared-data GPs
     es_threshold: float = 1e-2  # early stopping criterion threshold
     es_min_steps: int = 10  # minimum number of gradient steps to perform before checking early stopping
     es_win_size: int = 3  # window size of the running mean to compute the early stopping criterion
@@ -193,9 +209,23 @@ class GPModelConfig:
         params = {'imll_mc_samples': self.imll_mc_samples,
                   'opt_batch_size': self.opt_batch_size,
                   'linear': self.linear,
+                  'sq_diff_cache_max_samples': self.sq_diff_cache_max_samples,
+                  'cholesky_cache_size': self.cholesky_cache_size,
+                  'cholesky_cache_max_samples': self.cholesky_cache_max_samples,
+                  'approximation': self.approximation,
+                  'num_inducing_points': self.num_inducing_points,
+                  'inducing_point_strategy': self.inducing_point_strategy,
+                  'num_fourier_features': self.num_fourier_features,
+                  'rff_seed': self.rff_seed,
+                  'cg_tolerance': self.cg_tolerance,
+                  'cg_max_iterations': self.cg_max_iterations,
+                  'num_probe_vectors': self.num_probe_vectors,
+                  'preconditioner_rank': self.preconditioner_rank,
+                  'cg_seed': self.cg_seed,
                   'num_steps': self.num_steps,
                   'log_interval': self.log_interval,
                   'lr': self.lr,
+                  'optimizer': self.optimizer,
                   'es_threshold': self.es_threshold,
                   'es_min_steps': self.es_min_steps,
                   'es_win_size': self.es_win_size}
@@ -205,9 +235,23 @@ class GPModelConfig:
         self.imll_mc_samples = param_dict['imll_mc_samples']
         self.opt_batch_size = param_dict['opt_batch_size']
         self.linear = param_dict['linear']
+        self.sq_diff_cache_max_samples = param_dict.get('sq_diff_cache_max_samples', 0)
+        self.cholesky_cache_size = param_dict.get('cholesky_cache_size', 0)
+        self.cholesky_cache_max_samples = param_dict.get('cholesky_cache_max_samples', 1000)
+        self.approximation = param_dict.get('approximation', 'exact')
+        self.num_inducing_points = param_dict.get('num_inducing_points', 256)
+        self.inducing_point_strategy = param_dict.get('inducing_point_strategy', 'kmeans')
+        self.num_fourier_features = param_dict.get('num_fourier_features', 128)
+        self.rff_seed = param_dict.get('rff_seed', 0)
+        self.cg_tolerance = param_dict.get('cg_tolerance', 1e-2)
+        self.cg_max_iterations = param_dict.get('cg_max_iterations', 100)
+        self.num_probe_vectors = param_dict.get('num_probe_vectors', 10)
+        self.preconditioner_rank = param_dict.get('preconditioner_rank', 5)
+        self.cg_seed = param_dict.get('cg_seed', 0)
         self.num_steps = param_dict['num_steps']
         self.log_interval = param_dict['log_interval']
         self.lr = param_dict['lr']
+        self.optimizer = param_dict.get('optimizer', 'rmsprop')
         self.es_threshold = param_dict['es_threshold']
         self.es_min_steps = param_dict['es_min_steps']
         self.es_win_size = param_dict['es_win_size']
@@ -528,6 +572,7 @@ class ABCIArCOGPConfig(ABCIBaseConfig):
     inference_mode: str = 'joint'  # 'joint' and 'no_gp_hps' available
     num_workers: int = 1
     max_ps_size: int = 2
+    max_ps_weight_elements: int = 2 ** 24  # max (order, node, parent set) entries processed at once
 
     # run config
     checkpoint_interval: int = 10
@@ -573,6 +618,7 @@ class ABCIArCOGPConfig(ABCIBaseConfig):
                   'inference_mode': self.inference_mode,
                   'num_workers': self.num_workers,
                   'max_ps_size': self.max_ps_size,
+                  'max_ps_weight_elements': self.max_ps_weight_elements,
                   # run config
                   'checkpoint_interval': self.checkpoint_interval,
                   'output_dir': self.output_dir,
@@ -605,6 +651,7 @@ class ABCIArCOGPConfig(ABCIBaseConfig):
         self.inference_mode = param_dict['inference_mode']
         self.num_workers = param_dict['num_workers']
         self.max_ps_size = param_dict['max_ps_size']
+        self.max_ps_weight_elements = param_dict.get('max_ps_weight_elements', 2 ** 24)
 
         # run config
         self.checkpoint_interval = param_dict['checkpoint_interval']
@@ -1,4 +1,4 @@
-from typing import Callable, List, Dict, Any, Optional, Union
+from typing import Callable, Dict, Any, Optional
 
 import networkx as nx
 import torch.optim
@@ -8,12 +8,11 @@ from src.abci_base import ABCIBase
 from src.config import ABCIArCOGPConfig
 from src.environments.environment import Environment
 from src.graph_models.arco import ArCO
-from src.mechanism_models.mechanisms import get_mechanism_key
 from src.mechanism_models.shared_data_gp_model import SharedDataGaussianProcessModel
-from src.utils.causal_orders import CausalOrder, generate_all_mechanisms, generate_all_parent_sets
-from src.utils.graphs import dag_to_cpdag, adj_mat_to_graph
+from src.utils.causal_orders import CausalOrder, CausalOrderBatch
+from src.utils.graphs import dag_to_cpdag
 from src.utils.metrics import aid, compute_structure_metrics, mmd
-from src.utils.utils import inf_tensor
+from src.utils.parent_sets import ParentSetScoreTable
 
 
 class ABCIArCOGP(ABCIBase):
@@ -38,9 +37,13 @@ class ABCIArCOGP(ABCIBase):
 
         # init caches
         self.node_label_to_id_dict = dict(zip(self.env.node_labels, list(range(self.env.num_nodes))))
-        self.ps_weight_cache: Dict[str, torch.Tensor] = {}  # holds log p(X_i, \psi_i | pa_i) * p(pa_i | L)
-        self.co_weight_cache: Dict[str, torch.Tensor] = {}  # holds log p(X_i, \psi_i | L) for i=1..d
-        self.co_weights: Optional[torch.Tensor] = None  # shape (num_mc_cos, num_nodes)
+        # holds log p(X_i, \psi_i | pa_i) for all nodes and parent sets
+        self.ps_score_table = ParentSetScoreTable(self.env.node_labels, self.cfg.max_ps_size)
+        # the unique mc cos weighted last, the parent set log-weights log p(X_i, \psi_i | pa_i) * p(pa_i | L) of any
+        # weighted orders are recomputed from the score table in chunks of orders
+        self.mc_cos: Optional[CausalOrderBatch] = None
+        self.co_weights: Optional[torch.Tensor] = None  # shape (num_unique_mc_cos, num_nodes)
+        self.co_counts: Optional[torch.Tensor] = None  # multiplicities of the unique mc cos, shape (num_unique_mc_cos,)
 
     def experiment_designer_factory(self):
         raise NotImplementedError
@@ -90,8 +93,7 @@ class ABCIArCOGP(ABCIBase):
             self.mechanism_model.clear_prior_mll_cache()
             self.mechanism_model.clear_posterior_mll_cache()
             self.mechanism_model.clear_rmse_cache()
-            self.co_weight_cache.clear()
-            self.ps_weight_cache.clear()
+            self.ps_score_table.clear()
 
             # update model
             self.update_co_model()
@@ -117,8 +119,13 @@ class ABCIArCOGP(ABCIBase):
         arco_optimizer = torch.optim.Adam(self.co_model.parameters(), lr=self.cfg.arco_lr)
         co_baselines = [torch.tensor(0.)]
         for step in range(self.cfg.num_arco_steps):
-            mc_cos, mc_adj_masks = self.sample_mc_cos(num_cos=self.cfg.num_cos_arco_opt)
-            co_weights = self.co_weights.sum(dim=1)
+            # sample orders together with their differentiable log-probs and compute their weights
+            mc_cos, _, co_log_prior = self.co_model.sample_with_log_prob(self.cfg.num_cos_arco_opt)
+            unique_cos, inverse_idc, co_counts = mc_cos.unique()
+            self.compute_co_weights(unique_cos, unique_cos.get_adjacency_masks(), co_counts)
+
+            # expand the weights of the unique orders to all sampled orders
+            co_weights = self.co_weights.sum(dim=1)[inverse_idc]
             co_weights = (co_weights - co_weights.logsumexp(dim=0)).exp()
 
             # compute log prior p(\theta)
@@ -128,7 +135,6 @@ class ABCIArCOGP(ABCIBase):
             bl = co_weights.mean() * self.cfg.tau + co_baselines[-1] * (1. - self.cfg.tau)
             co_baselines.append(bl)
 
-            co_log_prior = self.co_model.log_prob(mc_cos).squeeze(0)
             arco_loss = -((co_weights - co_baselines[-1]) * co_log_prior).sum() - log_arco_prior
 
             # co model updates
@@ -151,156 +157,196 @@ class ABCIArCOGP(ABCIBase):
         num_cos = self.cfg.num_mc_cos if num_cos is None else num_cos
 
         with torch.no_grad():
-            # sample causal orders
-            mc_cos, mc_adj_masks = self.co_model.sample(num_cos)
+            # sample causal orders and collapse duplicates
+            mc_cos, _ = self.co_model.sample(num_cos)
+            mc_cos, _, co_counts = mc_cos.unique()
+            mc_adj_masks = mc_cos.get_adjacency_masks()
 
-            mechanism_keys = set()
-            for cidx in range(num_cos):
-                mechs = generate_all_mechanisms(self.env.node_labels, self.cfg.max_ps_size, mc_adj_masks[cidx])
-                mechanism_keys.update(set(mechs))
+        self.compute_co_weights(mc_cos, mc_adj_masks, co_counts, set_data)
+        return mc_cos, mc_adj_masks
 
-            mechanism_keys = list(mechanism_keys)
+    def compute_co_weights(self, mc_cos: CausalOrderBatch, mc_adj_masks: torch.Tensor, co_counts: torch.Tensor = None,
+                           set_data=False):
+        num_cos = len(mc_cos)
+        self.co_counts = torch.ones(num_cos) if co_counts is None else co_counts.float()
+        self.mc_cos = mc_cos
+        with torch.no_grad():
+            admissible_mechanisms = self.admissible_mechanisms(mc_cos)
+            mechanism_ids = self.ps_score_table.get_mechanism_ids(admissible_mechanisms.nonzero())
 
         # initialize mechanisms
         self.sample_time += 1
-        self.mechanism_model.init_mechanisms_from_keys(mechanism_keys, self.sample_time)
+        self.mechanism_model.init_mechanisms(mechanism_ids, self.sample_time)
 
         # discard older gps/topolocial orders
         self.mechanism_model.discard_gps()
 
         # update mechanism hyperparameters
         if self.cfg.inference_mode == 'joint':
-            self.mechanism_model.update_gp_hyperparameters(self.experiments, mechanism_keys)
+            self.mechanism_model.update_gp_hyperparameters(self.experiments, mechanism_ids)
         elif set_data:
             self.mechanism_model.set_data(self.experiments)
 
-        # pre-compute mc weights
-        self.co_weights = torch.zeros(num_cos, self.env.num_nodes)
         with torch.no_grad():
-            for cidx, co in enumerate(mc_cos):
-                # if co weights already pre-computed, take cached value
-                if co.__repr__() in self.co_weight_cache:
-                    self.co_weights[cidx] = self.co_weight_cache[co.__repr__()]
-                    continue
-
-                # else compute co and ps weights
-                parent_sets = self.generate_co_parent_sets(mc_adj_masks[cidx])
-                for nidx, node in enumerate(self.env.node_labels):
-                    node_weights = torch.zeros(len(parent_sets[node]))
-                    for pidx, parents in enumerate(parent_sets[node]):
-                        key = get_mechanism_key(node, parents)
-                        if key in self.ps_weight_cache:
-                            weight = self.ps_weight_cache[key].clone()
-                        else:
-                            with torch.no_grad():
-                                weight = self.mechanism_model.node_mll(self.experiments, node, parents, prior_mode=True)
-                                weight -= torch.tensor(len(parent_sets[node])).log()  # uniform prior over parent sets
-                                if self.cfg.inference_mode == 'joint':
-                                    weight += self.mechanism_model.mechanism_log_hp_priors([key])
-
-                            self.ps_weight_cache[key] = weight
-
-                        node_weights[pidx] = weight
-                    self.co_weights[cidx, nidx] = node_weights.logsumexp(dim=0)
-
-                self.co_weight_cache[co.__repr__()] = self.co_weights[cidx]
-
-        return mc_cos, mc_adj_masks
-
-    def sample_mc_graphs(self, mc_cos: List[CausalOrder], mc_adj_masks: torch.Tensor, num_mc_graphs: int = None):
+            # compute the scores of all mechanisms not yet in the score table
+            missing_idc = self.ps_score_table.missing_scores(admissible_mechanisms)
+            missing_ids = self.ps_score_table.get_mechanism_ids(missing_idc)
+            scores = self.mechanism_model.mechanism_mlls(self.experiments, missing_ids)
+            if self.cfg.inference_mode == 'joint':
+                scores += self.mechanism_model.mechanism_log_hp_priors(missing_ids, reduce=False)
+            self.ps_score_table.set_scores(missing_idc[:, 0], missing_idc[:, 1], scores)
+
+            # compute the weights of the orders by marginalising over the consistent parent sets
+            self.co_weights = torch.cat([ps_log_weights.logsumexp(dim=-1) for _, ps_log_weights in
+                                         self.ps_log_weight_chunks(mc_cos)])
+
+    def admissible_mechanisms(self, mc_cos: CausalOrderBatch) -> torch.Tensor:
+        """Returns the (node, parent set) pairs admissible in any of the given orders as boolean tensor of shape
+        (num_nodes, num_parent_sets).
+        """
+        index = self.ps_score_table.index
+        positions = mc_cos.get_positions()
+        admissible = torch.zeros(index.num_nodes, index.num_parent_sets, dtype=torch.bool)
+        for chunk in index.order_chunks(len(mc_cos), self.cfg.max_ps_weight_elements):
+            admissible |= index.consistent_parent_sets(positions[chunk]).any(dim=0)
+        return admissible
+
+    def ps_log_weight_chunks(self, mc_cos: CausalOrderBatch):
+        """Yields the parent set log-weights of shape (chunk_size, num_nodes, num_parent_sets) of the given orders
+        together with the slice of orders they belong to, chunked to bound the peak memory. The scores of all
+        admissible parent sets must be in the score table, i.e., the orders must be weighted with `compute_co_weights`
+        before.
+        """
+        index = self.ps_score_table.index
+        positions = mc_cos.get_positions()
+        for chunk in index.order_chunks(len(mc_cos), self.cfg.max_ps_weight_elements):
+            consistent = index.consistent_parent_sets(positions[chunk])
+            assert self.ps_score_table.missing_scores(consistent.any(dim=0)).numel() == 0, \
+                print('Missing parent set scores, compute the weights of the orders first!')
+            yield chunk, self.ps_score_table.ps_log_weights(consistent)
+
+    def ps_log_prob_chunks(self, mc_cos: CausalOrderBatch):
+        """Yields, in chunks of the given orders, the slice of orders, the normalised parent set log-probabilities
+        log p(pa_i | D, L) of shape (chunk_size, num_nodes, num_parent_sets) and the unnormalised order log-weights of
+        shape (chunk_size,). The multiplicities of the orders are taken into account if the orders are the ones
+        weighted last.
+        """
+        log_counts = self.co_counts.log() if mc_cos is self.mc_cos else torch.zeros(len(mc_cos))
+        for chunk, ps_log_weights in self.ps_log_weight_chunks(mc_cos):
+            node_log_weights = ps_log_weights.logsumexp(dim=-1)
+            co_log_weights = node_log_weights.sum(dim=1) + log_counts[chunk]
+            yield chunk, ps_log_weights - node_log_weights.unsqueeze(-1), co_log_weights
+
+    def log_co_weights(self) -> torch.Tensor:
+        """Returns the normalised log-weights of the current unique mc cos, taking their multiplicities into account.
+        """
+        log_co_weights = self.co_weights.sum(dim=1) + self.co_counts.log()
+        return log_co_weights - log_co_weights.logsumexp(dim=0)
+
+    def sample_mc_graphs(self, mc_cos: CausalOrderBatch, mc_adj_masks: torch.Tensor, num_mc_graphs: int = None):
+        # draws num_mc_graphs graphs per given order, the admissible parents follow from the orders such that the
+        # adjacency masks are only checked for consistency
+        assert mc_adj_masks.shape[0] == len(mc_cos), print('Adjacency masks do not match the given mc cos!')
         num_mc_graphs = self.cfg.num_mc_graphs if num_mc_graphs is None else num_mc_graphs
 
-        mc_adj_mats = torch.zeros(len(mc_cos), num_mc_graphs, self.env.num_nodes, self.env.num_nodes)
+        mc_adj_mats = []
         with torch.no_grad():
-            for cidx, co in enumerate(mc_cos):
-                parent_sets = self.generate_co_parent_sets(mc_adj_masks[cidx])
-
-                for nidx, node in enumerate(self.env.node_labels):
-                    ps_logits = torch.tensor(
-                        [self.ps_weight_cache[get_mechanism_key(node, ps)] for ps in parent_sets[node]])
-
-                    mc_ps_idc = Categorical(logits=ps_logits).sample(torch.Size((num_mc_graphs,)))
-                    mc_ps = [parent_sets[node][ps_idx] for ps_idx in mc_ps_idc]
-                    for ps_idx, ps in enumerate(mc_ps):
-                        parent_ids = [self.node_label_to_id_dict[pa] for pa in ps]
-                        mc_adj_mats[cidx, ps_idx, parent_ids, nidx] = 1
-
-        return mc_adj_mats
-
-    def graph_posterior_expectation_additive(self, func: Callable[[str, List[str]], torch.Tensor],
-                                             mc_cos: List[CausalOrder],
-                                             logspace=False):
-        num_cos = len(mc_cos)
-        co_values = torch.zeros(num_cos, self.env.num_nodes)
-        for cidx, co in enumerate(mc_cos):
-            parent_sets = self.generate_co_parent_sets(co)
-            for nidx, node in enumerate(self.env.node_labels):
-                weighted_values = []
-                for parents in parent_sets[node]:
-                    key = get_mechanism_key(node, parents)
-                    weight = self.ps_weight_cache[key]
-                    func_value = func(node, parents)
-                    if logspace:
-                        weighted_values.append(weight + func_value)
-                    else:
-                        weighted_values.append(weight.exp() * func_value)
-
-                tmp = self.co_weights[cidx].sum() - self.co_weights[cidx, nidx]
-                if logspace:
-                    co_values[cidx, nidx] = tmp + torch.stack(weighted_values, dim=0).logsumexp(dim=0)
-                else:
-                    co_values[cidx, nidx] = tmp.exp() * torch.stack(weighted_values, dim=0).sum(dim=0)
-
-        normalisation = self.co_weights.sum(dim=1).logsumexp(dim=0)
-        if logspace:
-            return co_values.logsumexp(dim=1).logsumexp(dim=0) - normalisation
+            for _, ps_log_weights in self.ps_log_weight_chunks(mc_cos):
+                # draw the parent sets of all (order, node) pairs, shape (num_mc_graphs, chunk_size, num_nodes)
+                mc_ps_idc = Categorical(logits=ps_log_weights).sample(torch.Size((num_mc_graphs,)))
+
+                # look up the parent incidence vectors, shape (chunk_size, num_mc_graphs, num_nodes, num_nodes)
+                mc_adj_mats.append(self.ps_score_table.index.ps_mat[mc_ps_idc.transpose(0, 1)].transpose(-1, -2))
+
+        return torch.cat(mc_adj_mats)
+
+    def compute_mechanism_values(self, func: Callable, mc_cos: CausalOrderBatch, batched=False) -> torch.Tensor:
+        """Evaluates a per-mechanism function once for every (node, parent set) pair that is admissible in any of the
+        given orders.
+
+        Parameters
+        ----------
+        func : Callable
+            Either a function func(node, parents) returning a scalar tensor or, if batched, a function
+            func(mechanism_ids) mapping a list of mechanism ids to a tensor of the same length.
+        mc_cos : CausalOrderBatch
+            The orders.
+        batched : bool
+            Whether func is evaluated on a batch of mechanism ids.
+
+        Returns
+        ------
+        torch.Tensor
+            Tensor of shape (num_nodes, num_parent_sets) holding the function values of the admissible mechanisms
+            and zeros elsewhere.
+        """
+        node_ps_idc = self.admissible_mechanisms(mc_cos).nonzero()
+        if batched:
+            values = func(self.ps_score_table.get_mechanism_ids(node_ps_idc))
         else:
-            return co_values.sum() / normalisation.exp()
+            values = torch.stack([func(self.env.node_labels[nidx], self.ps_score_table.get_parents(ps_idx)) for
+                                  nidx, ps_idx in node_ps_idc.tolist()])
+
+        mechanism_values = torch.zeros(self.env.num_nodes, self.ps_score_table.index.num_parent_sets)
+        mechanism_values[node_ps_idc[:, 0], node_ps_idc[:, 1]] = values.view(-1).float()
+        return mechanism_values
+
+    def graph_posterior_expectation_additive(self, func: Callable, mc_cos: CausalOrderBatch, logspace=False,
+                                             batched=False):
+        mechanism_values = self.compute_mechanism_values(func, mc_cos, batched)
+
+        # E[sum_i f(X_i, pa_i)] = sum_L p(L | D) sum_i sum_pa_i p(pa_i | D, L) f(X_i, pa_i)
+        co_values, co_log_weights = [], []
+        for _, ps_log_probs, chunk_log_weights in self.ps_log_prob_chunks(mc_cos):
+            if logspace:
+                co_values.append((ps_log_probs + mechanism_values).logsumexp(dim=(1, 2)))
+            else:
+                co_values.append((ps_log_probs.exp() * mechanism_values).sum(dim=(1, 2)))
+            co_log_weights.append(chunk_log_weights)
+        co_values = torch.cat(co_values)
+        log_co_weights = torch.cat(co_log_weights)
+        log_co_weights = log_co_weights - log_co_weights.logsumexp(dim=0)
 
-    def graph_posterior_expectation_factorising(self, func: Callable[[str, List[str]], torch.Tensor],
-                                                mc_cos: List[CausalOrder],
-                                                logspace=False):
-        num_cos = len(mc_cos)
         if logspace:
-            co_values = torch.zeros(num_cos)
+            return (log_co_weights + co_values).logsumexp(dim=0)
         else:
-            co_values = torch.ones(num_cos)
+            return (log_co_weights.exp() * co_values).sum()
 
-        for cidx, co in enumerate(mc_cos):
-            parent_sets = self.generate_co_parent_sets(co)
-            for nidx, node in enumerate(self.env.node_labels):
-                weighted_values = []
-                for parents in parent_sets[node]:
-                    key = get_mechanism_key(node, parents)
-                    weight = self.ps_weight_cache[key]
-                    func_value = func(node, parents)
-                    if logspace:
-                        weighted_values.append(weight + func_value)
-                    else:
-                        weighted_values.append(weight.exp() * func_value)
-
-                if logspace:
-                    co_values[cidx] += torch.stack(weighted_values, dim=0).logsumexp(dim=0)
-                else:
-                    co_values[cidx] *= torch.stack(weighted_values, dim=0).sum(dim=0)
+    def graph_posterior_expectation_factorising(self, func: Callable, mc_cos: CausalOrderBatch, logspace=False,
+                                                batched=False):
+        mechanism_values = self.compute_mechanism_values(func, mc_cos, batched)
+
+        # E[prod_i f(X_i, pa_i)] = sum_L p(L | D) prod_i sum_pa_i p(pa_i | D, L) f(X_i, pa_i)
+        node_values, co_log_weights = [], []
+        for _, ps_log_probs, chunk_log_weights in self.ps_log_prob_chunks(mc_cos):
+            if logspace:
+                node_values.append((ps_log_probs + mechanism_values).logsumexp(dim=-1))
+            else:
+                node_values.append((ps_log_probs.exp() * mechanism_values).sum(dim=-1))
+            co_log_weights.append(chunk_log_weights)
+        node_values = torch.cat(node_values)
+        log_co_weights = torch.cat(co_log_weights)
+        log_co_weights = log_co_weights - log_co_weights.logsumexp(dim=0)
 
-        normalisation = self.co_weights.sum(dim=1).logsumexp(dim=0)
         if logspace:
-            return co_values.logsumexp(dim=0) - normalisation
+            return (log_co_weights + node_values.sum(dim=1)).logsumexp(dim=0)
         else:
-            return co_values.sum() / normalisation.exp()
-
-    def graph_posterior_expectation_mc(self, func: Callable[[torch.Tensor], torch.Tensor],
-                                       mc_cos: List[CausalOrder] = None, mc_adj_mats: torch.Tensor = None,
-                                       logspace=False):
+            return (log_co_weights.exp() * node_values.prod(dim=1)).sum()
 
+    def get_mc_graphs(self, mc_cos: CausalOrderBatch = None, mc_adj_mats: torch.Tensor = None):
         if mc_cos is None and mc_adj_mats is None:
             mc_cos, _ = self.sample_mc_cos(set_data=True)
 
         if mc_adj_mats is None:
-            mc_adj_masks = torch.stack([co.get_adjacency_mask() for co in mc_cos])
-            mc_adj_mats = self.sample_mc_graphs(mc_cos, mc_adj_masks)
+            mc_adj_mats = self.sample_mc_graphs(mc_cos, mc_cos.get_adjacency_masks())
+
+        return mc_cos, mc_adj_mats
+
+    def graph_posterior_expectation_mc(self, func: Callable[[torch.Tensor], torch.Tensor],
+                                       mc_cos: CausalOrderBatch = None, mc_adj_mats: torch.Tensor = None,
+                                       logspace=False):
 
+        mc_cos, mc_adj_mats = self.get_mc_graphs(mc_cos, mc_adj_mats)
         num_cos, num_graphs = mc_adj_mats.shape[0:2]
         if logspace:
             co_values = torch.zeros(num_cos)
@@ -314,9 +360,7 @@ class ABCIArCOGP(ABCIBase):
         func_values = torch.stack(func_values).view(num_cos, num_graphs, *func_output_shape)
 
         # compute expectation
-        log_co_weights = self.co_weights.sum(dim=1)
-        log_co_weights -= log_co_weights.logsumexp(dim=0)
-        log_co_weights = log_co_weights.view(num_cos, *([1] * func_dims))
+        log_co_weights = self.log_co_weights().view(num_cos, *([1] * func_dims))
         if logspace:
             func_values = func_values.logsumexp(dim=1) - torch.tensor(num_graphs).log()
             expected_value = (log_co_weights + func_values).logsumexp(dim=0)
@@ -327,109 +371,99 @@ class ABCIArCOGP(ABCIBase):
         return expected_value
 
     def co_posterior_expectation(self, func: Callable[[CausalOrder], torch.Tensor],
-                                 mc_cos: List[CausalOrder]):
+                                 mc_cos: CausalOrderBatch):
         num_cos = len(mc_cos)
 
-        # compute function values
+        # compute function values (this creates the CausalOrder objects)
         func_values = torch.stack([func(co) for co in mc_cos])
         func_output_dim = func_values.dim() - 1
 
         # compute expectation
-        log_co_weights = self.co_weights.sum(dim=1)
-        log_co_weights = (log_co_weights - log_co_weights.logsumexp(dim=0)).view(num_cos, *([1] * func_output_dim))
+        log_co_weights = self.log_co_weights().view(num_cos, *([1] * func_output_dim))
         expected_value = (log_co_weights.exp() * func_values).sum()
         return expected_value
 
-    def compute_posterior_edge_probs(self, mc_cos: List[CausalOrder]):
-        log_probs = -torch.ones(len(mc_cos), self.env.num_nodes, self.env.num_nodes) * inf_tensor()
-        for cidx, co in enumerate(mc_cos):
-            parent_sets = self.generate_co_parent_sets(co)
-            for sidx, source in enumerate(self.env.node_labels):
-                for tidx, target in enumerate(self.env.node_labels):
-                    if sidx == tidx:
-                        continue
-
-                    keys = [get_mechanism_key(target, parents) for parents in parent_sets[target] if source in parents]
-                    if len(keys) == 0:
-                        continue
-
-                    log_prob = self.co_weights[cidx].sum() - self.co_weights[cidx, tidx]
-                    weights = torch.tensor([self.ps_weight_cache[key] for key in keys])
-                    log_probs[cidx, sidx, tidx] = log_prob + weights.logsumexp(dim=0)
-
-        normalisation = self.co_weights.sum(dim=1).logsumexp(dim=0)
-        posterior_edge_probs = log_probs.logsumexp(dim=0) - normalisation
-        return posterior_edge_probs.exp()
-
-    def estimate_ace(self, target: str, interventions: dict, num_samples: int, mc_cos: List[CausalOrder] = None,
+    def compute_posterior_edge_probs(self, mc_cos: CausalOrderBatch):
+        # per chunk, the order log-weights and the edge probabilities averaged over the orders of the chunk
+        chunk_log_weights, chunk_edge_probs = [], []
+        for _, ps_log_probs, co_log_weights in self.ps_log_prob_chunks(mc_cos):
+            # edge probabilities p(X_j -> X_i | D, L) given each order, shape (chunk_size, num_nodes, num_nodes)
+            co_edge_probs = (ps_log_probs.exp() @ self.ps_score_table.index.ps_mat).transpose(-1, -2)
+
+            chunk_log_weights.append(co_log_weights.logsumexp(dim=0))
+            co_probs = (co_log_weights - chunk_log_weights[-1]).exp().view(-1, 1, 1)
+            chunk_edge_probs.append((co_probs * co_edge_probs).sum(dim=0))
+
+        chunk_probs = torch.stack(chunk_log_weights).softmax(dim=0).view(-1, 1, 1)
+        return (chunk_probs * torch.stack(chunk_edge_probs)).sum(dim=0)
+
+    def get_mc_graph_orders(self, mc_adj_mats: torch.Tensor, mc_cos: CausalOrderBatch = None) -> torch.LongTensor:
+        """Returns a topological order for each of the mc graphs of shape (num_cos, num_graphs, num_nodes, num_nodes),
+        flattened to shape (num_cos * num_graphs, num_nodes). Graphs drawn given a causal order are consistent with it,
+        otherwise each graph is sorted individually.
+        """
+        num_cos, num_graphs, num_nodes = mc_adj_mats.shape[0:3]
+        if mc_cos is not None:
+            return mc_cos.perms.repeat_interleave(num_graphs, dim=0)
+        return self.mechanism_model.get_topological_orders(mc_adj_mats.view(-1, num_nodes, num_nodes),
+                                                           self.sample_time)
+
+    def estimate_ace(self, target: str, interventions: dict, num_samples: int, mc_cos: CausalOrderBatch = None,
                      mc_adj_mats: torch.Tensor = None) -> torch.Tensor:
-        def ate_wrapper(adj_mat: torch.Tensor):
-            graph = adj_mat_to_graph(adj_mat, self.mechanism_model.node_labels)
-            self.mechanism_model.init_topological_order(graph, self.sample_time)
-            return self.mechanism_model.sample_ace(target, interventions, num_samples, graph).mean()
+        mc_cos, mc_adj_mats = self.get_mc_graphs(mc_cos, mc_adj_mats)
+        num_cos, num_graphs, num_nodes = mc_adj_mats.shape[0:3]
 
-        ate = self.graph_posterior_expectation_mc(ate_wrapper, mc_cos, mc_adj_mats)
-        return ate
+        # sample all graphs at once
+        orders = self.get_mc_graph_orders(mc_adj_mats, mc_cos)
+        ates = self.mechanism_model.batched_sample_ace(target, interventions, num_samples,
+                                                       mc_adj_mats.view(-1, num_nodes, num_nodes), orders)
+        ates = ates.mean(dim=-1).view(num_cos, num_graphs)
+        return (ates.mean(dim=1) * self.log_co_weights().exp()).sum(dim=0)
 
-    def estimate_aces(self, interventions: dict, num_samples: int, mc_cos: List[CausalOrder] = None,
+    def estimate_aces(self, interventions: dict, num_samples: int, mc_cos: CausalOrderBatch = None,
                       mc_adj_mats: torch.Tensor = None) -> torch.Tensor:
-        def ace_wrapper(adj_mat: torch.Tensor):
-            graph = adj_mat_to_graph(adj_mat, self.mechanism_model.node_labels)
-            self.mechanism_model.init_topological_order(graph, self.sample_time)
-            return self.mechanism_model.sample_aces(interventions, num_samples, graph).mean(dim=1)
+        mc_cos, mc_adj_mats = self.get_mc_graphs(mc_cos, mc_adj_mats)
+        num_cos, num_graphs, num_nodes = mc_adj_mats.shape[0:3]
 
-        aces = self.graph_posterior_expectation_mc(ace_wrapper, mc_cos, mc_adj_mats)
-        return aces
+        # sample all graphs at once
+        orders = self.get_mc_graph_orders(mc_adj_mats, mc_cos)
+        aces = self.mechanism_model.batched_sample_aces(interventions, num_samples,
+                                                        mc_adj_mats.view(-1, num_nodes, num_nodes), orders)
+        aces = aces.mean(dim=-1).view(num_cos, num_graphs, num_nodes)
+        return (aces.mean(dim=1) * self.log_co_weights().exp().unsqueeze(-1)).sum(dim=0)
 
     def sample(self, interventions: dict, num_samples_per_graph: int, adj_mats: torch.Tensor = None):
+        mc_cos = None
         if adj_mats is None:
             mc_cos, mc_adj_masks = self.sample_mc_cos(set_data=True, num_cos=self.cfg.num_mc_cos)
             adj_mats = self.sample_mc_graphs(mc_cos, mc_adj_masks, num_mc_graphs=self.cfg.num_mc_graphs)
 
-        num_cos, num_graphs = adj_mats.shape[0:2]
-        samples = {node: torch.zeros(num_cos, num_graphs, num_samples_per_graph) for node in
-                   self.mechanism_model.node_labels}
-
+        num_cos, num_graphs, num_nodes = adj_mats.shape[0:3]
         with torch.no_grad():
-            for cidx in range(num_cos):
-                for gidx in range(num_graphs):
-                    graph = adj_mat_to_graph(adj_mats[cidx, gidx], self.mechanism_model.node_labels)
-                    self.mechanism_model.init_topological_order(graph, self.sample_time)
-                    exp = self.mechanism_model.sample(interventions, 1, num_samples_per_graph, graph)
-                    for node in samples:
-                        samples[node][cidx, gidx] = exp.data[node].squeeze()
-
+            # sample all graphs at once
+            orders = self.get_mc_graph_orders(adj_mats, mc_cos)
+            samples = self.mechanism_model.batched_sample(interventions, num_samples_per_graph,
+                                                          adj_mats.view(-1, num_nodes, num_nodes), orders)
             for node in samples:
                 samples[node] = samples[node].reshape(-1)
 
             # compute sample weights
-            log_co_weights = self.co_weights.sum(dim=1)
-            log_co_weights -= log_co_weights.logsumexp(dim=0)
-            weights = log_co_weights.exp() / (num_graphs * num_samples_per_graph)
+            weights = self.log_co_weights().exp() / (num_graphs * num_samples_per_graph)
             weights = weights.unsqueeze(1).expand(-1, num_graphs * num_samples_per_graph).reshape(-1)
         return samples, weights
 
     def sample_ace(self, target: str, interventions: dict, num_samples: int, adj_mats: torch.Tensor):
-        num_cos, num_graphs = adj_mats.shape[0:2]
-        ates = torch.zeros(num_cos, num_graphs, num_samples)
-
-        log_co_weights = self.co_weights.sum(dim=1)
-        log_co_weights -= log_co_weights.logsumexp(dim=0)
-        co_weights = log_co_weights.exp()
-        for cidx in range(num_cos):
-            for gidx in range(num_graphs):
-                graph = adj_mat_to_graph(adj_mats[cidx, gidx], self.mechanism_model.node_labels)
-                self.mechanism_model.init_topological_order(graph, self.sample_time)
-                ates[cidx, gidx] = self.mechanism_model.sample_ace(target, interventions, num_samples, graph)
+        num_cos, num_graphs, num_nodes = adj_mats.shape[0:3]
+        co_weights = self.log_co_weights().exp()
 
+        # sample all graphs at once
+        orders = self.get_mc_graph_orders(adj_mats)
+        ates = self.mechanism_model.batched_sample_ace(target, interventions, num_samples,
+                                                       adj_mats.view(-1, num_nodes, num_nodes), orders)
         ates = ates.view(num_cos, -1)
         weights = co_weights.unsqueeze(-1).expand_as(ates).reshape(-1) / (num_graphs * num_samples)
         return ates.view(-1), weights
 
-    def generate_co_parent_sets(self, co: Union[CausalOrder, torch.Tensor]):
-        adj_mask = co.get_adjacency_mask() if isinstance(co, CausalOrder) else co
-        return generate_all_parent_sets(self.env.node_labels, self.cfg.max_ps_size, adj_mask)
-
     def compute_stats(self):
         mc_cos, mc_adj_masks = self.sample_mc_cos(set_data=True)
 
@@ -466,7 +500,6 @@ class ABCIArCOGP(ABCIBase):
 
         print('Computing AID metrics...', flush=True)
         # sample mc graphs
-        mc_adj_masks = torch.stack([co.get_adjacency_mask() for co in mc_cos])
         mc_adj_mats = self.sample_mc_graphs(mc_cos, mc_adj_masks)
 
         # record AID metrics to true DAG
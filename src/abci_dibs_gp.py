@@ -13,7 +13,7 @@ from src.environments.experiment import Experiment
 from src.graph_models.dibs_model import DiBSModel
 from src.mechanism_models.gp_model import get_unique_mechanisms
 from src.mechanism_models.shared_data_gp_model import SharedDataGaussianProcessModel
-from src.utils.graphs import dag_to_cpdag
+from src.utils.graphs import dag_to_cpdag, is_dag_batch
 from src.utils.metrics import compute_structure_metrics, aid, mmd
 from src.utils.utils import inf_tensor
 
@@ -208,19 +208,15 @@ class ABCIDiBSGP(ABCIBase):
         if only_dags:
             self.graph_model.dagify_graphs(mc_graphs, mc_adj_mats, alpha)
 
-        # initialize mechanisms
+        # initialize mechanisms and the topological orders of all acyclic graphs at once
         self.sample_time += 1
-        mechanism_keys = set()
-        num_particles, num_graphs = mc_adj_mats.shape[0:2]
-        num_cyclic = 0
+        mechanism_ids = set()
+        num_particles, num_graphs, num_nodes = mc_adj_mats.shape[0:3]
+        self.mechanism_model.init_topological_orders(mc_adj_mats.view(-1, num_nodes, num_nodes), self.sample_time)
         for pidx in range(num_particles):
             for gidx in range(num_graphs):
-                if not nx.is_directed_acyclic_graph(mc_graphs[pidx][gidx]):
-                    num_cyclic += 1
-                else:
-                    self.mechanism_model.init_topological_order(mc_graphs[pidx][gidx], self.sample_time)
-                keys = self.mechanism_model.init_graph_mechanisms(mc_graphs[pidx][gidx], self.sample_time)
-                mechanism_keys.update(keys)
+                ids = self.mechanism_model.init_graph_mechanisms(mc_graphs[pidx][gidx], self.sample_time)
+                mechanism_ids.update(ids)
         # print(f'Sampled {num_cyclic}/{num_particles * num_graphs} cyclic graphs!')
 
         # discard older gps/topolocial orders
@@ -229,7 +225,7 @@ class ABCIDiBSGP(ABCIBase):
 
         # update mechanism hyperparameters
         if self.cfg.inference_mode == 'joint':
-            self.mechanism_model.update_gp_hyperparameters(self.experiments, list(mechanism_keys))
+            self.mechanism_model.update_gp_hyperparameters(self.experiments, list(mechanism_ids))
         elif set_data:
             self.mechanism_model.set_data(self.experiments)
 
@@ -300,11 +296,8 @@ class ABCIDiBSGP(ABCIBase):
 
         # assign cyclic graphs zero weight -> only acyclic graphs hold weight
         if exclude_cyclic:
-            cyclic = []
-            for pidx in range(num_particles):
-                cyclic.append(torch.tensor([not nx.is_directed_acyclic_graph(g) for g in mc_graphs[pidx]]))
-
-            cyclic = torch.stack(cyclic, dim=0)
+            num_nodes = mc_adj_mats.shape[-1]
+            cyclic = ~is_dag_batch(mc_adj_mats.view(-1, num_nodes, num_nodes)).view(num_particles, num_mc_graphs)
             graph_mlls = torch.where(cyclic, -inf_tensor(), graph_mlls)
 
         log_normalization = graph_mlls.logsumexp(dim=1)
@@ -330,14 +323,15 @@ class ABCIDiBSGP(ABCIBase):
         if mc_graphs is None or mc_adj_mats is None:
             mc_graphs, mc_adj_mats = self.sample_mc_graphs(set_data=True)
 
-        num_particles, num_graphs = mc_adj_mats.shape[0:2]
+        num_particles, num_graphs, num_nodes = mc_adj_mats.shape[0:3]
         samples = {node: torch.zeros(num_particles, num_graphs, num_samples_per_graph) for node in
                    self.mechanism_model.node_labels}
 
         with torch.no_grad():
+            acyclic = is_dag_batch(mc_adj_mats.view(-1, num_nodes, num_nodes)).view(num_particles, num_graphs)
             for pidx in range(num_particles):
                 for gidx, graph in enumerate(mc_graphs[pidx]):
-                    if nx.is_directed_acyclic_graph(graph):
+                    if acyclic[pidx, gidx]:
                         exp = self.mechanism_model.sample(interventions, 1, num_samples_per_graph, graph)
                         for node in samples:
                             samples[node][pidx, gidx] = exp.data[node].squeeze()
@@ -409,8 +403,9 @@ class ABCIDiBSGP(ABCIBase):
 
         print('Computing AID metrics...', flush=True)
 
-        is_cyclic = [all([not nx.is_directed_acyclic_graph(g) for g in pgraphs]) for pgraphs in mc_graphs]
-        if all(is_cyclic):
+        num_nodes = mc_adj_mats.shape[-1]
+        acyclic = is_dag_batch(mc_adj_mats.view(-1, num_nodes, num_nodes)).view(mc_adj_mats.shape[0:2])
+        if not acyclic.any(dim=1).any():
             # for the exceptional case that all sampled graphs are cyclic, the AIDs are set to 1.
             print('All sampled graphs are cyclic!')
             self.record_stat('aaid', torch.tensor(1.))
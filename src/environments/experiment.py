@@ -193,6 +193,132 @@ def gather_data(experiments: List[Experiment], node: str, graph: nx.DiGraph = No
     return inputs, targets
 
 
+class DataStore:
+    """Columnar storage of the samples of a growing list of experiments. All samples are kept in one contiguous
+    (num_samples, num_nodes) tensor in the order of node_labels, together with a mask of the intervened nodes of each
+    sample and the row offsets of the experiments. The capacity is doubled when needed, such that appending samples is
+    amortised O(1).
+
+    For each node, the row indices of the samples of experiments that do not intervene on the node and the
+    corresponding data (see `gather_data` with parents=node_labels) are cached until the next append. If no sample
+    intervenes on the node, the inputs are a view of the store without copies.
+    """
+    node_labels: List[str]
+    data: Optional[torch.Tensor]
+    intervened: Optional[torch.Tensor]
+    offsets: List[int]
+    experiments: List[Experiment]
+
+    def __init__(self, node_labels: List[str], capacity: int = 1024):
+        """
+        Parameters
+        ----------
+        node_labels : List[str]
+            The node labels determining the column order.
+        capacity : int
+            Initial number of rows.
+        """
+        self.node_labels = node_labels
+        self.node_to_dim_map = {node: idx for idx, node in enumerate(node_labels)}
+        self.initial_capacity = capacity
+        self.reset()
+
+    def reset(self):
+        self.capacity = self.initial_capacity
+        self.data = None
+        self.intervened = None
+        self.num_samples = 0
+        self.offsets = [0]
+        self.experiments = []
+        self.row_idc = dict()
+        self.node_data = dict()
+
+    def __len__(self):
+        return self.num_samples
+
+    def grow(self, min_capacity: int):
+        new_capacity = max(2 * self.capacity, min_capacity)
+        self.data = torch.cat((self.data, self.data.new_zeros(new_capacity - self.capacity, self.data.shape[1])))
+        self.intervened = torch.cat((self.intervened, self.intervened.new_zeros(new_capacity - self.capacity,
+                                                                                 self.intervened.shape[1])))
+        self.capacity = new_capacity
+
+    def append(self, experiment: Experiment):
+        num_nodes = len(self.node_labels)
+        rows = torch.cat([experiment.data[node] for node in self.node_labels], dim=-1).view(-1, num_nodes)
+        if self.data is None:
+            self.data = rows.new_zeros(self.capacity, num_nodes)
+            self.intervened = torch.zeros(self.capacity, num_nodes, dtype=torch.bool, device=rows.device)
+        if self.num_samples + rows.shape[0] > self.capacity:
+            self.grow(self.num_samples + rows.shape[0])
+
+        start, end = self.num_samples, self.num_samples + rows.shape[0]
+        self.data[start:end] = rows
+        self.intervened[start:end] = torch.tensor([node in experiment.interventions for node in self.node_labels],
+                                                  device=rows.device)
+        self.num_samples = end
+        self.offsets.append(end)
+        self.experiments.append(experiment)
+
+        # cached per-node data is outdated
+        self.row_idc.clear()
+        self.node_data.clear()
+
+    def update(self, experiments: List[Experiment]):
+        # start over if the experiments are not an extension of the stored ones
+        num_stored = len(self.experiments)
+        if len(experiments) < num_stored or \
+                (num_stored > 0 and experiments[num_stored - 1] is not self.experiments[-1]):
+            self.reset()
+
+        for experiment in experiments[len(self.experiments):]:
+            self.append(experiment)
+
+    def row_indices(self, node: str) -> torch.LongTensor:
+        """Returns the indices of all rows of experiments that do not intervene on the given node.
+        """
+        if node not in self.row_idc:
+            if self.num_samples == 0:
+                self.row_idc[node] = torch.zeros(0, dtype=torch.long)
+            else:
+                observed = ~self.intervened[:self.num_samples, self.node_to_dim_map[node]]
+                self.row_idc[node] = observed.nonzero().squeeze(-1)
+        return self.row_idc[node]
+
+    def gather(self, node: str, mode: str = 'joint'):
+        """Returns the same data as `gather_data(experiments, node, parents=node_labels, mode=mode)`.
+
+        Parameters
+        ----------
+        node : str
+            The target node.
+        mode : str
+            'joint' or 'independent_samples'.
+
+        Returns
+        ------
+        Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]
+            The inputs of shape (num_samples, num_nodes) and targets of shape (num_samples,) in 'joint' mode, or of
+            shapes (num_samples, 1, num_nodes) and (num_samples, 1) in 'independent_samples' mode. (None, None) if
+            there is no data for the node.
+        """
+        assert mode in {'joint', 'independent_samples'}, print('Invalid gather mode: ', mode)
+        if node not in self.node_data:
+            row_idc = self.row_indices(node)
+            if row_idc.numel() == 0:
+                self.node_data[node] = (None, None)
+            else:
+                inputs = self.data[:self.num_samples]
+                if row_idc.numel() < self.num_samples:
+                    inputs = inputs[row_idc]
+                self.node_data[node] = (inputs, inputs[:, self.node_to_dim_map[node]].contiguous())
+
+        inputs, targets = self.node_data[node]
+        if inputs is None or mode == 'joint':
+            return inputs, targets
+        return inputs.unsqueeze(1), targets.unsqueeze(1)
+
+
 class InterventionalDistributionsQuery:
     def __init__(self, query_nodes: List[str], intervention_targets: Dict[str, Distribution]):
         self.query_nodes = query_nodes
@@ -1,4 +1,4 @@
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -6,7 +6,7 @@ from torch.distributions import Categorical, Normal
 from torch.nn.utils import parameters_to_vector
 
 from src.config import ArCOConfig
-from src.utils.causal_orders import CausalOrder, co_from_co_mat
+from src.utils.causal_orders import CausalOrder, CausalOrderBatch, adjacency_masks_from_perms
 from src.utils.utils import inf_tensor
 
 
@@ -28,58 +28,133 @@ class ArCO:
             else:
                 assert False, print(f'Invalid map mode {self.cfg.map_mode}.')
 
-    def sample(self, num_cos: int = 1) -> Tuple[List[CausalOrder], torch.Tensor]:
-        co_list = []
-        for _ in range(num_cos):
-            unassigned = torch.ones(self.num_nodes, dtype=torch.long)
-            co_mat = torch.zeros(self.num_nodes, self.num_nodes)
-            for pidx in range(self.num_nodes - 1):
-                # sample next element of the causal order
-                with torch.no_grad():
-                    logits = self.logit_map(co_mat.unsqueeze(0), torch.LongTensor([pidx])).squeeze()
-                    logits = torch.where(unassigned.bool(), logits, -inf_tensor())
-                    elem_idx = Categorical(logits=logits).sample()
+    def sample(self, num_cos: int = 1) -> Tuple[CausalOrderBatch, torch.Tensor]:
+        perms, masks = self.sample_perms(num_cos)
+        return CausalOrderBatch(perms, self.node_labels), masks
+
+    def sample_perms(self, num_cos: int = 1) -> Tuple[torch.LongTensor, torch.Tensor]:
+        """Samples a batch of causal orders by advancing all orders simultaneously, i.e., with a single logit map
+        evaluation per position.
 
-                co_mat[pidx, elem_idx] = 1.
-                unassigned[elem_idx] = 0
+        Parameters
+        ----------
+        num_cos : int
+            Number of causal orders to sample.
 
-            # prob of the last unassigned element is 1
-            assert unassigned.sum() == 1
-            elem_idx = unassigned.nonzero().squeeze()
-            co_mat[-1, elem_idx] = 1.
+        Returns
+        ------
+        Tuple[torch.LongTensor, torch.Tensor]
+            The sampled orders as permutation tensor of shape (num_cos, num_nodes), where entry (c, i) is the node
+            index at position i in the c-th order, and the corresponding adjacency masks of shape
+            (num_cos, num_nodes, num_nodes).
+        """
+        batch_idc = torch.arange(num_cos)
+        perms = torch.zeros(num_cos, self.num_nodes, dtype=torch.long)
+        unassigned = torch.ones(num_cos, self.num_nodes, dtype=torch.bool)
+        co_mats = torch.zeros(num_cos, self.num_nodes, self.num_nodes)
+        with torch.no_grad():
+            for pidx in range(self.num_nodes - 1):
+                # sample next element of all causal orders
+                logits = self.logit_map(co_mats, torch.LongTensor([pidx])).squeeze(1)
+                logits = torch.where(unassigned, logits, -inf_tensor())
+                elem_idc = Categorical(logits=logits).sample()
 
-            co_list.append(co_from_co_mat(co_mat, self.node_labels))
+                perms[:, pidx] = elem_idc
+                co_mats[batch_idc, pidx, elem_idc] = 1.
+                unassigned[batch_idc, elem_idc] = False
 
-        # assemble adjacency masks
-        masks = []
-        for cidx in range(num_cos):
-            masks.append(co_list[cidx].get_adjacency_mask())
+        # prob of the last unassigned element is 1
+        assert (unassigned.sum(dim=1) == 1).all()
+        perms[:, -1] = unassigned.long().argmax(dim=1)
 
-        masks = torch.stack(masks)
+        return perms, adjacency_masks_from_perms(perms)
 
-        return co_list, masks
+    def sample_with_log_prob(self, num_cos: int = 1) -> Tuple[CausalOrderBatch, torch.Tensor, torch.Tensor]:
+        """Samples a batch of causal orders and returns their log-probabilities from the same forward computation of
+        the logit map. In contrast to `sample_perms`, the log-probabilities are differentiable w.r.t. the parameters
+        of the logit map, e.g., for the score-function estimator.
 
-    def log_prob(self, cos: List[CausalOrder]) -> torch.Tensor:
-        num_cos = len(cos)
+        Parameters
+        ----------
+        num_cos : int
+            Number of causal orders to sample.
+
+        Returns
+        ------
+        Tuple[CausalOrderBatch, torch.Tensor, torch.Tensor]
+            The batch of sampled orders, the corresponding adjacency masks of shape (num_cos, num_nodes, num_nodes)
+            and the log-probabilities of the orders of shape (num_cos,).
+        """
+        batch_idc = torch.arange(num_cos)
+        perms = torch.zeros(num_cos, self.num_nodes, dtype=torch.long)
+        unassigned = torch.ones(num_cos, self.num_nodes, dtype=torch.bool)
+        co_mats = torch.zeros(num_cos, self.num_nodes, self.num_nodes)
         co_log_probs = torch.zeros(num_cos)
-        for co_idx in range(num_cos):
-            if cos[co_idx].num_layers != self.num_nodes:
-                # not a total order / permutation of nodes -> prob is zero
-                co_log_probs[co_idx] = -inf_tensor()
-                continue
-
-            co_mat = cos[co_idx].get_co_mat().unsqueeze(0)
-            co_cum_mat = cos[co_idx].get_co_cum_mat().unsqueeze(0)
-            layer_idc = torch.arange(cos[co_idx].num_layers, dtype=torch.long)
-
-            logits = self.logit_map(co_mat, layer_idc)
-            logits = torch.where(co_cum_mat[:, layer_idc].bool(), -inf_tensor(), logits)
+        for pidx in range(self.num_nodes - 1):
+            # sample next element of all causal orders and accumulate its log-prob
+            logits = self.logit_map(co_mats, torch.LongTensor([pidx])).squeeze(1)
+            logits = torch.where(unassigned, logits, -inf_tensor())
             logprobs = torch.log_softmax(logits, dim=-1)
-            logprobs = torch.where(co_mat[:, layer_idc].bool(), logprobs, -inf_tensor())
-            co_log_probs[co_idx] = logprobs.logsumexp(dim=-1).sum(dim=-1)
+            with torch.no_grad():
+                elem_idc = Categorical(logits=logits).sample()
+            co_log_probs = co_log_probs + logprobs[batch_idc, elem_idc]
+
+            perms[:, pidx] = elem_idc
+            co_mats[batch_idc, pidx, elem_idc] = 1.
+            unassigned[batch_idc, elem_idc] = False
 
+        # prob of the last unassigned element is 1
+        assert (unassigned.sum(dim=1) == 1).all()
+        perms[:, -1] = unassigned.long().argmax(dim=1)
+
+        cos = CausalOrderBatch(perms, self.node_labels)
+        return cos, cos.get_adjacency_masks(), co_log_probs
+
+    def log_prob(self, cos: Union[CausalOrderBatch, List[CausalOrder]]) -> torch.Tensor:
+        if isinstance(cos, CausalOrderBatch):
+            return self.log_prob_perms(cos.perms)
+
+        co_log_probs = -torch.ones(len(cos)) * inf_tensor()
+
+        # orders that are not total orders / permutations of nodes have prob zero
+        co_idc = [co_idx for co_idx, co in enumerate(cos) if co.num_layers == self.num_nodes]
+        if len(co_idc) == 0:
+            return co_log_probs
+
+        perms = torch.stack([cos[co_idx].get_perm() for co_idx in co_idc])
+        co_log_probs[co_idc] = self.log_prob_perms(perms)
         return co_log_probs
 
+    def log_prob_perms(self, perms: torch.LongTensor) -> torch.Tensor:
+        """Computes the log-probabilities of a batch of causal orders in a single masked forward pass of the logit map
+        over all (num_cos x num_nodes) positions.
+
+        Parameters
+        ----------
+        perms : torch.LongTensor
+            Permutation tensor of shape (num_cos, num_nodes), where entry (c, i) is the node index at position i in
+            the c-th order.
+
+        Returns
+        ------
+        torch.Tensor
+            The log-probabilities of the causal orders of shape (num_cos,).
+        """
+        assert perms.dim() == 2 and perms.shape[-1] == self.num_nodes, print(perms.shape)
+        num_cos = perms.shape[0]
+
+        # entry (c, i, j) of the co matrices is 1 if node j is at position i in the c-th order, and entry (c, i, j) of
+        # the assigned matrices is 1 if node j is at any position preceding i
+        co_mats = torch.zeros(num_cos, self.num_nodes, self.num_nodes)
+        co_mats.scatter_(2, perms.unsqueeze(-1), 1.)
+        assigned = co_mats.cumsum(dim=1) - co_mats
+
+        layer_idc = torch.arange(self.num_nodes, dtype=torch.long)
+        logits = self.logit_map(co_mats, layer_idc)
+        logits = torch.where(assigned.bool(), -inf_tensor(), logits)
+        logprobs = torch.log_softmax(logits, dim=-1)
+        return logprobs.gather(-1, perms.unsqueeze(-1)).squeeze(-1).sum(dim=-1)
+
     def parameters(self):
         return list(self.logit_map.parameters())
 
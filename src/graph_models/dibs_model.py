@@ -7,7 +7,7 @@ from torch.autograd import Function
 from torch.nn.functional import logsigmoid
 
 from src.config import DiBSConfig
-from src.utils.graphs import graph_to_adj_mat, adj_mat_to_graph
+from src.utils.graphs import graph_to_adj_mat, adj_mat_to_graph, is_dag_batch
 
 
 class DiBSModel:
@@ -136,9 +136,10 @@ class DiBSModel:
         edge_probs = self.edge_probs(alpha)
         for particle_idx in range(self.cfg.num_particles):
             num_dagified = 0
+            acyclic = is_dag_batch(adj_mats[particle_idx])
             for graph_idx, graph in enumerate(graphs[particle_idx]):
                 # check if the graph is cyclic
-                if not nx.is_directed_acyclic_graph(graphs[particle_idx][graph_idx]):
+                if not acyclic[graph_idx]:
                     edges, _ = self.sort_edges(adj_mats[particle_idx, graph_idx], edge_probs[particle_idx])
 
                     graph = nx.DiGraph()
@@ -0,0 +1,436 @@
+import math
+from collections import OrderedDict
+from typing import List, Tuple, Dict, Optional
+
+import torch
+from linear_operator.utils.cholesky import psd_safe_cholesky
+
+
+def get_parent_index_matrix(parent_ids: List[Tuple[int, ...]], padding_idx: int) -> torch.LongTensor:
+    """Builds a padded matrix of the parent indices of a batch of mechanisms.
+
+    Parameters
+    ----------
+    parent_ids : List[Tuple[int, ...]]
+        The parent indices of each mechanism.
+    padding_idx : int
+        Index used to pad parent sets with less than the maximum number of parents. Should point to an all-zero
+        input column.
+
+    Returns
+    ------
+    torch.LongTensor
+        Index tensor of shape (num_mechanisms, max_num_parents).
+    """
+    max_num_parents = max(max([len(ps) for ps in parent_ids]), 1)
+    parent_idc = torch.full((len(parent_ids), max_num_parents), padding_idx, dtype=torch.long)
+    for midx, ps in enumerate(parent_ids):
+        parent_idc[midx, :len(ps)] = torch.LongTensor(ps)
+    return parent_idc
+
+
+def gather_parent_inputs(inputs: torch.Tensor, parent_idc: torch.LongTensor) -> torch.Tensor:
+    """Gathers the parent inputs of a batch of mechanisms from the shared data matrix.
+
+    Parameters
+    ----------
+    inputs : torch.Tensor
+        Shared input data of shape (num_samples, num_nodes).
+    parent_idc : torch.LongTensor
+        Padded parent indices of shape (num_mechanisms, max_num_parents), where the padding index is num_nodes.
+
+    Returns
+    ------
+    torch.Tensor
+        Parent inputs of shape (num_mechanisms, num_samples, max_num_parents), padded with zeros.
+    """
+    padded_inputs = torch.cat((inputs, inputs.new_zeros(inputs.shape[0], 1)), dim=-1)
+    return padded_inputs[:, parent_idc].permute(1, 0, 2)
+
+
+def squared_distances(x1: torch.Tensor, x2: torch.Tensor = None) -> torch.Tensor:
+    """Computes the pairwise squared distances of (batches of) point sets of shape (..., num_samples, dim).
+    """
+    x2 = x1 if x2 is None else x2
+    x1_norms = x1.pow(2).sum(dim=-1)
+    x2_norms = x1_norms if x2 is x1 else x2.pow(2).sum(dim=-1)
+    sq_dists = x1_norms.unsqueeze(-1) + x2_norms.unsqueeze(-2) - 2. * x1 @ x2.transpose(-1, -2)
+    return sq_dists.clamp_min(0.)
+
+
+def expand_hyperparameter(values: torch.Tensor) -> torch.Tensor:
+    return values.unsqueeze(-1).unsqueeze(-1)
+
+
+def rq_kernel(x1: torch.Tensor, x2: torch.Tensor, outputscales: torch.Tensor, lengthscales: torch.Tensor,
+              alphas: torch.Tensor) -> torch.Tensor:
+    """Computes scaled rational quadratic kernel matrices.
+
+    Parameters
+    ----------
+    x1, x2 : torch.Tensor
+        Parent inputs of shape (..., num_samples, max_num_parents). If x2 is None, x2 = x1.
+    outputscales, lengthscales, alphas : torch.Tensor
+        Kernel hyperparameters of shape (...) that broadcast with the batch dimensions of the inputs.
+
+    Returns
+    ------
+    torch.Tensor
+        Kernel matrices of shape (..., num_samples_x1, num_samples_x2).
+    """
+    lengthscales = expand_hyperparameter(lengthscales)
+    sq_dists = squared_distances(x1 / lengthscales, None if x2 is None else x2 / lengthscales)
+    return rq_kernel_from_sq_dists(sq_dists, outputscales, alphas)
+
+
+def rq_kernel_from_sq_dists(scaled_sq_dists: torch.Tensor, outputscales: torch.Tensor,
+                            alphas: torch.Tensor) -> torch.Tensor:
+    """Computes scaled rational quadratic kernel matrices from squared distances that are already divided by the
+    squared lengthscales.
+    """
+    alphas = expand_hyperparameter(alphas)
+    return expand_hyperparameter(outputscales) * (1. + scaled_sq_dists / (2. * alphas)).log().mul(-alphas).exp()
+
+
+def rq_fourier_features(x: torch.Tensor, outputscales: torch.Tensor, lengthscales: torch.Tensor, alphas: torch.Tensor,
+                        num_features: int, seed: int = 0) -> torch.Tensor:
+    """Computes random Fourier features of the scaled rational quadratic kernel, such that phi(x1)^T phi(x2)
+    approximates the kernel.
+
+    The RQ kernel is a scale mixture of RBF kernels, (1 + r^2 / (2 alpha l^2))^-alpha =
+    E[exp(-tau r^2 / (2 l^2))] with tau ~ Gamma(alpha, alpha). Hence, frequencies are drawn as sqrt(tau) * eps / l with
+    eps ~ N(0, I). The mixing precisions tau are obtained from fixed normal draws via the Wilson-Hilferty transform, so
+    the features are differentiable w.r.t. alpha and all mechanisms share the same base noise for a given seed.
+
+    Parameters
+    ----------
+    x : torch.Tensor
+        Parent inputs of shape (..., num_samples, max_num_parents).
+    outputscales, lengthscales, alphas : torch.Tensor
+        Kernel hyperparameters of shape (...) that broadcast with the batch dimensions of the inputs.
+    num_features : int
+        Number of frequencies, each yielding a cosine and a sine feature.
+    seed : int
+        Seed of the base noise.
+
+    Returns
+    ------
+    torch.Tensor
+        Features of shape (..., num_samples, 2 * num_features).
+    """
+    # draw base noise such that the frequencies of the first k input dims do not depend on the padding
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+        gamma_base = torch.randn(num_features)
+        freq_base = torch.randn(x.shape[-1], num_features).t()
+
+    # Wilson-Hilferty approximation of Gamma(alpha, alpha) precisions of shape (..., num_features)
+    alphas = alphas.unsqueeze(-1)
+    precisions = (1. - 1. / (9. * alphas) + gamma_base / (3. * alphas.sqrt())).clamp_min(0.).pow(3)
+
+    freqs = precisions.sqrt().unsqueeze(-1) * freq_base / expand_hyperparameter(lengthscales)
+    projections = x @ freqs.transpose(-1, -2)
+    scales = expand_hyperparameter((outputscales / num_features).sqrt())
+    return scales * torch.cat((projections.cos(), projections.sin()), dim=-1)
+
+
+def linear_kernel(x1: torch.Tensor, x2: torch.Tensor, variances: torch.Tensor) -> torch.Tensor:
+    """Computes linear kernel matrices.
+
+    Parameters
+    ----------
+    x1, x2 : torch.Tensor
+        Parent inputs of shape (..., num_samples, max_num_parents). If x2 is None, x2 = x1.
+    variances : torch.Tensor
+        Kernel variances of shape (...) that broadcast with the batch dimensions of the inputs.
+
+    Returns
+    ------
+    torch.Tensor
+        Kernel matrices of shape (..., num_samples_x1, num_samples_x2).
+    """
+    x2 = x1 if x2 is None else x2
+    return expand_hyperparameter(variances) * x1 @ x2.transpose(-1, -2)
+
+
+def batched_gaussian_mll(covars: torch.Tensor, noises: torch.Tensor, targets: torch.Tensor,
+                         means: torch.Tensor = None) -> torch.Tensor:
+    """Computes the log-densities of the targets under a batch of multivariate normals N(mean, K + noise * I) using one
+    batched Cholesky decomposition.
+
+    Parameters
+    ----------
+    covars : torch.Tensor
+        Kernel matrices of shape (num_mechanisms, num_samples, num_samples).
+    noises : torch.Tensor
+        Noise variances of shape (num_mechanisms,).
+    targets : torch.Tensor
+        Targets of shape (num_samples,).
+    means : torch.Tensor
+        Optional constant means of shape (num_mechanisms,). Zero mean if None.
+
+    Returns
+    ------
+    torch.Tensor
+        The marginal log-likelihoods of shape (num_mechanisms,).
+    """
+    num_samples = targets.shape[-1]
+    covars = covars + noises.view(-1, 1, 1) * torch.eye(num_samples, device=covars.device)
+    residuals = targets.view(1, -1, 1).expand(covars.shape[0], -1, -1)
+    if means is not None:
+        residuals = residuals - means.view(-1, 1, 1)
+
+    return cholesky_gaussian_mll(psd_safe_cholesky(covars), residuals)
+
+
+def cholesky_gaussian_mll(cholesky_factors: torch.Tensor, residuals: torch.Tensor) -> torch.Tensor:
+    """Computes the log-densities log N(residuals | 0, L L^T) given the Cholesky factors L of shape
+    (num_mechanisms, num_samples, num_samples) and residuals of shape (num_mechanisms, num_samples, 1).
+    """
+    num_samples = residuals.shape[-2]
+    alphas = torch.cholesky_solve(residuals, cholesky_factors)
+    quad_terms = (residuals * alphas).sum(dim=(-2, -1))
+    log_dets = 2. * cholesky_factors.diagonal(dim1=-2, dim2=-1).log().sum(dim=-1)
+    return -0.5 * (quad_terms + log_dets + num_samples * math.log(2. * math.pi))
+
+
+def extend_cholesky(cholesky_factors: torch.Tensor, cross_covars: torch.Tensor,
+                    new_covars: torch.Tensor) -> torch.Tensor:
+    """Extends the Cholesky factors L of matrices A by appended rows and columns, i.e., computes the Cholesky factors of
+    [[A, B^T], [B, C]] in O(n^2 b) for b new rows.
+
+    Parameters
+    ----------
+    cholesky_factors : torch.Tensor
+        Lower Cholesky factors of A of shape (..., n, n).
+    cross_covars : torch.Tensor
+        The new off-diagonal blocks B of shape (..., b, n).
+    new_covars : torch.Tensor
+        The new diagonal blocks C of shape (..., b, b).
+
+    Returns
+    ------
+    torch.Tensor
+        The extended Cholesky factors of shape (..., n + b, n + b).
+    """
+    l21 = torch.linalg.solve_triangular(cholesky_factors, cross_covars.transpose(-1, -2), upper=False)
+    l21 = l21.transpose(-1, -2)
+    l22 = psd_safe_cholesky(new_covars - l21 @ l21.transpose(-1, -2))
+    upper = torch.cat((cholesky_factors, cholesky_factors.new_zeros(*l22.shape[:-2], cholesky_factors.shape[-2],
+                                                                    l22.shape[-1])), dim=-1)
+    return torch.cat((upper, torch.cat((l21, l22), dim=-1)), dim=-2)
+
+
+def batched_sgpr_mll(knn_diags: torch.Tensor, kmns: torch.Tensor, kmms: torch.Tensor, noises: torch.Tensor,
+                     targets: torch.Tensor, means: torch.Tensor = None) -> torch.Tensor:
+    """Computes Titsias' collapsed evidence lower bound of sparse GPs with inducing points,
+    log N(y | mean, Q + noise * I) - tr(K_nn - Q) / (2 * noise) with Q = K_nm K_mm^-1 K_mn, for a batch of mechanisms
+    in O(n m^2).
+
+    Parameters
+    ----------
+    knn_diags : torch.Tensor
+        Kernel diagonals at the training inputs of shape (num_mechanisms, num_samples).
+    kmns : torch.Tensor
+        Cross-covariances between inducing and training inputs of shape (num_mechanisms, num_inducing, num_samples).
+    kmms : torch.Tensor
+        Inducing point covariances of shape (num_mechanisms, num_inducing, num_inducing).
+    noises : torch.Tensor
+        Noise variances of shape (num_mechanisms,).
+    targets : torch.Tensor
+        Targets of shape (num_samples,).
+    means : torch.Tensor
+        Optional constant means of shape (num_mechanisms,). Zero mean if None.
+
+    Returns
+    ------
+    torch.Tensor
+        The evidence lower bounds of shape (num_mechanisms,).
+    """
+    num_samples = targets.shape[-1]
+    residuals = targets.unsqueeze(0).expand(kmns.shape[0], -1)
+    if means is not None:
+        residuals = residuals - means.unsqueeze(-1)
+
+    noise_scales = noises.sqrt().view(-1, 1, 1)
+    kmm_cholesky, a, b_cholesky = sgpr_factors(kmns, kmms, noises)
+    c = torch.linalg.solve_triangular(b_cholesky, a @ residuals.unsqueeze(-1), upper=False) / noise_scales
+
+    quad_terms = residuals.pow(2).sum(dim=-1) / noises - c.pow(2).sum(dim=(-2, -1))
+    log_dets = num_samples * noises.log() + 2. * b_cholesky.diagonal(dim1=-2, dim2=-1).log().sum(dim=-1)
+    trace_terms = knn_diags.sum(dim=-1) / noises - a.pow(2).sum(dim=(-2, -1))
+    return -0.5 * (quad_terms + log_dets + trace_terms + num_samples * math.log(2. * math.pi))
+
+
+def sgpr_factors(kmns: torch.Tensor, kmms: torch.Tensor, noises: torch.Tensor):
+    """Computes the factors L = chol(K_mm), A = L^-1 K_mn / sqrt(noise) and L_B = chol(I + A A^T) shared by the SGPR
+    evidence and predictions.
+    """
+    num_inducing = kmms.shape[-1]
+    eye = torch.eye(num_inducing, device=kmms.device)
+    kmm_cholesky = psd_safe_cholesky(kmms + 1e-6 * eye)
+    a = torch.linalg.solve_triangular(kmm_cholesky, kmns, upper=False) / expand_hyperparameter(noises.sqrt())
+    b_cholesky = psd_safe_cholesky(eye + a @ a.transpose(-1, -2))
+    return kmm_cholesky, a, b_cholesky
+
+
+def select_inducing_points(inputs: torch.Tensor, num_points: int, strategy: str = 'kmeans',
+                           num_iterations: int = 10) -> torch.Tensor:
+    """Selects inducing inputs from a data matrix.
+
+    Parameters
+    ----------
+    inputs : torch.Tensor
+        Data of shape (num_samples, num_dims).
+    num_points : int
+        Number of inducing points.
+    strategy : str
+        'random' for a random subset of the data, 'kmeans' for the centroids of Lloyd's algorithm initialised with a
+        random subset.
+    num_iterations : int
+        Number of Lloyd iterations.
+
+    Returns
+    ------
+    torch.Tensor
+        Inducing inputs of shape (num_points, num_dims).
+    """
+    assert strategy in {'random', 'kmeans'}, print(f'Invalid inducing point strategy {strategy}!')
+    num_points = min(num_points, inputs.shape[0])
+    centroids = inputs[torch.randperm(inputs.shape[0])[:num_points]].clone()
+    if strategy == 'random':
+        return centroids
+
+    for _ in range(num_iterations):
+        assignments = squared_distances(inputs, centroids).argmin(dim=-1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, inputs)
+        counts = torch.bincount(assignments, minlength=num_points).unsqueeze(-1)
+        # keep empty clusters at their previous location
+        centroids = torch.where(counts > 0, sums / counts.clamp_min(1), centroids)
+    return centroids
+
+
+class SquaredDifferenceCache:
+    """Caches the pairwise squared differences (x_id - x_jd)^2 of each input dimension d of a shared data matrix. The
+    squared distances over any parent set are then sums of cached slices, such that isotropic kernels over different
+    parent sets and lengthscales do not need to recompute distances. Slices are computed lazily and dropped whenever
+    the data changes. Memory grows with num_dims * num_samples^2, hence the cache is only used up to max_samples.
+    """
+    inputs: Optional[torch.Tensor]
+    sq_diffs: Dict[int, torch.Tensor]
+
+    def __init__(self, max_samples: int):
+        self.max_samples = max_samples
+        self.inputs = None
+        self.version = 0
+        self.sq_diffs = dict()
+
+    def reset(self, inputs: torch.Tensor):
+        self.inputs = inputs if inputs.shape[0] <= self.max_samples else None
+        self.version += 1
+        self.sq_diffs = dict()
+
+    def matches(self, inputs: torch.Tensor) -> bool:
+        if self.inputs is None:
+            return False
+        return inputs is self.inputs or (inputs.shape == self.inputs.shape and torch.equal(inputs, self.inputs))
+
+    def get(self, dim: int) -> torch.Tensor:
+        if dim not in self.sq_diffs:
+            x = self.inputs[:, dim]
+            self.sq_diffs[dim] = (x.unsqueeze(-1) - x.unsqueeze(-2)).pow(2)
+        return self.sq_diffs[dim]
+
+    def squared_distances(self, parent_ids: List[Tuple[int, ...]]) -> torch.Tensor:
+        """Sums the cached slices of the given parent sets.
+
+        Parameters
+        ----------
+        parent_ids : List[Tuple[int, ...]]
+            The parent indices of each mechanism.
+
+        Returns
+        ------
+        torch.Tensor
+            Squared distance matrices of shape (num_mechanisms, num_samples, num_samples).
+        """
+        num_samples = self.inputs.shape[0]
+        sq_dists = self.inputs.new_zeros(len(parent_ids), num_samples, num_samples)
+        for midx, ps in enumerate(parent_ids):
+            for dim in ps:
+                sq_dists[midx] += self.get(dim)
+        return sq_dists
+
+
+class CholeskyCache:
+    """Caches the Cholesky factors of the noisy training covariances K + noise * I of individual mechanisms on a shared
+    data matrix. Each factor is stamped with the hyperparameter version of its mechanism (see `HyperparameterStore`) and
+    is only reused while the version is unchanged. When the data is extended by appended rows, e.g., by a new
+    experiment, the factors stay valid for the leading rows and can be extended with `extend_cholesky`. At most
+    max_entries factors are kept, evicting the least recently used ones.
+
+    For posterior predictions, the solves alpha = (K + noise * I)^-1 (y - mean) can be stored along with the factors.
+    They are stamped with the data version, which changes on every reset.
+    """
+    inputs: Optional[torch.Tensor]
+    entries: OrderedDict
+
+    def __init__(self, max_samples: int, max_entries: int):
+        self.max_samples = max_samples
+        self.max_entries = max_entries
+        self.inputs = None
+        self.data_version = 0
+        self.entries = OrderedDict()
+
+    def reset(self, inputs: torch.Tensor):
+        # keep the factors if the new data only appends rows to the cached data
+        if not self.extends(inputs) or inputs.shape[0] > self.max_samples:
+            self.entries.clear()
+        self.inputs = inputs if inputs.shape[0] <= self.max_samples else None
+        self.data_version += 1
+
+    def extends(self, inputs: torch.Tensor) -> bool:
+        if self.inputs is None or inputs.shape[0] < self.inputs.shape[0] or inputs.shape[1:] != self.inputs.shape[1:]:
+            return False
+        return inputs is self.inputs or torch.equal(inputs[:self.inputs.shape[0]], self.inputs)
+
+    def matches(self, inputs: torch.Tensor) -> bool:
+        if self.inputs is None:
+            return False
+        return inputs is self.inputs or (inputs.shape == self.inputs.shape and torch.equal(inputs, self.inputs))
+
+    def get(self, mechanism_id: int, version: int) -> Optional[torch.Tensor]:
+        """Returns the cached factor of the leading rows of the data (or None), if it is up-to-date with the given
+        hyperparameter version.
+        """
+        entry = self.entries.get(mechanism_id)
+        if entry is None or entry[0] != version:
+            return None
+        self.entries.move_to_end(mechanism_id)
+        return entry[1]
+
+    def get_alpha(self, mechanism_id: int, version: int) -> Optional[torch.Tensor]:
+        entry = self.entries.get(mechanism_id)
+        if entry is None or entry[0] != version or entry[2] is None or entry[2][0] != self.data_version:
+            return None
+        self.entries.move_to_end(mechanism_id)
+        return entry[2][1]
+
+    def put(self, mechanism_id: int, version: int, cholesky_factor: torch.Tensor):
+        self.entries[mechanism_id] = (version, cholesky_factor, None)
+        self.entries.move_to_end(mechanism_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put_alpha(self, mechanism_id: int, version: int, alpha: torch.Tensor):
+        entry = self.entries.get(mechanism_id)
+        if entry is not None and entry[0] == version:
+            self.entries[mechanism_id] = (version, entry[1], (self.data_version, alpha))
+
+    def discard(self, mechanism_ids: List[int]):
+        for mechanism_id in mechanism_ids:
+            self.entries.pop(mechanism_id, None)
+
+
+def split_batches(mechanism_ids: List[int], batch_size: int) -> List[List[int]]:
+    return [mechanism_ids[i:i + batch_size] for i in range(0, len(mechanism_ids), batch_size)]
@@ -0,0 +1,174 @@
+import math
+from typing import Tuple, Union
+
+import torch
+from linear_operator.utils.cholesky import psd_safe_cholesky
+
+# A GP with linear kernel variance * x^T x' and constant mean c is the Bayesian linear regression model
+# y = c + x^T w + eps with w ~ N(0, variance * I) and eps ~ N(0, noise). All functions below parametrise the weight
+# distribution as N(mean, noise * precision^-1), such that they only involve (num_features x num_features) matrices
+# and scale linearly in the number of samples.
+
+
+def blr_prior_precisions(num_features: int, variances: torch.Tensor, noises: torch.Tensor) -> torch.Tensor:
+    """Computes the scaled prior weight precisions (noise / variance) * I.
+
+    Parameters
+    ----------
+    num_features : int
+        Number of regression features (parents).
+    variances, noises : torch.Tensor
+        Kernel variances and noise variances of shape (...).
+
+    Returns
+    ------
+    torch.Tensor
+        Precision matrices of shape (..., num_features, num_features).
+    """
+    scales = (noises / variances).unsqueeze(-1).unsqueeze(-1)
+    return scales * torch.eye(num_features, device=noises.device)
+
+
+def blr_update(x: torch.Tensor, residuals: torch.Tensor,
+               precisions: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Conditions a zero-mean weight distribution with the given scaled precisions on data.
+
+    Parameters
+    ----------
+    x : torch.Tensor
+        Features of shape (..., num_samples, num_features).
+    residuals : torch.Tensor
+        Targets minus the constant mean of shape (..., num_samples).
+    precisions : torch.Tensor
+        Scaled prior precisions of shape (..., num_features, num_features).
+
+    Returns
+    ------
+    Tuple[torch.Tensor, torch.Tensor]
+        The posterior weight means of shape (..., num_features) and the Cholesky factors of the scaled posterior
+        precisions of shape (..., num_features, num_features).
+    """
+    xt = x.transpose(-1, -2)
+    precision_cholesky = psd_safe_cholesky(precisions + xt @ x)
+    means = torch.cholesky_solve(xt @ residuals.unsqueeze(-1), precision_cholesky).squeeze(-1)
+    return means, precision_cholesky
+
+
+def blr_log_likelihood(x: torch.Tensor, residuals: torch.Tensor, noises: torch.Tensor,
+                       precisions: torch.Tensor) -> torch.Tensor:
+    """Computes log N(residuals | 0, noise * (I + x precision^-1 x^T)) via the Woodbury identity and the matrix
+    determinant lemma.
+
+    Parameters
+    ----------
+    x : torch.Tensor
+        Features of shape (..., num_samples, num_features).
+    residuals : torch.Tensor
+        Targets minus the predictive mean of shape (..., num_samples).
+    noises : torch.Tensor
+        Noise variances of shape (...).
+    precisions : torch.Tensor
+        Scaled weight precisions of shape (..., num_features, num_features).
+
+    Returns
+    ------
+    torch.Tensor
+        The log-likelihoods of shape (...).
+    """
+    xt = x.transpose(-1, -2)
+    xtr = (xt @ residuals.unsqueeze(-1)).squeeze(-1)
+    return blr_log_likelihood_from_statistics(xt @ x, xtr, residuals.pow(2).sum(dim=-1), residuals.shape[-1], noises,
+                                              precisions)
+
+
+def blr_log_likelihood_from_statistics(xtx: torch.Tensor, xtr: torch.Tensor, rtr: torch.Tensor,
+                                       num_samples: Union[int, torch.Tensor], noises: torch.Tensor,
+                                       precisions: torch.Tensor) -> torch.Tensor:
+    """Computes the same log-likelihood as `blr_log_likelihood` from the sufficient statistics x^T x, x^T r and r^T r.
+
+    Parameters
+    ----------
+    xtx : torch.Tensor
+        Feature Gram matrices of shape (..., num_features, num_features).
+    xtr : torch.Tensor
+        Feature-residual products of shape (..., num_features).
+    rtr : torch.Tensor
+        Residual sums of squares of shape (...).
+    num_samples : Union[int, torch.Tensor]
+        Number of samples.
+    noises : torch.Tensor
+        Noise variances of shape (...).
+    precisions : torch.Tensor
+        Scaled weight precisions of shape (..., num_features, num_features).
+
+    Returns
+    ------
+    torch.Tensor
+        The log-likelihoods of shape (...).
+    """
+    prior_cholesky = psd_safe_cholesky(precisions)
+    posterior_cholesky = psd_safe_cholesky(precisions + xtx)
+
+    xtr = xtr.unsqueeze(-1)
+    quad_terms = rtr - (xtr * torch.cholesky_solve(xtr, posterior_cholesky)).sum(dim=(-2, -1))
+    log_dets = num_samples * noises.log() + 2. * (posterior_cholesky.diagonal(dim1=-2, dim2=-1).log().sum(dim=-1) -
+                                                  prior_cholesky.diagonal(dim1=-2, dim2=-1).log().sum(dim=-1))
+    return -0.5 * (quad_terms / noises + log_dets + num_samples * math.log(2. * math.pi))
+
+
+def blr_predict(x: torch.Tensor, means: torch.Tensor, precision_cholesky: torch.Tensor, noises: torch.Tensor,
+                mean_only=False):
+    """Computes the predictive distribution of the latent function values x^T w.
+
+    Parameters
+    ----------
+    x : torch.Tensor
+        Features of shape (..., num_samples, num_features).
+    means : torch.Tensor
+        Weight means of shape (num_features,).
+    precision_cholesky : torch.Tensor
+        Cholesky factor of the scaled weight precision of shape (num_features, num_features).
+    noises : torch.Tensor
+        Noise variance of shape ().
+    mean_only : bool
+        Whether to skip computing the predictive covariance.
+
+    Returns
+    ------
+    Tuple[torch.Tensor, Optional[torch.Tensor]]
+        The predictive means of shape (..., num_samples) and covariances of shape (..., num_samples, num_samples) or
+        None if mean_only.
+    """
+    pred_means = x @ means
+    if mean_only:
+        return pred_means, None
+
+    v = torch.linalg.solve_triangular(precision_cholesky, x.transpose(-1, -2), upper=False)
+    return pred_means, noises * v.transpose(-1, -2) @ v
+
+
+def blr_sample(x: torch.Tensor, means: torch.Tensor, precision_cholesky: torch.Tensor,
+               noises: torch.Tensor) -> torch.Tensor:
+    """Samples noisy targets x^T w + eps with one weight sample per batch element.
+
+    Parameters
+    ----------
+    x : torch.Tensor
+        Features of shape (..., num_samples, num_features).
+    means : torch.Tensor
+        Weight means of shape (num_features,).
+    precision_cholesky : torch.Tensor
+        Cholesky factor of the scaled weight precision of shape (num_features, num_features).
+    noises : torch.Tensor
+        Noise variance of shape ().
+
+    Returns
+    ------
+    torch.Tensor
+        Samples of shape (..., num_samples).
+    """
+    eps = torch.randn(*x.shape[:-2], means.shape[-1], 1)
+    weights = means + noises.sqrt() * torch.linalg.solve_triangular(precision_cholesky.transpose(-1, -2), eps,
+                                                                    upper=True).squeeze(-1)
+    latents = (x @ weights.unsqueeze(-1)).squeeze(-1)
+    return latents + noises.sqrt() * torch.randn_like(latents)
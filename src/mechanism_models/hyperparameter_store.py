@@ -0,0 +1,129 @@
+from typing import List, Dict, Any, Optional
+
+import torch
+from torch.nn.functional import softplus
+
+
+def inv_softplus(x: torch.Tensor) -> torch.Tensor:
+    return x + torch.log(-torch.expm1(-x))
+
+
+class HyperparameterStore:
+    """Columnar storage of the hyperparameters of many mechanisms. Each hyperparameter type is stored in one tensor of
+    unconstrained (raw) values, and each mechanism id is mapped to a slot in these tensors. Slots of deleted mechanisms
+    are reused.
+
+    Constrained hyperparameters are obtained via softplus(raw) + lower_bound, as for gpytorch's Positive/GreaterThan
+    constraints, such that raw values are interchangeable with the raw parameters of the corresponding gpytorch modules.
+
+    Each slot carries a version counter that is incremented whenever its values are written, such that quantities
+    derived from the hyperparameters can be cached and validated.
+    """
+    lower_bounds: Dict[str, Optional[float]]
+    raw_values: Dict[str, torch.Tensor]
+    versions: torch.LongTensor
+    id_to_slot: Dict[int, int]
+    free_slots: List[int]
+
+    def __init__(self, lower_bounds: Dict[str, Optional[float]], capacity: int = 64):
+        """
+        Parameters
+        ----------
+        lower_bounds : Dict[str, Optional[float]]
+            Maps each hyperparameter name to its lower bound, or None if the hyperparameter is unconstrained.
+        capacity : int
+            Initial number of slots.
+        """
+        self.lower_bounds = lower_bounds
+        self.capacity = capacity
+        self.raw_values = {name: torch.zeros(capacity) for name in lower_bounds}
+        self.versions = torch.zeros(capacity, dtype=torch.long)
+        self.id_to_slot = {}
+        self.free_slots = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self.id_to_slot)
+
+    def __contains__(self, mechanism_id: int):
+        return mechanism_id in self.id_to_slot
+
+    def mechanism_ids(self) -> List[int]:
+        return list(self.id_to_slot.keys())
+
+    def grow(self, min_capacity: int):
+        new_capacity = max(2 * self.capacity, min_capacity)
+        for name, values in self.raw_values.items():
+            self.raw_values[name] = torch.cat((values, values.new_zeros(new_capacity - self.capacity)))
+        self.versions = torch.cat((self.versions, self.versions.new_zeros(new_capacity - self.capacity)))
+        self.free_slots = list(range(new_capacity - 1, self.capacity - 1, -1)) + self.free_slots
+        self.capacity = new_capacity
+
+    def allocate(self, mechanism_ids: List[int]):
+        new_ids = [mechanism_id for mechanism_id in mechanism_ids if mechanism_id not in self.id_to_slot]
+        if len(new_ids) > len(self.free_slots):
+            self.grow(len(self.id_to_slot) + len(new_ids))
+
+        for mechanism_id in new_ids:
+            self.id_to_slot[mechanism_id] = self.free_slots.pop()
+            self.versions[self.id_to_slot[mechanism_id]] += 1
+
+    def release(self, mechanism_ids: List[int]):
+        for mechanism_id in mechanism_ids:
+            slot = self.id_to_slot.pop(mechanism_id, None)
+            if slot is not None:
+                self.free_slots.append(slot)
+
+    def get_slots(self, mechanism_ids: List[int]) -> torch.LongTensor:
+        return torch.LongTensor([self.id_to_slot[mechanism_id] for mechanism_id in mechanism_ids])
+
+    def transform(self, name: str, raw_values: torch.Tensor) -> torch.Tensor:
+        lower_bound = self.lower_bounds[name]
+        if lower_bound is None:
+            return raw_values
+        return softplus(raw_values) + lower_bound
+
+    def inverse_transform(self, name: str, values: torch.Tensor) -> torch.Tensor:
+        lower_bound = self.lower_bounds[name]
+        if lower_bound is None:
+            return values
+        return inv_softplus(values - lower_bound)
+
+    def gather_raw(self, mechanism_ids: List[int], requires_grad=False) -> Dict[str, torch.Tensor]:
+        """Returns copies of the raw hyperparameters of the given mechanisms. If requires_grad, the copies are leaf
+        tensors that can be optimised and written back with `scatter_raw`.
+        """
+        slots = self.get_slots(mechanism_ids)
+        return {name: values[slots].clone().requires_grad_(requires_grad) for name, values in self.raw_values.items()}
+
+    def scatter_raw(self, mechanism_ids: List[int], raw_values: Dict[str, torch.Tensor]):
+        slots = self.get_slots(mechanism_ids)
+        with torch.no_grad():
+            for name, values in raw_values.items():
+                self.raw_values[name][slots] = values.detach()
+        self.versions[slots] += 1
+
+    def get_versions(self, mechanism_ids: List[int]) -> List[int]:
+        return self.versions[self.get_slots(mechanism_ids)].tolist()
+
+    def get(self, mechanism_ids: List[int], raw_values: Dict[str, torch.Tensor] = None) -> Dict[str, torch.Tensor]:
+        """Returns the constrained hyperparameters of the given mechanisms, either from the store or from the given
+        raw values.
+        """
+        raw_values = self.gather_raw(mechanism_ids) if raw_values is None else raw_values
+        return {name: self.transform(name, values) for name, values in raw_values.items()}
+
+    def set(self, mechanism_ids: List[int], values: Dict[str, torch.Tensor]):
+        raw_values = {name: self.inverse_transform(name, v) for name, v in values.items()}
+        self.scatter_raw(mechanism_ids, raw_values)
+
+    def param_dict(self, mechanism_ids: List[int] = None) -> Dict[str, Any]:
+        mechanism_ids = self.mechanism_ids() if mechanism_ids is None else mechanism_ids
+        slots = self.get_slots(mechanism_ids)
+        params = {'mechanism_ids': mechanism_ids,
+                  'raw_values': {name: values[slots].clone() for name, values in self.raw_values.items()}}
+        return params
+
+    def load_param_dict(self, param_dict):
+        mechanism_ids = param_dict['mechanism_ids']
+        self.allocate(mechanism_ids)
+        self.scatter_raw(mechanism_ids, {name: v.float() for name, v in param_dict['raw_values'].items()})
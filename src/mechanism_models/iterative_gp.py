@@ -0,0 +1,254 @@
+import math
+from typing import Callable, Tuple
+
+import torch
+
+
+def batched_pivoted_cholesky(matrices: torch.Tensor, rank: int) -> torch.Tensor:
+    """Computes low-rank partial pivoted Cholesky factors L with L L^T ~ matrices.
+
+    Parameters
+    ----------
+    matrices : torch.Tensor
+        Positive semi-definite matrices of shape (batch_size, n, n).
+    rank : int
+        Rank of the factors.
+
+    Returns
+    ------
+    torch.Tensor
+        Factors of shape (batch_size, n, rank).
+    """
+    batch_size, n, _ = matrices.shape
+    rank = min(rank, n)
+    batch_idc = torch.arange(batch_size)
+    diags = matrices.diagonal(dim1=-2, dim2=-1).clone()
+    factors = matrices.new_zeros(batch_size, n, rank)
+    for i in range(rank):
+        pivots = diags.argmax(dim=-1)
+        pivot_values = diags[batch_idc, pivots].clamp_min(1e-10).sqrt()
+        pivot_rows = factors[batch_idc, pivots, :i].unsqueeze(-1)
+        columns = matrices[batch_idc, pivots] - (factors[:, :, :i] @ pivot_rows).squeeze(-1)
+        factors[:, :, i] = columns / pivot_values.unsqueeze(-1)
+        diags = (diags - factors[:, :, i].pow(2)).clamp_min(0.)
+    return factors
+
+
+class PivotedCholeskyPreconditioner:
+    """Preconditioner P = L L^T + noise * I for kernel matrices K + noise * I, where L is a low-rank pivoted Cholesky
+    factor of K. Solves and log-determinants use the Woodbury identity and cost O(n r^2).
+    """
+
+    def __init__(self, kernel_covars: torch.Tensor, noises: torch.Tensor, rank: int):
+        """
+        Parameters
+        ----------
+        kernel_covars : torch.Tensor
+            Noise-free kernel matrices of shape (batch_size, n, n).
+        noises : torch.Tensor
+            Noise variances of shape (batch_size,).
+        rank : int
+            Rank of the pivoted Cholesky factors.
+        """
+        self.noises = noises.view(-1, 1, 1)
+        self.factors = batched_pivoted_cholesky(kernel_covars, rank)
+        eye = torch.eye(self.factors.shape[-1], device=kernel_covars.device)
+        self.inner_cholesky = torch.linalg.cholesky(self.noises * eye + self.factors.transpose(-1, -2) @ self.factors)
+
+    def solve(self, rhs: torch.Tensor) -> torch.Tensor:
+        inner_solves = torch.cholesky_solve(self.factors.transpose(-1, -2) @ rhs, self.inner_cholesky)
+        return (rhs - self.factors @ inner_solves) / self.noises
+
+    def logdet(self) -> torch.Tensor:
+        n, rank = self.factors.shape[-2:]
+        noises = self.noises.view(-1)
+        return (n - rank) * noises.log() + 2. * self.inner_cholesky.diagonal(dim1=-2, dim2=-1).log().sum(dim=-1)
+
+    def sample(self, num_samples: int) -> torch.Tensor:
+        # draws samples from N(0, P) of shape (batch_size, n, num_samples)
+        batch_size, n, rank = self.factors.shape
+        return self.factors @ torch.randn(batch_size, rank, num_samples) + \
+            self.noises.sqrt() * torch.randn(batch_size, n, num_samples)
+
+
+def batched_preconditioned_cg(matmul: Callable, rhs: torch.Tensor, precondition: Callable, tolerance: float,
+                              max_iterations: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Solves batches of linear systems A x = b with preconditioned conjugate gradients (all columns at once) and
+    records the coefficients needed to recover the Lanczos tridiagonal matrices.
+
+    Parameters
+    ----------
+    matmul : Callable
+        Computes A @ v for v of shape (batch_size, n, num_rhs).
+    rhs : torch.Tensor
+        Right-hand sides of shape (batch_size, n, num_rhs).
+    precondition : Callable
+        Computes P^-1 @ v.
+    tolerance : float
+        Relative residual norm at which a column is considered converged.
+    max_iterations : int
+        Maximum number of iterations.
+
+    Returns
+    ------
+    Tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+        The solutions of shape (batch_size, n, num_rhs), the step sizes alpha and the conjugation coefficients beta,
+        both of shape (num_iterations, batch_size, num_rhs), where entries of converged columns are zero.
+    """
+    solutions = torch.zeros_like(rhs)
+    residuals = rhs.clone()
+    rhs_norms = rhs.norm(dim=-2).clamp_min(1e-10)
+    z = precondition(residuals)
+    directions = z
+    rz = (residuals * z).sum(dim=-2)
+    active = torch.ones_like(rz, dtype=torch.bool)
+
+    alphas, betas = [], []
+    for _ in range(max_iterations):
+        a_directions = matmul(directions)
+        alpha = torch.where(active, rz / (directions * a_directions).sum(dim=-2).clamp_min(1e-10),
+                            torch.zeros_like(rz))
+        solutions = solutions + alpha.unsqueeze(-2) * directions
+        residuals = residuals - alpha.unsqueeze(-2) * a_directions
+        alphas.append(alpha)
+
+        active = active & (residuals.norm(dim=-2) / rhs_norms > tolerance)
+        if not active.any():
+            betas.append(torch.zeros_like(rz))
+            break
+
+        z = precondition(residuals)
+        rz_new = (residuals * z).sum(dim=-2)
+        beta = torch.where(active, rz_new / rz.clamp_min(1e-10), torch.zeros_like(rz))
+        directions = z + beta.unsqueeze(-2) * directions
+        rz = torch.where(active, rz_new, rz)
+        betas.append(beta)
+
+    return solutions, torch.stack(alphas), torch.stack(betas)
+
+
+def lanczos_quadrature(alphas: torch.Tensor, betas: torch.Tensor) -> torch.Tensor:
+    """Computes e_1^T log(T) e_1 for the Lanczos tridiagonal matrices T recovered from preconditioned CG coefficients.
+
+    Parameters
+    ----------
+    alphas, betas : torch.Tensor
+        CG coefficients of shape (num_iterations, ...) as returned by `batched_preconditioned_cg`.
+
+    Returns
+    ------
+    torch.Tensor
+        The quadrature estimates of shape (...).
+    """
+    # iterations after convergence have alpha = 0 and yield decoupled unit diagonal entries
+    valid = alphas > 0.
+    safe_alphas = torch.where(valid, alphas, torch.ones_like(alphas))
+    prev_terms = torch.cat((torch.zeros_like(alphas[:1]), (betas[:-1] / safe_alphas[:-1])), dim=0)
+    diags = torch.where(valid, 1. / safe_alphas + prev_terms * valid, torch.ones_like(alphas))
+    off_diags = torch.where(valid[1:], betas[:-1].clamp_min(0.).sqrt() / safe_alphas[:-1],
+                            torch.zeros_like(alphas[1:]))
+
+    # build tridiagonal matrices of shape (..., num_iterations, num_iterations)
+    diags, off_diags = diags.movedim(0, -1), off_diags.movedim(0, -1)
+    tridiags = torch.diag_embed(diags) + torch.diag_embed(off_diags, offset=1) + torch.diag_embed(off_diags, offset=-1)
+    eigvals, eigvecs = torch.linalg.eigh(tridiags)
+    return (eigvecs[..., 0, :].pow(2) * eigvals.clamp_min(1e-10).log()).sum(dim=-1)
+
+
+class CGGaussianMLL(torch.autograd.Function):
+    """Marginal log-likelihoods log N(residuals | 0, K + noise * I) of a batch of GPs via preconditioned CG solves and
+    stochastic Lanczos quadrature of the log-determinant. Gradients use the CG solves and the same probe vectors
+    (Hutchinson trace estimator), so no Cholesky decomposition is needed.
+    """
+
+    @staticmethod
+    def forward(ctx, kernel_covars: torch.Tensor, noises: torch.Tensor, residuals: torch.Tensor, tolerance: float,
+                max_iterations: int, num_probes: int, preconditioner_rank: int, seed: int):
+        num_samples = residuals.shape[-1]
+        eye = torch.eye(num_samples, device=kernel_covars.device)
+        covars = kernel_covars + noises.view(-1, 1, 1) * eye
+        preconditioner = PivotedCholeskyPreconditioner(kernel_covars, noises, preconditioner_rank)
+
+        # probe vectors z ~ N(0, P), fixed by the seed
+        with torch.random.fork_rng():
+            torch.manual_seed(seed)
+            probes = preconditioner.sample(num_probes)
+
+        rhs = torch.cat((residuals.unsqueeze(-1), probes), dim=-1)
+        solves, alphas, betas = batched_preconditioned_cg(lambda v: covars @ v, rhs, preconditioner.solve, tolerance,
+                                                          max_iterations)
+        target_solves, probe_solves = solves[..., 0], solves[..., 1:]
+
+        # stochastic Lanczos quadrature of logdet(P^-1 A) plus the exact logdet(P)
+        preconditioned_probes = preconditioner.solve(probes)
+        probe_norms = (probes * preconditioned_probes).sum(dim=-2)
+        quadratures = lanczos_quadrature(alphas[..., 1:], betas[..., 1:])
+        log_dets = preconditioner.logdet() + (probe_norms * quadratures).mean(dim=-1)
+
+        quad_terms = (residuals * target_solves).sum(dim=-1)
+        ctx.save_for_backward(target_solves, probe_solves, preconditioned_probes)
+        return -0.5 * (quad_terms + log_dets + num_samples * math.log(2. * math.pi))
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        target_solves, probe_solves, preconditioned_probes = ctx.saved_tensors
+        num_probes = probe_solves.shape[-1]
+
+        # d mll / d A = 0.5 * (A^-1 r r^T A^-1 - A^-1), with tr(A^-1 dA) ~ mean_i (A^-1 z_i)^T dA (P^-1 z_i)
+        grad_covars = target_solves.unsqueeze(-1) * target_solves.unsqueeze(-2) - \
+            probe_solves @ preconditioned_probes.transpose(-1, -2) / num_probes
+        grad_covars = 0.25 * (grad_covars + grad_covars.transpose(-1, -2)) * grad_output.view(-1, 1, 1)
+        grad_noises = grad_covars.diagonal(dim1=-2, dim2=-1).sum(dim=-1)
+        grad_residuals = -target_solves * grad_output.unsqueeze(-1)
+        return grad_covars, grad_noises, grad_residuals, None, None, None, None, None
+
+
+def batched_cg_gaussian_mll(kernel_covars: torch.Tensor, noises: torch.Tensor, targets: torch.Tensor,
+                            means: torch.Tensor = None, tolerance: float = 1e-2, max_iterations: int = 100,
+                            num_probes: int = 10, preconditioner_rank: int = 5, seed: int = 0) -> torch.Tensor:
+    """Computes the same marginal log-likelihoods as `batched_gaussian_mll` with iterative solvers, see
+    `CGGaussianMLL`.
+
+    Parameters
+    ----------
+    kernel_covars : torch.Tensor
+        Kernel matrices of shape (num_mechanisms, num_samples, num_samples).
+    noises : torch.Tensor
+        Noise variances of shape (num_mechanisms,).
+    targets : torch.Tensor
+        Targets of shape (num_samples,).
+    means : torch.Tensor
+        Optional constant means of shape (num_mechanisms,). Zero mean if None.
+    tolerance : float
+        Relative residual tolerance of CG.
+    max_iterations : int
+        Maximum number of CG/Lanczos iterations.
+    num_probes : int
+        Number of probe vectors for the stochastic trace and log-determinant estimates.
+    preconditioner_rank : int
+        Rank of the pivoted Cholesky preconditioner.
+    seed : int
+        Seed of the probe vectors.
+
+    Returns
+    ------
+    torch.Tensor
+        The marginal log-likelihoods of shape (num_mechanisms,).
+    """
+    residuals = targets.unsqueeze(0).expand(kernel_covars.shape[0], -1)
+    if means is not None:
+        residuals = residuals - means.unsqueeze(-1)
+    return CGGaussianMLL.apply(kernel_covars, noises, residuals, tolerance, max_iterations, num_probes,
+                               preconditioner_rank, seed)
+
+
+def cg_solve(kernel_covar: torch.Tensor, noise: torch.Tensor, rhs: torch.Tensor, tolerance: float = 1e-2,
+             max_iterations: int = 100, preconditioner_rank: int = 5) -> torch.Tensor:
+    """Solves (K + noise * I) x = rhs for a single kernel matrix of shape (n, n) and right-hand sides of shape
+    (n, num_rhs) with preconditioned CG.
+    """
+    covar = kernel_covar + noise * torch.eye(kernel_covar.shape[-1], device=kernel_covar.device)
+    preconditioner = PivotedCholeskyPreconditioner(kernel_covar.unsqueeze(0), noise.view(1), preconditioner_rank)
+    solves, _, _ = batched_preconditioned_cg(lambda v: covar @ v, rhs.unsqueeze(0), preconditioner.solve, tolerance,
+                                             max_iterations)
+    return solves.squeeze(0)
@@ -1,15 +1,23 @@
 import math
-from itertools import chain
-from typing import List, Tuple, Dict, Any
+from functools import lru_cache
+from typing import List, Tuple, Dict, Any, Optional
 
 import gpytorch
 import torch
 import torch.distributions as dist
-from torch.nn import Module, ModuleDict
-from torch.nn.utils import vector_to_parameters
+from torch.nn import Module
 
-from src.config import GaussianRootNodeConfig, GaussianProcessConfig, AdditiveSigmoidsConfig, use_gpu
-from src.utils.utils import get_module_params
+from linear_operator.utils.cholesky import psd_safe_cholesky
+
+from src.config import GaussianRootNodeConfig, GaussianProcessConfig, AdditiveSigmoidsConfig, GPModelConfig
+from src.mechanism_models.batched_gp import get_parent_index_matrix, gather_parent_inputs, expand_hyperparameter, \
+    rq_kernel, rq_kernel_from_sq_dists, rq_fourier_features, linear_kernel, batched_gaussian_mll, batched_sgpr_mll, \
+    cholesky_gaussian_mll, extend_cholesky, sgpr_factors, select_inducing_points, SquaredDifferenceCache, CholeskyCache
+from src.mechanism_models.bayesian_linear_regression import blr_prior_precisions, blr_update, blr_log_likelihood, \
+    blr_log_likelihood_from_statistics, blr_predict, blr_sample
+from src.mechanism_models.hyperparameter_store import HyperparameterStore
+from src.mechanism_models.iterative_gp import batched_cg_gaussian_mll, cg_solve
+from src.mechanism_models.sufficient_statistics import compute_moments, merge_moments, NodeStatistics
 
 
 def get_mechanism_key(node, parents: List) -> str:
@@ -26,6 +34,51 @@ def resolve_mechanism_key(key: str) -> Tuple[str, List[str]]:
     return node, parents
 
 
+# mechanism ids pack the target node index into the lower bits and the parent bitmask into the upper bits, the ids are
+# python ints without size limit but fit into int64 tensors only for graphs with up to MECHANISM_ID_MAX_INT64_NODES
+MECHANISM_ID_NODE_BITS = 8
+MECHANISM_ID_MAX_NODES = 1 << MECHANISM_ID_NODE_BITS
+MECHANISM_ID_MAX_INT64_NODES = 63 - MECHANISM_ID_NODE_BITS
+
+
+def get_mechanism_id(node_id: int, parent_ids: List[int]) -> int:
+    parent_mask = 0
+    for parent_id in parent_ids:
+        parent_mask |= 1 << parent_id
+    return (parent_mask << MECHANISM_ID_NODE_BITS) | node_id
+
+
+def get_mechanism_ids(node_ids: torch.LongTensor, parent_masks: torch.LongTensor) -> torch.LongTensor:
+    # vectorised version of get_mechanism_id for parent sets given as int64 bitmasks
+    return (parent_masks << MECHANISM_ID_NODE_BITS) | node_ids
+
+
+@lru_cache(maxsize=2 ** 16)
+def resolve_mechanism_id(mechanism_id: int) -> Tuple[int, Tuple[int, ...]]:
+    node_id = mechanism_id & ((1 << MECHANISM_ID_NODE_BITS) - 1)
+    parent_mask = mechanism_id >> MECHANISM_ID_NODE_BITS
+    parent_ids = tuple(i for i in range(parent_mask.bit_length()) if (parent_mask >> i) & 1)
+    return node_id, parent_ids
+
+
+def is_root_mechanism(mechanism_id: int) -> bool:
+    return mechanism_id >> MECHANISM_ID_NODE_BITS == 0
+
+
+def mechanism_id_to_key(mechanism_id: int, node_labels: List[str]) -> str:
+    node_id, parent_ids = resolve_mechanism_id(mechanism_id)
+    return get_mechanism_key(node_labels[node_id], [node_labels[i] for i in parent_ids])
+
+
+def mechanism_key_to_id(key: str, node_to_dim_map: Dict[str, int]) -> int:
+    node, parents = resolve_mechanism_key(key)
+    return get_mechanism_id(node_to_dim_map[node], [node_to_dim_map[parent] for parent in parents])
+
+
+def get_node_labels(node_to_dim_map: Dict[str, int]) -> List[str]:
+    return sorted(node_to_dim_map.keys(), key=node_to_dim_map.get)
+
+
 class Mechanism(Module):
     """
     Class that represents a generic mechanism including a likelihood/noise model in an SCM.
@@ -97,6 +150,7 @@ class Mechanism(Module):
 class GaussianRootNode(Mechanism):
     def __init__(self, static=False, cfg: GaussianRootNodeConfig = None, param_dict: Dict[str, Any] = None):
         super().__init__(in_size=0)
+        self.train_moments = None
         if param_dict is not None:
             self.load_param_dict(param_dict)
         else:
@@ -107,7 +161,6 @@ class GaussianRootNode(Mechanism):
             self.alpha_0 = self.alpha_n = torch.tensor(self.cfg.alpha_0)
             self.beta_0 = self.beta_n = torch.tensor(self.cfg.beta_0)
             self.lam_0 = None
-            self.train_targets = None
 
             self.static = static
             if static:
@@ -116,20 +169,22 @@ class GaussianRootNode(Mechanism):
     def compute_posterior_params(self, targets: torch.Tensor, prior_mode=False):
         self._check_args(targets=targets)
 
-        full_targets = targets
-        if not prior_mode and self.train_targets is not None:
-            full_targets = torch.cat((targets, self.train_targets.expand(*targets.shape[:-1], -1)), dim=-1)
+        # merge the moments of the targets with those of the training data instead of concatenating the samples
+        moments = compute_moments(targets)
+        if not prior_mode and self.train_moments is not None:
+            moments = merge_moments(*moments, *self.train_moments)
 
-        n = full_targets.shape[-1]
-        empirical_means = full_targets.mean(dim=-1)
+        return self.posterior_params_from_moments(*moments)
 
+    def posterior_params_from_moments(self, n: torch.Tensor, empirical_means: torch.Tensor, sq_devs: torch.Tensor):
+        # computes the posterior params given the number of samples, their mean and sum of squared deviations
+        n, empirical_means, sq_devs = n.float(), empirical_means.float(), sq_devs.float()
         kappa_n = self.kappa_0 + n
         mu_n = (self.kappa_0 * self.mu_0 + n * empirical_means) / kappa_n
         alpha_n = self.alpha_0 + 0.5 * n
-        beta_n = self.beta_0 + 0.5 * (full_targets - empirical_means.unsqueeze(-1)).pow_(2).sum(dim=-1) + \
-                 0.5 * self.kappa_0 * n * (empirical_means - self.mu_0).pow_(2) / kappa_n
+        beta_n = self.beta_0 + 0.5 * sq_devs + 0.5 * self.kappa_0 * n * (empirical_means - self.mu_0).pow(2) / kappa_n
 
-        return mu_n, kappa_n.expand(mu_n.shape), alpha_n.expand(mu_n.shape), beta_n
+        return mu_n, kappa_n.expand(mu_n.shape), alpha_n.expand(mu_n.shape), beta_n.expand(mu_n.shape)
 
     def init_as_static(self):
         self.lam_0 = dist.Gamma(self.alpha_0, self.beta_0).sample()
@@ -138,8 +193,22 @@ class GaussianRootNode(Mechanism):
     def set_data(self, inputs: torch.Tensor, targets: torch.Tensor):
         self._check_args(targets=targets)
         assert targets.dim() == 1, print('Can only work with one set of posterior params!')
-        self.train_targets = targets
-        self.mu_n, self.kappa_n, self.alpha_n, self.beta_n = self.compute_posterior_params(targets, prior_mode=True)
+        self.set_moments(*compute_moments(targets))
+
+    def set_moments(self, n: torch.Tensor, empirical_means: torch.Tensor, sq_devs: torch.Tensor):
+        # sets the training data via its number of samples, mean and sum of squared deviations
+        self.train_moments = (n, empirical_means, sq_devs)
+        self.mu_n, self.kappa_n, self.alpha_n, self.beta_n = self.posterior_params_from_moments(*self.train_moments)
+
+    def prior_mll_from_moments(self, n: torch.Tensor, empirical_means: torch.Tensor, sq_devs: torch.Tensor):
+        # prior-mode marginal log-likelihood of a sample set given its moments, constant in the number of samples
+        _, kappa_m, alpha_m, beta_m = self.posterior_params_from_moments(n, empirical_means, sq_devs)
+        return self.log_evidence_ratio(n.float(), self.kappa_0, self.alpha_0, self.beta_0, kappa_m, alpha_m, beta_m)
+
+    @staticmethod
+    def log_evidence_ratio(num_samples, kappa_n, alpha_n, beta_n, kappa_m, alpha_m, beta_m):
+        return torch.lgamma(alpha_m) - torch.lgamma(alpha_n) + alpha_n * beta_n.log() - alpha_m * beta_m.log() + \
+               0.5 * (kappa_n.log() - kappa_m.log()) - 0.5 * num_samples * math.log(2. * math.pi)
 
     def forward(self, inputs: torch.Tensor, prior_mode=False):
         assert inputs.dim() >= 2
@@ -186,8 +255,7 @@ class GaussianRootNode(Mechanism):
                 kappa_n, alpha_n, beta_n = (self.kappa_n, self.alpha_n, self.beta_n)
 
             _, kappa_m, alpha_m, beta_m = self.compute_posterior_params(targets, prior_mode)
-            lls = torch.lgamma(alpha_m) - torch.lgamma(alpha_n) + alpha_n * beta_n.log() - alpha_m * beta_m.log() + \
-                  0.5 * (kappa_n.log() - kappa_m.log()) - 0.5 * targets.shape[-1] * math.log(2. * math.pi)
+            lls = self.log_evidence_ratio(targets.shape[-1], kappa_n, alpha_n, beta_n, kappa_m, alpha_m, beta_m)
 
         assert lls.shape == output_shape, print(lls.shape)
         if reduce:
@@ -253,6 +321,7 @@ class GaussianProcess(Mechanism):
             super().__init__(None, None, likelihood)
             self.mean_module = gpytorch.means.ZeroMean()
             self.covar_module = gpytorch.kernels.ScaleKernel(gpytorch.kernels.RQKernel())
+            self.inducing_covar_module = None
 
             # init hp priors
             # ATTENTION: do not name the HP priors "noise_prior", "outputscale_prior" or "lengthscale_prior"
@@ -272,9 +341,17 @@ class GaussianProcess(Mechanism):
 
         def forward(self, x):
             mean = self.mean_module(x)
-            covar = self.covar_module(x)
+            covar = self.covar_module(x) if self.inducing_covar_module is None else self.inducing_covar_module(x)
             return gpytorch.distributions.MultivariateNormal(mean, covar)
 
+        def set_inducing_points(self, inducing_points: Optional[torch.Tensor]):
+            # SGPR approximation of the RQ kernel with fixed inducing points
+            self.inducing_covar_module = None
+            if inducing_points is not None:
+                self.inducing_covar_module = gpytorch.kernels.InducingPointKernel(self.covar_module, inducing_points,
+                                                                                  self.likelihood)
+                self.inducing_covar_module.inducing_points.requires_grad_(False)
+
         def hyperparam_log_prior(self):
             log_prior = self.noise_var_prior.log_prob(self.likelihood.noise) + \
                         self.outscale_prior.log_prob(self.covar_module.outputscale) + \
@@ -412,8 +489,9 @@ class GaussianProcess(Mechanism):
     # Main-class functions
     ##########################################################################
     def __init__(self, in_size: int, static=False, linear=False, cfg: GaussianProcessConfig = None,
-                 param_dict: Dict[str, Any] = None):
+                 param_dict: Dict[str, Any] = None, model_cfg: GPModelConfig = None):
         super().__init__(in_size)
+        self.model_cfg = GPModelConfig() if model_cfg is None else model_cfg
         if param_dict is not None:
             self.load_param_dict(param_dict)
         else:
@@ -449,24 +527,35 @@ class GaussianProcess(Mechanism):
         self._check_args(inputs, targets)
         self.gp.set_train_data(inputs, targets, strict=False)
 
-    def forward(self, inputs: torch.Tensor, prior_mode=False):
+        # choose inducing points for the sparse approximation, linear GPs are not approximated
+        if self.model_cfg.approximation == 'sparse' and not self.linear and not self.static:
+            inducing_points = None
+            if inputs.shape[0] > self.model_cfg.num_inducing_points:
+                inducing_points = select_inducing_points(inputs, self.model_cfg.num_inducing_points,
+                                                         self.model_cfg.inducing_point_strategy)
+            self.gp.set_inducing_points(inducing_points)
+
+    def predict(self, inputs: torch.Tensor, prior_mode=False, return_samples=False):
+        # predictive means and optionally samples from a single posterior evaluation, the posterior variances are
+        # skipped if only the means are needed
         self._check_args(inputs)
         output_shape = (*inputs.shape[:-1], 1)
 
         self.eval()
-        with gpytorch.settings.prior_mode(prior_mode):
+        skip_variances = not return_samples or self.static
+        with gpytorch.settings.prior_mode(prior_mode), gpytorch.settings.skip_posterior_variances(skip_variances):
             f_dist = self.gp(inputs)
-        return f_dist.mean.view(output_shape)
+        if not return_samples:
+            return f_dist.mean.view(output_shape), None
 
-    def sample(self, inputs: torch.Tensor, prior_mode=False):
-        self._check_args(inputs)
-        output_shape = (*inputs.shape[:-1], 1)
-
-        self.eval()
-        with gpytorch.settings.prior_mode(prior_mode):
-            f_dist = self.gp(inputs)
         y_dist = self.gp.likelihood(f_dist.mean) if self.static else self.gp.likelihood(f_dist)
-        return y_dist.sample().view(output_shape)
+        return f_dist.mean.view(output_shape), y_dist.sample().view(output_shape)
+
+    def forward(self, inputs: torch.Tensor, prior_mode=False):
+        return self.predict(inputs, prior_mode)[0]
+
+    def sample(self, inputs: torch.Tensor, prior_mode=False):
+        return self.predict(inputs, prior_mode, return_samples=True)[1]
 
     def mll(self, inputs: torch.Tensor, targets: torch.Tensor, prior_mode=False, reduce=True):
         self._check_args(inputs, targets)
@@ -528,241 +617,269 @@ class GaussianProcess(Mechanism):
 
 class SharedDataGaussianProcess(Mechanism):
     ##########################################################################
-    # Shared-data GP Linear Kernel Model
+    # Shared-data GP base model
     ##########################################################################
-    class SharedDataGPLinearKernel(gpytorch.models.ExactGP):
+    class SharedDataGPBase:
+        # lower bounds of the constrained hyperparameters (None if unconstrained)
+        hyperparameter_bounds: Dict[str, Optional[float]] = {}
+        # whether the kernel can be computed from cached squared distances
+        supports_sq_dists = False
+
         def __init__(self, cfg: GaussianProcessConfig, node_to_dim_map: Dict[str, int] = None,
                      param_dict: Dict[str, Any] = None):
             assert node_to_dim_map is not None or param_dict is not None
-            likelihood = gpytorch.likelihoods.GaussianLikelihood()
-            super().__init__(None, None, likelihood)
             self.cfg = cfg
+            self.init_priors()
 
             if param_dict is not None:
                 self.load_param_dict(param_dict)
             else:
                 self.node_to_dim_map = node_to_dim_map
-                self.means = ModuleDict()
-                self.likelihoods = ModuleDict()
-                self.kernels = ModuleDict()
-
-            # init hp priors
-            # ATTENTION: do not name the HP priors "noise_prior", "outputscale_prior"
-            self.noise_var_prior = dist.Gamma(cfg.noise_var_concentration, cfg.noise_var_rate)
-            self.outscale_prior = dist.Gamma(cfg.outscale_concentration, cfg.outscale_rate)
-            self.offset_prior = dist.Normal(cfg.offset_loc, cfg.offset_scale)
-
-        def init_kernel(self, key: str):
-            likelihood = gpytorch.likelihoods.GaussianLikelihood()
-            likelihood.eval()
-            self.likelihoods[key] = likelihood
+                self.store = HyperparameterStore(self.hyperparameter_bounds)
 
-            _, parents = resolve_mechanism_key(key)
-            active_dims = torch.LongTensor([self.node_to_dim_map[node] for node in parents])
-            kernel = gpytorch.kernels.LinearKernel(active_dims=active_dims)
-            kernel.eval()
-            self.kernels[key] = kernel
+        def init_priors(self):
+            raise NotImplementedError
 
-            mean = gpytorch.means.ConstantMean()
-            mean.eval()
-            self.means[key] = mean
+        def init_kernels(self, mechanism_ids: List[int]):
+            self.store.allocate(mechanism_ids)
 
-            if use_gpu and torch.cuda.is_available():
-                self.kernels[key].cuda(torch.device('cuda'))
-                self.likelihoods[key].cuda(torch.device('cuda'))
-                self.means[key].cuda(torch.device('cuda'))
+        def delete_kernels(self, mechanism_ids: List[int]):
+            self.store.release(mechanism_ids)
 
-        def delete_kernel(self, key: str):
-            self.likelihoods.pop(key)
-            self.kernels.pop(key)
-            self.means.pop(key)
+        def init_hyperparams(self, mechanism_ids: List[int]):
+            raise NotImplementedError
 
-        def delete_kernels(self, keys: List[str]):
-            likelihoods = {key: lhd for key, lhd in self.likelihoods.items() if key not in keys}
-            self.likelihoods = ModuleDict(likelihoods)
+        def hyperparam_log_priors(self, mechanism_ids: List[int], raw_values: Dict[str, torch.Tensor] = None):
+            raise NotImplementedError
 
-            kernels = {key: kernel for key, kernel in self.kernels.items() if key not in keys}
-            self.kernels = ModuleDict(kernels)
+        def mean(self, hyperparams: Dict[str, torch.Tensor]) -> Optional[torch.Tensor]:
+            raise NotImplementedError
 
-            means = {key: mean for key, mean in self.means.items() if key not in keys}
-            self.means = ModuleDict(means)
-
-        def init_hyperparams(self, key: str):
-            noise_var = self.noise_var_prior.sample()
-            self.likelihoods[key].noise = noise_var if noise_var > 1e-3 else torch.tensor(1e-3)
-            self.kernels[key].variance = self.outscale_prior.sample()
-            self.means[key].constant = self.offset_prior.sample()
+        def kernel(self, x1: torch.Tensor, x2: Optional[torch.Tensor], hyperparams: Dict[str, torch.Tensor]):
+            raise NotImplementedError
 
-        def forward(self, x, key: str):
-            mean = self.means[key](x)
-            covar = self.kernels[key](x)
-            return gpytorch.distributions.MultivariateNormal(mean, covar)
+        def kernel_from_sq_dists(self, sq_dists: torch.Tensor, hyperparams: Dict[str, torch.Tensor]):
+            raise NotImplementedError
 
-        def hyperparam_log_prior(self, key: str):
-            log_prior = self.noise_var_prior.log_prob(self.likelihoods[key].noise) + \
-                        self.outscale_prior.log_prob(self.kernels[key].variance) + \
-                        self.offset_prior.log_prob(self.means[key].constant)
-            return log_prior.squeeze()
+        def batched_prior_mll(self, inputs: torch.Tensor, targets: torch.Tensor, mechanism_ids: List[int],
+                              raw_values: Dict[str, torch.Tensor] = None,
+                              sq_diff_cache: SquaredDifferenceCache = None, cg_settings: Dict[str, Any] = None):
+            hyperparams = self.store.get(mechanism_ids, raw_values)
+            parent_ids = [resolve_mechanism_id(mechanism_id)[1] for mechanism_id in mechanism_ids]
+            if sq_diff_cache is not None and self.supports_sq_dists:
+                covars = self.kernel_from_sq_dists(sq_diff_cache.squared_distances(parent_ids), hyperparams)
+            else:
+                parent_inputs = gather_parent_inputs(inputs, get_parent_index_matrix(parent_ids, inputs.shape[-1]))
+                covars = self.kernel(parent_inputs, None, hyperparams)
+            if cg_settings is not None:
+                return batched_cg_gaussian_mll(covars, hyperparams['noise'], targets, self.mean(hyperparams),
+                                               **cg_settings)
+            return batched_gaussian_mll(covars, hyperparams['noise'], targets, self.mean(hyperparams))
+
+        def batched_sparse_prior_mll(self, inputs: torch.Tensor, targets: torch.Tensor, mechanism_ids: List[int],
+                                     inducing_inputs: torch.Tensor, raw_values: Dict[str, torch.Tensor] = None):
+            hyperparams = self.store.get(mechanism_ids, raw_values)
+            parent_ids = [resolve_mechanism_id(mechanism_id)[1] for mechanism_id in mechanism_ids]
+            parent_idc = get_parent_index_matrix(parent_ids, inputs.shape[-1])
+            parent_inputs = gather_parent_inputs(inputs, parent_idc)
+            parent_inducing_inputs = gather_parent_inputs(inducing_inputs, parent_idc)
+            kmns = self.kernel(parent_inducing_inputs, parent_inputs, hyperparams)
+            kmms = self.kernel(parent_inducing_inputs, None, hyperparams)
+            knn_diags = self.kernel_diag(parent_inputs, hyperparams)
+            return batched_sgpr_mll(knn_diags, kmns, kmms, hyperparams['noise'], targets, self.mean(hyperparams))
+
+        def kernel_diag(self, x: torch.Tensor, hyperparams: Dict[str, torch.Tensor]) -> torch.Tensor:
+            raise NotImplementedError
+
+        def legacy_raw_values(self, param_dict: Dict[str, Any], key: str) -> Dict[str, torch.Tensor]:
+            raise NotImplementedError
 
         def param_dict(self) -> Dict[str, Any]:
             # ATTENTION: does not store the training data!
-            likelihood_param_dict = {k: get_module_params(m) for k, m in self.likelihoods.items()}
-            kernel_param_dict = {k: get_module_params(m) for k, m in self.kernels.items()}
-            mean_param_dict = {k: get_module_params(m) for k, m in self.means.items()}
-
+            node_labels = get_node_labels(self.node_to_dim_map)
+            store_param_dict = self.store.param_dict()
             params = {'node_to_dim_map': self.node_to_dim_map,
-                      'likelihood_param_dict': likelihood_param_dict,
-                      'kernel_param_dict': kernel_param_dict,
-                      'mean_param_dict': mean_param_dict}
+                      'mechanism_keys': [mechanism_id_to_key(mechanism_id, node_labels) for mechanism_id in
+                                         store_param_dict['mechanism_ids']],
+                      'raw_hyperparameters': store_param_dict['raw_values']}
             return params
 
         def load_param_dict(self, param_dict):
             # ATTENTION: does not load the training data!
-            self.means = ModuleDict()
-            self.likelihoods = ModuleDict()
-            self.kernels = ModuleDict()
-
             self.node_to_dim_map = param_dict['node_to_dim_map']
-            for key in param_dict['likelihood_param_dict']:
-                self.init_kernel(key)
-                likelihood_param_vec = param_dict['likelihood_param_dict'][key].float()
-                kernel_param_vec = param_dict['kernel_param_dict'][key].float()
-                mean_param_vec = param_dict['mean_param_dict'][key].float()
-                if use_gpu and torch.cuda.is_available():
-                    likelihood_param_vec.cuda(torch.device('cuda'))
-                    kernel_param_vec.cuda(torch.device('cuda'))
-                    mean_param_vec.cuda(torch.device('cuda'))
-
-                vector_to_parameters(likelihood_param_vec, self.likelihoods[key].parameters())
-                vector_to_parameters(kernel_param_vec, self.kernels[key].parameters())
-                vector_to_parameters(mean_param_vec, self.means[key].parameters())
-
-        def get_parameters(self, keys: List[str] = None):
-            if keys is None:
-                return self.parameters()
-            else:
-                mean_params = [self.means[key].parameters() for key in keys if key in self.means]
-                kernel_params = [self.kernels[key].parameters() for key in keys if key in self.kernels]
-                likelihood_params = [self.likelihoods[key].parameters() for key in keys if key in self.likelihoods]
-                return chain(*mean_params, *kernel_params, *likelihood_params)
-
-    ##########################################################################
-    # Shared-data GP  RQ-Kernel Model
-    ##########################################################################
-    class SharedDataGPRQKernel(gpytorch.models.ExactGP):
-        def __init__(self, cfg: GaussianProcessConfig, node_to_dim_map: Dict[str, int] = None,
-                     param_dict: Dict[str, Any] = None):
-            assert node_to_dim_map is not None or param_dict is not None
-            likelihood = gpytorch.likelihoods.GaussianLikelihood()
-            super().__init__(None, None, likelihood)
-            self.cfg = cfg
-            self.mean_module = gpytorch.means.ZeroMean()
+            self.store = HyperparameterStore(self.hyperparameter_bounds)
 
-            if param_dict is not None:
-                self.load_param_dict(param_dict)
+            if 'raw_hyperparameters' in param_dict:
+                keys = param_dict['mechanism_keys']
+                raw_values = param_dict['raw_hyperparameters']
             else:
-                self.node_to_dim_map = node_to_dim_map
-                self.likelihoods = ModuleDict()
-                self.kernels = ModuleDict()
-                self.lscale_priors: Dict[str, dist.Gamma] = {}
-
-            # init hp priors
-            # ATTENTION: do not name the HP priors "noise_prior", "outputscale_prior" or "lengthscale_prior"
-            self.noise_var_prior = dist.Gamma(cfg.noise_var_concentration, cfg.noise_var_rate)
-            self.outscale_prior = dist.Gamma(cfg.outscale_concentration, cfg.outscale_rate)
-            self.scale_mix_prior = dist.Gamma(cfg.scale_mix_concentration, cfg.scale_mix_rate)
-
-        def init_kernel(self, key: str):
-            likelihood = gpytorch.likelihoods.GaussianLikelihood()
-            likelihood.eval()
-            self.likelihoods[key] = likelihood
-
-            _, parents = resolve_mechanism_key(key)
-            active_dims = torch.LongTensor([self.node_to_dim_map[node] for node in parents])
-            kernel = gpytorch.kernels.ScaleKernel(gpytorch.kernels.RQKernel(active_dims=active_dims))
-            kernel.eval()
-            self.kernels[key] = kernel
-
-            self.lscale_priors[key] = dist.Gamma(self.cfg.lscale_concentration_multiplier * len(parents),
-                                                 self.cfg.lscale_rate)
+                # convert checkpoints that stored one set of gpytorch module parameters per mechanism
+                keys = list(param_dict['likelihood_param_dict'].keys())
+                legacy_values = [self.legacy_raw_values(param_dict, key) for key in keys]
+                raw_values = {name: torch.stack([v[name] for v in legacy_values]) if keys else torch.zeros(0) for
+                              name in self.hyperparameter_bounds}
 
-            if use_gpu and torch.cuda.is_available():
-                self.kernels[key].cuda(torch.device('cuda'))
-                self.likelihoods[key].cuda(torch.device('cuda'))
+            mechanism_ids = [mechanism_key_to_id(key, self.node_to_dim_map) for key in keys]
+            self.store.load_param_dict({'mechanism_ids': mechanism_ids, 'raw_values': raw_values})
 
-        def delete_kernel(self, key: str):
-            self.likelihoods.pop(key)
-            self.kernels.pop(key)
-
-        def delete_kernels(self, keys: List[str]):
-            likelihoods = {key: lhd for key, lhd in self.likelihoods.items() if key not in keys}
-            self.likelihoods = ModuleDict(likelihoods)
-
-            kernels = {key: kernel for key, kernel in self.kernels.items() if key not in keys}
-            self.kernels = ModuleDict(kernels)
-
-        def init_hyperparams(self, key: str):
-            noise_var = self.noise_var_prior.sample()
-            self.likelihoods[key].noise = noise_var if noise_var > 1e-3 else torch.tensor(1e-3)
-            self.kernels[key].outputscale = self.outscale_prior.sample()
-            self.kernels[key].base_kernel.lengthscale = self.lscale_priors[key].sample()
-            self.kernels[key].base_kernel.alpha = self.scale_mix_prior.sample()
-
-        def forward(self, x, key: str):
-            mean = self.mean_module(x)
-            covar = self.kernels[key](x)
-            return gpytorch.distributions.MultivariateNormal(mean, covar)
-
-        def hyperparam_log_prior(self, key: str):
-            log_prior = self.noise_var_prior.log_prob(self.likelihoods[key].noise) + \
-                        self.outscale_prior.log_prob(self.kernels[key].outputscale) + \
-                        self.lscale_priors[key].log_prob(self.kernels[key].base_kernel.lengthscale) + \
-                        self.scale_mix_prior.log_prob(self.kernels[key].base_kernel.alpha)
-            return log_prior.squeeze()
-
-        def param_dict(self) -> Dict[str, Any]:
-            # ATTENTION: does not store the training data!
-            likelihood_param_dict = {k: get_module_params(m) for k, m in self.likelihoods.items()}
-            kernel_param_dict = {k: get_module_params(m) for k, m in self.kernels.items()}
+    ##########################################################################
+    # Shared-data GP Linear Kernel Model
+    ##########################################################################
+    class SharedDataGPLinearKernel(SharedDataGPBase):
+        hyperparameter_bounds = {'noise': 1e-4, 'variance': 0., 'constant': None}
 
-            params = {'node_to_dim_map': self.node_to_dim_map,
-                      'likelihood_param_dict': likelihood_param_dict,
-                      'kernel_param_dict': kernel_param_dict}
-            return params
+        def init_priors(self):
+            self.noise_var_prior = dist.Gamma(self.cfg.noise_var_concentration, self.cfg.noise_var_rate)
+            self.outscale_prior = dist.Gamma(self.cfg.outscale_concentration, self.cfg.outscale_rate)
+            self.offset_prior = dist.Normal(self.cfg.offset_loc, self.cfg.offset_scale)
+
+        def init_hyperparams(self, mechanism_ids: List[int]):
+            sample_shape = torch.Size((len(mechanism_ids),))
+            hyperparams = {'noise': self.noise_var_prior.sample(sample_shape).clamp_min(1e-3),
+                           'variance': self.outscale_prior.sample(sample_shape),
+                           'constant': self.offset_prior.sample(sample_shape)}
+            self.store.set(mechanism_ids, hyperparams)
+
+        def hyperparam_log_priors(self, mechanism_ids: List[int], raw_values: Dict[str, torch.Tensor] = None):
+            hyperparams = self.store.get(mechanism_ids, raw_values)
+            log_priors = self.noise_var_prior.log_prob(hyperparams['noise']) + \
+                         self.outscale_prior.log_prob(hyperparams['variance']) + \
+                         self.offset_prior.log_prob(hyperparams['constant'])
+            return log_priors
+
+        def mean(self, hyperparams: Dict[str, torch.Tensor]) -> Optional[torch.Tensor]:
+            return hyperparams['constant']
+
+        def kernel(self, x1: torch.Tensor, x2: Optional[torch.Tensor], hyperparams: Dict[str, torch.Tensor]):
+            return linear_kernel(x1, x2, hyperparams['variance'])
+
+        def batched_prior_mll(self, inputs: torch.Tensor, targets: torch.Tensor, mechanism_ids: List[int],
+                              raw_values: Dict[str, torch.Tensor] = None,
+                              sq_diff_cache: SquaredDifferenceCache = None, cg_settings: Dict[str, Any] = None):
+            # closed-form Bayesian linear regression evidence, linear in the number of samples (no iterative solves)
+            hyperparams = self.store.get(mechanism_ids, raw_values)
+            parent_ids = [resolve_mechanism_id(mechanism_id)[1] for mechanism_id in mechanism_ids]
+            parent_inputs = gather_parent_inputs(inputs, get_parent_index_matrix(parent_ids, inputs.shape[-1]))
+            residuals = targets - hyperparams['constant'].unsqueeze(-1)
+            precisions = blr_prior_precisions(parent_inputs.shape[-1], hyperparams['variance'], hyperparams['noise'])
+            return blr_log_likelihood(parent_inputs, residuals, hyperparams['noise'], precisions)
+
+        def batched_statistics_mll(self, statistics: NodeStatistics, mechanism_ids: List[int],
+                                   raw_values: Dict[str, torch.Tensor] = None):
+            # evaluates the evidence in double precision from the accumulated data statistics only
+            hyperparams = {name: values.double() for name, values in self.store.get(mechanism_ids, raw_values).items()}
+            parent_ids = [resolve_mechanism_id(mechanism_id)[1] for mechanism_id in mechanism_ids]
+            parent_idc = get_parent_index_matrix(parent_ids, statistics.num_dims)
+            xtx, xty, xt1, yty, y_sum, num_samples = statistics.linear_statistics(parent_idc)
+
+            constants = hyperparams['constant']
+            xtr = xty - constants.unsqueeze(-1) * xt1
+            rtr = yty - 2. * constants * y_sum + num_samples * constants.pow(2)
+            precisions = blr_prior_precisions(parent_idc.shape[-1], hyperparams['variance'], hyperparams['noise'])
+            mlls = blr_log_likelihood_from_statistics(xtx, xtr, rtr, num_samples, hyperparams['noise'], precisions)
+            return mlls.float()
+
+        def legacy_raw_values(self, param_dict: Dict[str, Any], key: str) -> Dict[str, torch.Tensor]:
+            # gpytorch parameter order: likelihood [raw_noise], kernel [raw_variance], mean [raw_constant]
+            return {'noise': param_dict['likelihood_param_dict'][key].float()[0],
+                    'variance': param_dict['kernel_param_dict'][key].float()[0],
+                    'constant': param_dict['mean_param_dict'][key].float()[0]}
 
-        def load_param_dict(self, param_dict):
-            # ATTENTION: does not load the training data!
-            self.likelihoods = ModuleDict()
-            self.kernels = ModuleDict()
-            self.lscale_priors: Dict[str, dist.Gamma] = {}
+    ##########################################################################
+    # Shared-data GP  RQ-Kernel Model
+    ##########################################################################
+    class SharedDataGPRQKernel(SharedDataGPBase):
+        hyperparameter_bounds = {'noise': 1e-4, 'outputscale': 0., 'lengthscale': 0., 'alpha': 0.}
+        supports_sq_dists = True
 
-            self.node_to_dim_map = param_dict['node_to_dim_map']
-            for key in param_dict['likelihood_param_dict']:
-                self.init_kernel(key)
-                likelihood_param_vec = param_dict['likelihood_param_dict'][key].float()
-                kernel_param_vec = param_dict['kernel_param_dict'][key].float()
-                if use_gpu and torch.cuda.is_available():
-                    likelihood_param_vec.cuda(torch.device('cuda'))
-                    kernel_param_vec.cuda(torch.device('cuda'))
-
-                vector_to_parameters(likelihood_param_vec, self.likelihoods[key].parameters())
-                vector_to_parameters(kernel_param_vec, self.kernels[key].parameters())
-
-        def get_parameters(self, keys: List[str] = None):
-            if keys is None:
-                return self.parameters()
-            else:
-                kernel_params = [self.kernels[key].parameters() for key in keys if key in self.kernels]
-                likelihood_params = [self.likelihoods[key].parameters() for key in keys if key in self.likelihoods]
-                return chain(*kernel_params, *likelihood_params)
+        def init_priors(self):
+            self.noise_var_prior = dist.Gamma(self.cfg.noise_var_concentration, self.cfg.noise_var_rate)
+            self.outscale_prior = dist.Gamma(self.cfg.outscale_concentration, self.cfg.outscale_rate)
+            self.scale_mix_prior = dist.Gamma(self.cfg.scale_mix_concentration, self.cfg.scale_mix_rate)
+
+        def lscale_priors(self, mechanism_ids: List[int]) -> dist.Gamma:
+            num_parents = torch.tensor([len(resolve_mechanism_id(mechanism_id)[1]) for mechanism_id in mechanism_ids])
+            return dist.Gamma(self.cfg.lscale_concentration_multiplier * num_parents, self.cfg.lscale_rate)
+
+        def init_hyperparams(self, mechanism_ids: List[int]):
+            sample_shape = torch.Size((len(mechanism_ids),))
+            hyperparams = {'noise': self.noise_var_prior.sample(sample_shape).clamp_min(1e-3),
+                           'outputscale': self.outscale_prior.sample(sample_shape),
+                           'lengthscale': self.lscale_priors(mechanism_ids).sample(),
+                           'alpha': self.scale_mix_prior.sample(sample_shape)}
+            self.store.set(mechanism_ids, hyperparams)
+
+        def hyperparam_log_priors(self, mechanism_ids: List[int], raw_values: Dict[str, torch.Tensor] = None):
+            hyperparams = self.store.get(mechanism_ids, raw_values)
+            log_priors = self.noise_var_prior.log_prob(hyperparams['noise']) + \
+                         self.outscale_prior.log_prob(hyperparams['outputscale']) + \
+                         self.lscale_priors(mechanism_ids).log_prob(hyperparams['lengthscale']) + \
+                         self.scale_mix_prior.log_prob(hyperparams['alpha'])
+            return log_priors
+
+        def mean(self, hyperparams: Dict[str, torch.Tensor]) -> Optional[torch.Tensor]:
+            return None
+
+        def kernel(self, x1: torch.Tensor, x2: Optional[torch.Tensor], hyperparams: Dict[str, torch.Tensor]):
+            return rq_kernel(x1, x2, hyperparams['outputscale'], hyperparams['lengthscale'], hyperparams['alpha'])
+
+        def kernel_diag(self, x: torch.Tensor, hyperparams: Dict[str, torch.Tensor]) -> torch.Tensor:
+            return hyperparams['outputscale'].unsqueeze(-1).expand(x.shape[:-1])
+
+        def fourier_features(self, x: torch.Tensor, hyperparams: Dict[str, torch.Tensor], num_features: int,
+                             seed: int) -> torch.Tensor:
+            return rq_fourier_features(x, hyperparams['outputscale'], hyperparams['lengthscale'], hyperparams['alpha'],
+                                       num_features, seed)
+
+        def batched_rff_prior_mll(self, inputs: torch.Tensor, targets: torch.Tensor, mechanism_ids: List[int],
+                                  num_features: int, seed: int, raw_values: Dict[str, torch.Tensor] = None):
+            # Bayesian linear regression on random Fourier features with unit weight variance, O(n D^2)
+            hyperparams = self.store.get(mechanism_ids, raw_values)
+            parent_ids = [resolve_mechanism_id(mechanism_id)[1] for mechanism_id in mechanism_ids]
+            parent_inputs = gather_parent_inputs(inputs, get_parent_index_matrix(parent_ids, inputs.shape[-1]))
+            features = self.fourier_features(parent_inputs, hyperparams, num_features, seed)
+            noises = hyperparams['noise']
+            precisions = blr_prior_precisions(features.shape[-1], torch.ones_like(noises), noises)
+            return blr_log_likelihood(features, targets.expand(len(mechanism_ids), -1), noises, precisions)
+
+        def kernel_from_sq_dists(self, sq_dists: torch.Tensor, hyperparams: Dict[str, torch.Tensor]):
+            scaled_sq_dists = sq_dists / expand_hyperparameter(hyperparams['lengthscale']).pow(2)
+            return rq_kernel_from_sq_dists(scaled_sq_dists, hyperparams['outputscale'], hyperparams['alpha'])
+
+        def legacy_raw_values(self, param_dict: Dict[str, Any], key: str) -> Dict[str, torch.Tensor]:
+            # gpytorch parameter order: likelihood [raw_noise], kernel [raw_outputscale, raw_lengthscale, raw_alpha]
+            kernel_param_vec = param_dict['kernel_param_dict'][key].float()
+            return {'noise': param_dict['likelihood_param_dict'][key].float()[0],
+                    'outputscale': kernel_param_vec[0],
+                    'lengthscale': kernel_param_vec[1],
+                    'alpha': kernel_param_vec[2]}
 
     ##########################################################################
     # Main-class functions
     ##########################################################################
     def __init__(self, in_size: int, node_to_dim_map: Dict[str, int] = None, linear=False,
-                 cfg: GaussianProcessConfig = None, param_dict: Dict[str, Any] = None):
+                 cfg: GaussianProcessConfig = None, param_dict: Dict[str, Any] = None, model_cfg: GPModelConfig = None):
         assert node_to_dim_map is not None or param_dict is not None
         super().__init__(in_size)
+        self.train_inputs = None
+        self.train_targets = None
+        self.inducing_inputs = None
+
+        # the model config determines caching and approximations
+        self.model_cfg = GPModelConfig() if model_cfg is None else model_cfg
+        assert self.model_cfg.approximation in {'exact', 'sparse', 'rff', 'cg'}, \
+            print(f'Invalid GP approximation {self.model_cfg.approximation}!')
+
+        # per-dimension squared differences of the training data shared by all mechanisms (disabled if 0)
+        self.sq_diff_cache = None
+        if self.model_cfg.sq_diff_cache_max_samples > 0:
+            self.sq_diff_cache = SquaredDifferenceCache(self.model_cfg.sq_diff_cache_max_samples)
+
+        # per-mechanism Cholesky factors of the training covariances, extended when data is appended (disabled if 0)
+        self.cholesky_cache = None
+        if self.model_cfg.cholesky_cache_size > 0:
+            self.cholesky_cache = CholeskyCache(self.model_cfg.cholesky_cache_max_samples,
+                                                self.model_cfg.cholesky_cache_size)
 
         if param_dict is not None:
             self.load_param_dict(param_dict)
@@ -770,7 +887,7 @@ class SharedDataGaussianProcess(Mechanism):
             # load config
             self.cfg = GaussianProcessConfig() if cfg is None else cfg
 
-            # initialize likelihood and gp model
+            # initialize hyperparameter store and kernel model
             self.linear = linear
             if self.linear:
                 self.gp = SharedDataGaussianProcess.SharedDataGPLinearKernel(self.cfg, node_to_dim_map)
@@ -781,80 +898,433 @@ class SharedDataGaussianProcess(Mechanism):
 
     def set_data(self, inputs: torch.Tensor, targets: torch.Tensor):
         self._check_args(inputs, targets)
-        self.gp.set_train_data(inputs, targets, strict=False)
-
-    def init_kernel(self, key: str):
-        self.gp.init_kernel(key)
-        self.gp.init_hyperparams(key)
-
-    def delete_kernel(self, key: str):
-        self.gp.delete_kernel(key)
-
-    def delete_kernels(self, keys: List[str]):
-        self.gp.delete_kernels(keys)
-
-    def init_hyperparams(self, key: str):
-        self.gp.init_hyperparams(key)
-
-    def get_keys(self):
-        return list(self.gp.kernels.keys())
-
-    def exists(self, key: str):
-        return key in self.gp.kernels and key in self.gp.likelihoods
-
-    def activate(self, key: str):
-        if not self.exists(key):
-            self.init_kernel(key)
-            self.gp.init_hyperparams(key)
-
-        self.gp.likelihood = self.gp.likelihoods[key]
-        self.gp._clear_cache()
-
-    def hyperparam_log_prior(self, key: str):
-        return self.gp.hyperparam_log_prior(key)
+        self.train_inputs = inputs
+        self.train_targets = targets
+        if self.sq_diff_cache is not None:
+            self.sq_diff_cache.reset(inputs)
+        if self.cholesky_cache is not None:
+            self.cholesky_cache.reset(inputs)
+
+        # choose inducing inputs shared by all mechanisms, linear mechanisms are already cheap to evaluate
+        self.inducing_inputs = None
+        if self.model_cfg.approximation == 'sparse' and not self.linear and \
+                inputs.shape[0] > self.model_cfg.num_inducing_points:
+            self.inducing_inputs = select_inducing_points(inputs, self.model_cfg.num_inducing_points,
+                                                          self.model_cfg.inducing_point_strategy)
+
+    def use_sparse(self, inputs: torch.Tensor) -> bool:
+        return self.inducing_inputs is not None and inputs.shape[-2] > self.inducing_inputs.shape[0]
+
+    def use_cg(self) -> bool:
+        # linear mechanisms are scored in closed form and need no iterative solves
+        return self.model_cfg.approximation == 'cg' and not self.linear
+
+    def cg_settings(self) -> Optional[Dict[str, Any]]:
+        if not self.use_cg():
+            return None
+        return {'tolerance': self.model_cfg.cg_tolerance,
+                'max_iterations': self.model_cfg.cg_max_iterations,
+                'num_probes': self.model_cfg.num_probe_vectors,
+                'preconditioner_rank': self.model_cfg.preconditioner_rank,
+                'seed': self.model_cfg.cg_seed}
+
+    def init_kernel(self, mechanism_id: int):
+        self.init_kernels([mechanism_id])
+
+    def init_kernels(self, mechanism_ids: List[int]):
+        mechanism_ids = [mechanism_id for mechanism_id in mechanism_ids if not self.exists(mechanism_id)]
+        if len(mechanism_ids) > 0:
+            self.gp.init_kernels(mechanism_ids)
+            self.gp.init_hyperparams(mechanism_ids)
+
+    def delete_kernel(self, mechanism_id: int):
+        self.delete_kernels([mechanism_id])
+
+    def delete_kernels(self, mechanism_ids: List[int]):
+        self.gp.delete_kernels(mechanism_ids)
+        if self.cholesky_cache is not None:
+            self.cholesky_cache.discard(mechanism_ids)
+
+    def init_hyperparams(self, mechanism_id: int):
+        self.gp.init_hyperparams([mechanism_id])
+
+    def get_mechanism_ids(self) -> List[int]:
+        return self.gp.store.mechanism_ids()
+
+    def exists(self, mechanism_id: int):
+        return mechanism_id in self.gp.store
+
+    def activate(self, mechanism_id: int):
+        if not self.exists(mechanism_id):
+            self.init_kernel(mechanism_id)
+
+    def hyperparam_log_prior(self, mechanism_id: int):
+        return self.gp.hyperparam_log_priors([mechanism_id]).squeeze(0)
+
+    def hyperparam_log_priors(self, mechanism_ids: List[int], raw_values: Dict[str, torch.Tensor] = None):
+        return self.gp.hyperparam_log_priors(mechanism_ids, raw_values)
+
+    def get_hyperparameters(self, mechanism_id: int) -> Dict[str, torch.Tensor]:
+        self.activate(mechanism_id)
+        return {name: values.squeeze(0) for name, values in self.gp.store.get([mechanism_id]).items()}
+
+    def gather_raw_hyperparameters(self, mechanism_ids: List[int]) -> Dict[str, torch.Tensor]:
+        # returns leaf tensors of the raw hyperparameters for optimisation
+        return self.gp.store.gather_raw(mechanism_ids, requires_grad=True)
+
+    def get_sq_diff_cache(self, inputs: torch.Tensor) -> Optional[SquaredDifferenceCache]:
+        # the cache can only be used if the inputs are the current training data
+        if self.sq_diff_cache is not None and self.gp.supports_sq_dists and self.sq_diff_cache.matches(inputs):
+            return self.sq_diff_cache
+        return None
+
+    def scatter_raw_hyperparameters(self, mechanism_ids: List[int], raw_values: Dict[str, torch.Tensor]):
+        self.gp.store.scatter_raw(mechanism_ids, raw_values)
+
+    def predictive_distribution(self, inputs: torch.Tensor, mechanism_id: int, prior_mode=False, mean_only=False):
+        """Computes the predictive distribution of the latent function values at the given inputs.
 
-    def get_parameters(self, keys: List[str] = None):
-        return self.gp.get_parameters(keys)
+        Parameters
+        ----------
+        inputs : torch.Tensor
+            Inputs of shape (..., num_samples, num_nodes).
+        mechanism_id : int
+            The mechanism id.
+        prior_mode : bool
+            Whether to use the GP prior instead of the posterior given the training data.
+        mean_only : bool
+            Whether to skip computing the predictive covariance.
+
+        Returns
+        ------
+        Tuple[torch.Tensor, Optional[torch.Tensor], torch.Tensor]
+            The predictive mean of shape (..., num_samples), the predictive covariance of shape
+            (..., num_samples, num_samples) or None if mean_only, and the noise variance.
+        """
+        hyperparams, prior_mean, parent_ids = self.prepare_mechanism(mechanism_id)
+        x = inputs[..., parent_ids]
+
+        if self.use_weight_space():
+            weight_means, precision_cholesky = self.weight_space_posterior(parent_ids, hyperparams, prior_mean,
+                                                                           prior_mode)
+            features = self.weight_space_features(x, hyperparams)
+            mean, covar = blr_predict(features, weight_means, precision_cholesky, hyperparams['noise'], mean_only)
+            return mean + prior_mean, covar, hyperparams['noise']
+
+        if prior_mode or self.train_targets is None:
+            mean = prior_mean.expand(x.shape[:-1])
+            covar = None if mean_only else self.gp.kernel(x, None, hyperparams)
+            return mean, covar, hyperparams['noise']
+
+        if self.use_sparse(self.train_inputs):
+            return self.sparse_predictive_distribution(x, parent_ids, hyperparams, prior_mean, mean_only)
+
+        # condition on the training data
+        train_x = self.train_inputs[..., parent_ids]
+        residuals = (self.train_targets - prior_mean).unsqueeze(-1)
+        if self.use_cg():
+            train_covar = self.train_covariance(parent_ids, train_x, hyperparams)
+            return self.cg_predictive_distribution(x, train_x, train_covar, residuals, hyperparams, prior_mean,
+                                                   mean_only)
+
+        cholesky_factor, alpha = self.posterior_factors(mechanism_id, parent_ids, train_x, residuals, hyperparams)
+        cross_covar = self.gp.kernel(x, train_x, hyperparams)
+        mean = cross_covar @ alpha + prior_mean
+        if mean_only:
+            return mean, None, hyperparams['noise']
+
+        v = torch.linalg.solve_triangular(cholesky_factor, cross_covar.transpose(-1, -2), upper=False)
+        covar = self.gp.kernel(x, None, hyperparams) - v.transpose(-1, -2) @ v
+        return mean, covar, hyperparams['noise']
+
+    def sparse_predictive_distribution(self, x: torch.Tensor, parent_ids: List[int],
+                                       hyperparams: Dict[str, torch.Tensor], prior_mean: torch.Tensor, mean_only=False):
+        # SGPR posterior given the training data, see batched_sgpr_mll
+        train_x = self.train_inputs[..., parent_ids]
+        inducing_x = self.inducing_inputs[..., parent_ids]
+        kmm_cholesky, a, b_cholesky = sgpr_factors(self.gp.kernel(inducing_x, train_x, hyperparams),
+                                                   self.gp.kernel(inducing_x, None, hyperparams), hyperparams['noise'])
+        residuals = (self.train_targets - prior_mean).unsqueeze(-1)
+        c = torch.linalg.solve_triangular(b_cholesky, a @ residuals, upper=False) / hyperparams['noise'].sqrt()
+
+        w = torch.linalg.solve_triangular(kmm_cholesky, self.gp.kernel(inducing_x, x, hyperparams), upper=False)
+        mean = (w.transpose(-1, -2) @ torch.linalg.solve_triangular(b_cholesky.t(), c, upper=True)).squeeze(-1)
+        mean = mean + prior_mean
+        if mean_only:
+            return mean, None, hyperparams['noise']
+
+        v = torch.linalg.solve_triangular(b_cholesky, w, upper=False)
+        covar = self.gp.kernel(x, None, hyperparams) - w.transpose(-1, -2) @ w + v.transpose(-1, -2) @ v
+        return mean, covar, hyperparams['noise']
+
+    def train_covariance(self, parent_ids: List[int], train_x: torch.Tensor,
+                         hyperparams: Dict[str, torch.Tensor]) -> torch.Tensor:
+        sq_diff_cache = self.get_sq_diff_cache(self.train_inputs)
+        if sq_diff_cache is not None:
+            train_sq_dists = sq_diff_cache.squared_distances([tuple(parent_ids)]).squeeze(0)
+            return self.gp.kernel_from_sq_dists(train_sq_dists, hyperparams)
+        return self.gp.kernel(train_x, None, hyperparams)
+
+    def posterior_factors(self, mechanism_id: int, parent_ids: List[int], train_x: torch.Tensor,
+                          residuals: torch.Tensor, hyperparams: Dict[str, torch.Tensor]):
+        # returns the Cholesky factor of the noisy training covariance and alpha = (K + noise * I)^-1 (y - mean), which
+        # are kept in the LRU cache across predictions until the data or the hyperparameters change
+        if not self.use_cholesky_cache(self.train_inputs):
+            train_covar = self.train_covariance(parent_ids, train_x, hyperparams)
+            train_covar = train_covar + hyperparams['noise'] * torch.eye(train_covar.shape[-1])
+            cholesky_factor = psd_safe_cholesky(train_covar)
+            return cholesky_factor, torch.cholesky_solve(residuals, cholesky_factor).squeeze(-1)
+
+        version = self.gp.store.get_versions([mechanism_id])[0]
+        cholesky_factor = self.cached_cholesky_factors(self.train_inputs, [mechanism_id], [version])[0]
+        alpha = self.cholesky_cache.get_alpha(mechanism_id, version)
+        if alpha is None:
+            alpha = torch.cholesky_solve(residuals, cholesky_factor).squeeze(-1)
+            self.cholesky_cache.put_alpha(mechanism_id, version, alpha)
+        return cholesky_factor, alpha
+
+    def cg_predictive_distribution(self, x: torch.Tensor, train_x: torch.Tensor, train_covar: torch.Tensor,
+                                   residuals: torch.Tensor, hyperparams: Dict[str, torch.Tensor],
+                                   prior_mean: torch.Tensor, mean_only=False):
+        # exact GP posterior with the solves against the noisy training covariance done by preconditioned CG
+        cross_covar = self.gp.kernel(x, train_x, hyperparams)
+        rhs = residuals
+        if not mean_only:
+            rhs = torch.cat((residuals, cross_covar.reshape(-1, cross_covar.shape[-1]).t()), dim=-1)
+        solves = cg_solve(train_covar, hyperparams['noise'], rhs, self.model_cfg.cg_tolerance,
+                          self.model_cfg.cg_max_iterations, self.model_cfg.preconditioner_rank)
+
+        mean = cross_covar @ solves[:, 0] + prior_mean
+        if mean_only:
+            return mean, None, hyperparams['noise']
+
+        cross_solves = solves[:, 1:].t().reshape(cross_covar.shape)
+        covar = self.gp.kernel(x, None, hyperparams) - cross_covar @ cross_solves.transpose(-1, -2)
+        return mean, covar, hyperparams['noise']
+
+    def prepare_mechanism(self, mechanism_id: int):
+        hyperparams = self.get_hyperparameters(mechanism_id)
+        prior_mean = self.gp.mean(hyperparams)
+        prior_mean = torch.tensor(0.) if prior_mean is None else prior_mean
+        parent_ids = list(resolve_mechanism_id(mechanism_id)[1])
+        return hyperparams, prior_mean, parent_ids
+
+    def use_weight_space(self) -> bool:
+        # linear GPs and RFF-approximated GPs are Bayesian linear regressions in (feature) weight space
+        return self.linear or self.model_cfg.approximation == 'rff'
+
+    def weight_space_features(self, x: torch.Tensor, hyperparams: Dict[str, torch.Tensor]) -> torch.Tensor:
+        if self.linear:
+            return x
+        return self.gp.fourier_features(x, hyperparams, self.model_cfg.num_fourier_features, self.model_cfg.rff_seed)
+
+    def weight_space_posterior(self, parent_ids: List[int], hyperparams: Dict[str, torch.Tensor],
+                               prior_mean: torch.Tensor, prior_mode=False):
+        # returns the weight means and the Cholesky factor of the scaled weight precision
+        num_features = len(parent_ids) if self.linear else 2 * self.model_cfg.num_fourier_features
+        variances = hyperparams['variance'] if self.linear else torch.ones_like(hyperparams['noise'])
+        precisions = blr_prior_precisions(num_features, variances, hyperparams['noise'])
+        if prior_mode or self.train_targets is None:
+            return torch.zeros(num_features), psd_safe_cholesky(precisions)
+
+        train_features = self.weight_space_features(self.train_inputs[..., parent_ids], hyperparams)
+        return blr_update(train_features, self.train_targets - prior_mean, precisions)
+
+    def predictive_targets_distribution(self, inputs: torch.Tensor, mechanism_id: int, prior_mode=False):
+        mean, covar, noise = self.predictive_distribution(inputs, mechanism_id, prior_mode)
+        covar = covar + noise * torch.eye(covar.shape[-1])
+        return dist.MultivariateNormal(mean, scale_tril=psd_safe_cholesky(covar))
+
+    def predict(self, inputs: torch.Tensor, mechanism_id: int, prior_mode=False, return_samples=False):
+        """Computes the predictive means and, optionally, samples of noisy targets from a single evaluation of the GP
+        posterior. Without samples, the predictive covariance is not computed.
 
-    def forward(self, inputs: torch.Tensor, key: str, prior_mode=False):
+        Parameters
+        ----------
+        inputs : torch.Tensor
+            Inputs of shape (..., num_samples, num_nodes).
+        mechanism_id : int
+            The mechanism id.
+        prior_mode : bool
+            Whether to use the GP prior instead of the posterior given the training data.
+        return_samples : bool
+            Whether to also sample noisy targets.
+
+        Returns
+        ------
+        Tuple[torch.Tensor, Optional[torch.Tensor]]
+            The predictive means of shape (..., num_samples, 1) and the samples of the same shape or None.
+        """
         self._check_args(inputs)
         output_shape = (*inputs.shape[:-1], 1)
 
-        self.activate(key)
-        with gpytorch.settings.prior_mode(prior_mode):
-            f_dist = self.gp(inputs, key=key)
-        return f_dist.mean.view(output_shape)
+        if not return_samples:
+            mean, _, _ = self.predictive_distribution(inputs, mechanism_id, prior_mode, mean_only=True)
+            return mean.reshape(output_shape), None
+
+        if self.use_weight_space():
+            # evaluating a sampled (feature-space) function is a matrix-vector product on the same features
+            hyperparams, prior_mean, parent_ids = self.prepare_mechanism(mechanism_id)
+            weight_means, precision_cholesky = self.weight_space_posterior(parent_ids, hyperparams, prior_mean,
+                                                                           prior_mode)
+            features = self.weight_space_features(inputs[..., parent_ids], hyperparams)
+            mean = features @ weight_means + prior_mean
+            samples = blr_sample(features, weight_means, precision_cholesky, hyperparams['noise']) + prior_mean
+            return mean.reshape(output_shape), samples.view(output_shape)
+
+        mean, covar, noise = self.predictive_distribution(inputs, mechanism_id, prior_mode)
+        if covar.shape[-1] == 1:
+            # independent test points need no Cholesky decomposition
+            samples = mean + (covar.squeeze(-1).clamp_min(0.) + noise).sqrt() * torch.randn_like(mean)
+        else:
+            covar = covar + noise * torch.eye(covar.shape[-1])
+            samples = dist.MultivariateNormal(mean, scale_tril=psd_safe_cholesky(covar)).sample()
+        return mean.reshape(output_shape), samples.view(output_shape)
 
-    def sample(self, inputs: torch.Tensor, key: str, prior_mode=False):
-        self._check_args(inputs)
-        output_shape = (*inputs.shape[:-1], 1)
+    def forward(self, inputs: torch.Tensor, mechanism_id: int, prior_mode=False):
+        return self.predict(inputs, mechanism_id, prior_mode)[0]
 
-        self.activate(key)
-        with gpytorch.settings.prior_mode(prior_mode):
-            f_dist = self.gp(inputs, key=key)
-        y_dist = self.gp.likelihoods[key](f_dist)
-        return y_dist.sample().view(output_shape)
+    def sample(self, inputs: torch.Tensor, mechanism_id: int, prior_mode=False):
+        return self.predict(inputs, mechanism_id, prior_mode, return_samples=True)[1]
 
-    def mll(self, inputs: torch.Tensor, targets: torch.Tensor, key: str, prior_mode=False, reduce=True):
+    def mll(self, inputs: torch.Tensor, targets: torch.Tensor, mechanism_id: int, prior_mode=False, reduce=True):
         self._check_args(inputs, targets)
         output_shape = targets.shape[:-1]
 
-        self.activate(key)
-        with gpytorch.settings.prior_mode(prior_mode):
-            f_dist = self.gp(inputs, key=key)
-            y_dist = self.gp.likelihoods[key](f_dist)
-
-        mlls = y_dist.log_prob(targets)
+        if self.use_weight_space():
+            hyperparams, prior_mean, parent_ids = self.prepare_mechanism(mechanism_id)
+            weight_means, precision_cholesky = self.weight_space_posterior(parent_ids, hyperparams, prior_mean,
+                                                                           prior_mode)
+            features = self.weight_space_features(inputs[..., parent_ids], hyperparams)
+            residuals = targets - prior_mean - features @ weight_means
+            precisions = precision_cholesky @ precision_cholesky.transpose(-1, -2)
+            mlls = blr_log_likelihood(features, residuals, hyperparams['noise'], precisions)
+        elif prior_mode and targets.dim() == 1 and (self.use_sparse(inputs) or self.use_cg()):
+            mlls = self.batched_mll(inputs, targets, [mechanism_id]).squeeze(0)
+        else:
+            y_dist = self.predictive_targets_distribution(inputs, mechanism_id, prior_mode)
+            mlls = y_dist.log_prob(targets)
         assert mlls.shape == output_shape, print(f'Invalid shape {mlls.shape}!')
 
         if reduce:
             return mlls.sum()
         return mlls
 
-    def expected_noise_entropy(self, key: str) -> torch.Tensor:
+    def batched_mll(self, inputs: torch.Tensor, targets: torch.Tensor, mechanism_ids: List[int],
+                    raw_values: Dict[str, torch.Tensor] = None) -> torch.Tensor:
+        """Computes the prior-mode marginal log-likelihoods of several mechanisms on the same data with one batched
+        Cholesky decomposition (or batched preconditioned CG/Lanczos in 'cg' mode).
+
+        Parameters
+        ----------
+        inputs : torch.Tensor
+            Shared input data of shape (num_samples, num_nodes).
+        targets : torch.Tensor
+            Targets of shape (num_samples,).
+        mechanism_ids : List[int]
+            The ids of the mechanisms to evaluate.
+        raw_values : Dict[str, torch.Tensor]
+            Optional raw hyperparameters of the mechanisms, e.g., as returned by `gather_raw_hyperparameters`. If None,
+            the stored hyperparameters are used.
+
+        Returns
+        ------
+        torch.Tensor
+            The marginal log-likelihoods of shape (num_mechanisms,).
+        """
+        self._check_args(inputs, targets)
+        assert targets.dim() == 1, print(f'Batched MLLs need targets of shape (num_samples,), got {targets.shape}!')
+        self.init_kernels(mechanism_ids)
+        if self.use_sparse(inputs):
+            return self.gp.batched_sparse_prior_mll(inputs, targets, mechanism_ids, self.inducing_inputs, raw_values)
+        if self.model_cfg.approximation == 'rff' and not self.linear:
+            return self.gp.batched_rff_prior_mll(inputs, targets, mechanism_ids, self.model_cfg.num_fourier_features,
+                                                 self.model_cfg.rff_seed, raw_values)
+        if raw_values is None and not torch.is_grad_enabled() and self.use_cholesky_cache(inputs):
+            return self.cached_batched_mll(inputs, targets, mechanism_ids)
+        return self.gp.batched_prior_mll(inputs, targets, mechanism_ids, raw_values, self.get_sq_diff_cache(inputs),
+                                         self.cg_settings())
+
+    def use_cholesky_cache(self, inputs: torch.Tensor) -> bool:
+        # linear and iteratively solved GPs do not factorise the training covariance
+        return self.cholesky_cache is not None and not self.linear and not self.use_cg() and \
+            self.cholesky_cache.matches(inputs)
+
+    def cached_batched_mll(self, inputs: torch.Tensor, targets: torch.Tensor, mechanism_ids: List[int]) -> torch.Tensor:
+        factors = self.cached_cholesky_factors(inputs, mechanism_ids, self.gp.store.get_versions(mechanism_ids))
+        residuals = targets.view(1, -1, 1).expand(len(mechanism_ids), -1, -1)
+        means = self.gp.mean(self.gp.store.get(mechanism_ids))
+        if means is not None:
+            residuals = residuals - means.view(-1, 1, 1)
+        return cholesky_gaussian_mll(torch.stack(factors), residuals)
+
+    def cached_cholesky_factors(self, inputs: torch.Tensor, mechanism_ids: List[int],
+                                versions: List[int]) -> List[torch.Tensor]:
+        # reuse the cached Cholesky factors of mechanisms with unchanged hyperparameters and extend them by the rows
+        # appended to the data since they were computed, mechanisms are batched by the number of cached rows
+        num_samples = inputs.shape[0]
+        factors = [self.cholesky_cache.get(mid, version) for mid, version in zip(mechanism_ids, versions)]
+        idc_by_rows = dict()
+        for midx, factor in enumerate(factors):
+            idc_by_rows.setdefault(0 if factor is None else factor.shape[-1], []).append(midx)
+
+        for num_rows, idc in idc_by_rows.items():
+            if num_rows == num_samples:
+                continue
+
+            group_ids = [mechanism_ids[midx] for midx in idc]
+            hyperparams = self.gp.store.get(group_ids)
+            parent_ids = [resolve_mechanism_id(mechanism_id)[1] for mechanism_id in group_ids]
+            parent_inputs = gather_parent_inputs(inputs, get_parent_index_matrix(parent_ids, inputs.shape[-1]))
+            noise_covars = expand_hyperparameter(hyperparams['noise']) * torch.eye(num_samples - num_rows)
+            sq_diff_cache = self.get_sq_diff_cache(inputs)
+            if num_rows == 0 and sq_diff_cache is not None:
+                new_covars = self.gp.kernel_from_sq_dists(sq_diff_cache.squared_distances(parent_ids), hyperparams)
+            else:
+                new_covars = self.gp.kernel(parent_inputs[:, num_rows:], None, hyperparams)
+            new_covars = new_covars + noise_covars
+
+            if num_rows == 0:
+                group_factors = psd_safe_cholesky(new_covars)
+            else:
+                cross_covars = self.gp.kernel(parent_inputs[:, num_rows:], parent_inputs[:, :num_rows], hyperparams)
+                group_factors = extend_cholesky(torch.stack([factors[midx] for midx in idc]), cross_covars,
+                                                new_covars)
+
+            for gidx, midx in enumerate(idc):
+                factors[midx] = group_factors[gidx]
+                self.cholesky_cache.put(mechanism_ids[midx], versions[midx], group_factors[gidx])
+
+        return factors
+
+    def batched_statistics_mll(self, statistics: NodeStatistics, mechanism_ids: List[int],
+                               raw_values: Dict[str, torch.Tensor] = None) -> torch.Tensor:
+        """Computes the prior-mode marginal log-likelihoods of several linear mechanisms from the sufficient statistics
+        of the shared data, i.e., at a cost independent of the number of samples.
+
+        Parameters
+        ----------
+        statistics : NodeStatistics
+            The data statistics of the target node.
+        mechanism_ids : List[int]
+            The ids of the mechanisms to evaluate.
+        raw_values : Dict[str, torch.Tensor]
+            Optional raw hyperparameters of the mechanisms. If None, the stored hyperparameters are used.
+
+        Returns
+        ------
+        torch.Tensor
+            The marginal log-likelihoods of shape (num_mechanisms,).
+        """
+        assert self.linear, print('Sufficient statistics are only available for linear mechanisms!')
+        self.init_kernels(mechanism_ids)
+        return self.gp.batched_statistics_mll(statistics, mechanism_ids, raw_values)
+
+    def expected_noise_entropy(self, mechanism_id: int) -> torch.Tensor:
         # use point estimate with the MAP variance
-        self.activate(key)
-        entropy = 0.5 * (2. * math.pi * self.gp.likelihoods[key].noise * math.e).log().squeeze()
+        self.activate(mechanism_id)
+        noise = self.gp.store.get([mechanism_id])['noise'].squeeze(0)
+        entropy = 0.5 * (2. * math.pi * noise * math.e).log()
         return entropy
 
     def param_dict(self) -> Dict[str, Any]:
@@ -872,7 +1342,7 @@ class SharedDataGaussianProcess(Mechanism):
         self.in_size = param_dict['in_size']
         self.linear = param_dict['linear']
 
-        # initialize likelihood and gp model
+        # initialize hyperparameter store and kernel model
         if self.linear:
             self.gp = SharedDataGaussianProcess.SharedDataGPLinearKernel(self.cfg,
                                                                          param_dict=param_dict['gp_param_dict'])
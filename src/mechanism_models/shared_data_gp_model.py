@@ -1,6 +1,6 @@
 import itertools
 import math
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 
 import networkx as nx
 import torch
@@ -8,10 +8,14 @@ from torch.linalg import vector_norm
 
 from src.config import GPModelConfig
 from src.environments.environment import Experiment, gather_data
-from src.environments.experiment import InterventionalDistributionsQuery
+from src.environments.experiment import InterventionalDistributionsQuery, DataStore
+from src.mechanism_models.batched_gp import split_batches
 from src.mechanism_models.mechanisms import SharedDataGaussianProcess, GaussianRootNode, get_mechanism_key, \
-    resolve_mechanism_key
-from src.utils.graphs import get_graph_key, get_parents
+    get_mechanism_id, resolve_mechanism_id, is_root_mechanism, mechanism_id_to_key, mechanism_key_to_id, \
+    MECHANISM_ID_MAX_NODES
+from src.mechanism_models.sufficient_statistics import NodeStatistics
+from src.utils.graphs import get_parents, graph_to_adj_mat, topological_sort_batch, graph_hash_batch, \
+    get_graph_hash, graph_key_to_hash
 
 
 def get_unique_mechanisms(graphs: List[List[nx.DiGraph]]):
@@ -40,11 +44,13 @@ class SharedDataGaussianProcessModel:
 
             self.node_labels = sorted(list(set(node_labels)))
             num_nodes = len(self.node_labels)
+            assert num_nodes <= MECHANISM_ID_MAX_NODES, print(f'Mechanism ids support at most {MECHANISM_ID_MAX_NODES} '
+                                                              f'nodes, got {num_nodes}!')
             self.node_to_dim_map = {node: idx for idx, node in enumerate(self.node_labels)}
-            self.gps = {n: SharedDataGaussianProcess(num_nodes, self.node_to_dim_map, self.cfg.linear) for n in
-                        self.node_labels}
+            self.gps = {n: SharedDataGaussianProcess(num_nodes, self.node_to_dim_map, self.cfg.linear,
+                                                     model_cfg=self.cfg) for n in self.node_labels}
             self.root_mechs = {n: GaussianRootNode() for n in self.node_labels}
-            self.mechanism_update_times = {get_mechanism_key(node, []): 0 for node in self.node_labels}
+            self.mechanism_update_times = {get_mechanism_id(nidx, []): 0 for nidx in range(num_nodes)}
             self.gp_sample_times = dict()
             self.topological_orders = dict()
             self.topological_order_sample_times = dict()
@@ -54,41 +60,77 @@ class SharedDataGaussianProcessModel:
         self.posterior_mll_cache = dict()
         self.rmse_cache = dict()
 
-    def get_parameters(self, keys: List[str] = None):
-        params = [gp.get_parameters(keys) for gp in self.gps.values()]
-        return itertools.chain(*params)
+        # init per-node data statistics, these are rebuilt from the experiments and not stored in the param dict
+        self.node_statistics = {node: NodeStatistics(node, self.node_labels) for node in self.node_labels}
+        self.data_store = DataStore(self.node_labels)
+
+    def get_mechanism_id(self, node: str, parents: List[str]) -> int:
+        return get_mechanism_id(self.node_to_dim_map[node], [self.node_to_dim_map[parent] for parent in parents])
+
+    def get_mechanism_key(self, mechanism_id: int) -> str:
+        return mechanism_id_to_key(mechanism_id, self.node_labels)
+
+    def get_optimizer(self, params) -> torch.optim.Optimizer:
+        if self.cfg.optimizer == 'rmsprop':
+            return torch.optim.RMSprop(params, lr=self.cfg.lr)
+        if self.cfg.optimizer == 'adam':
+            return torch.optim.Adam(params, lr=self.cfg.lr)
+        assert False, print(f'Invalid optimizer {self.cfg.optimizer}!')
+
+    def get_graph_hash(self, graph: nx.DiGraph) -> int:
+        return get_graph_hash(graph, self.node_labels)
 
     def init_topological_order(self, graph: nx.DiGraph, init_time: int = 0):
-        graph_key = get_graph_key(graph)
-        if nx.is_directed_acyclic_graph(graph):
-            self.topological_order_sample_times[graph_key] = init_time
-            if graph_key not in self.topological_orders:
-                self.topological_orders[graph_key] = list(nx.topological_sort(graph))
+        self.init_topological_orders(graph_to_adj_mat(graph, self.node_labels).unsqueeze(0), init_time)
+
+    def init_topological_orders(self, adj_mats: torch.Tensor, init_time: int = 0):
+        """Sorts a batch of graphs of shape (num_graphs, num_nodes, num_nodes) topologically and registers the orders of
+        all acyclic graphs under their graph hashes.
+
+        Returns
+        ------
+        Tuple[torch.LongTensor, torch.BoolTensor]
+            The topological orders (node indices) of shape (num_graphs, num_nodes) and the acyclicity mask of shape
+            (num_graphs,), see `topological_sort_batch`.
+        """
+        orders, acyclic = topological_sort_batch(adj_mats)
+        graph_hashes = graph_hash_batch(adj_mats).tolist()
+        for graph_hash, order, is_dag in zip(graph_hashes, orders.tolist(), acyclic.tolist()):
+            if is_dag:
+                self.topological_order_sample_times[graph_hash] = init_time
+                if graph_hash not in self.topological_orders:
+                    self.topological_orders[graph_hash] = [self.node_labels[nidx] for nidx in order]
+        return orders, acyclic
 
     def init_graph_mechanisms(self, graph: nx.DiGraph, init_time: int = 0):
         initialized_mechanisms = []
         for node in self.node_labels:
             parents = get_parents(node, graph)
-            key = get_mechanism_key(node, parents)
-            initialized_mechanisms.append(key)
+            mechanism_id = self.get_mechanism_id(node, parents)
+            initialized_mechanisms.append(mechanism_id)
             if len(parents):
-                self.gp_sample_times[key] = init_time
-                if not self.gps[node].exists(key):
-                    self.gps[node].init_kernel(key)
-                    self.mechanism_update_times[key] = 0
+                self.gp_sample_times[mechanism_id] = init_time
+                if not self.gps[node].exists(mechanism_id):
+                    self.gps[node].init_kernel(mechanism_id)
+                    self.mechanism_update_times[mechanism_id] = 0
 
         return initialized_mechanisms
 
-    def init_mechanisms_from_keys(self, keys: List[str], init_time: int = 0):
-        for key in keys:
-            node, parents = resolve_mechanism_key(key)
-            if len(parents):
-                self.gp_sample_times[key] = init_time
-                if not self.gps[node].exists(key):
-                    self.gps[node].init_kernel(key)
-                    self.mechanism_update_times[key] = 0
+    def init_mechanisms(self, mechanism_ids: List[int], init_time: int = 0):
+        # collect new mechanisms per node to initialise their hyperparameters in bulk
+        new_ids_by_node = {node: [] for node in self.node_labels}
+        for mechanism_id in mechanism_ids:
+            if not is_root_mechanism(mechanism_id):
+                node = self.node_labels[resolve_mechanism_id(mechanism_id)[0]]
+                self.gp_sample_times[mechanism_id] = init_time
+                if not self.gps[node].exists(mechanism_id):
+                    new_ids_by_node[node].append(mechanism_id)
+                    self.mechanism_update_times[mechanism_id] = 0
+
+        for node, new_ids in new_ids_by_node.items():
+            self.gps[node].init_kernels(new_ids)
 
-        return keys
+        return mechanism_ids
 
     def discard_gps(self):
         # if number of mechanisms is less than the cfg threshold we don't delete anything
@@ -109,9 +151,9 @@ class SharedDataGaussianProcessModel:
         latest_sampling_time = max(self.gp_sample_times.values())
         discard_time = discard_time if discard_time < latest_sampling_time else latest_sampling_time - 1
 
-        # determine gp keys to be discarded
-        keys = [key for key, time in self.gp_sample_times.items() if time <= discard_time]
-        num_to_discard = len(keys)
+        # determine gp ids to be discarded
+        mechanism_ids = [mechanism_id for mechanism_id, time in self.gp_sample_times.items() if time <= discard_time]
+        num_to_discard = len(mechanism_ids)
         if num_to_discard == 0:
             return
 
@@ -120,14 +162,14 @@ class SharedDataGaussianProcessModel:
 
         # discard gps
         for gp in self.gps.values():
-            gp.delete_kernels(keys)
+            gp.delete_kernels(mechanism_ids)
 
-        keys = set(keys)
-        self.gp_sample_times = {k: v for k, v in self.gp_sample_times.items() if k not in keys}
-        self.mechanism_update_times = {k: v for k, v in self.mechanism_update_times.items() if k not in keys}
-        self.prior_mll_cache = {k: v for k, v in self.prior_mll_cache.items() if k not in keys}
-        self.posterior_mll_cache = {k: v for k, v in self.posterior_mll_cache.items() if k not in keys}
-        self.rmse_cache = {k: v for k, v in self.rmse_cache.items() if k not in keys}
+        mechanism_ids = set(mechanism_ids)
+        self.gp_sample_times = {k: v for k, v in self.gp_sample_times.items() if k not in mechanism_ids}
+        self.mechanism_update_times = {k: v for k, v in self.mechanism_update_times.items() if k not in mechanism_ids}
+        self.prior_mll_cache = {k: v for k, v in self.prior_mll_cache.items() if k not in mechanism_ids}
+        self.posterior_mll_cache = {k: v for k, v in self.posterior_mll_cache.items() if k not in mechanism_ids}
+        self.rmse_cache = {k: v for k, v in self.rmse_cache.items() if k not in mechanism_ids}
 
     def discard_topo_orders(self):
         # if number of topo orders is less than the cfg threshold we don't delete anything
@@ -169,60 +211,61 @@ class SharedDataGaussianProcessModel:
         for gp in self.gps.values():
             gp.train()
 
-    def clear_prior_mll_cache(self, keys: List[str] = None):
-        if keys is None:
+    def clear_prior_mll_cache(self, mechanism_ids: List[int] = None):
+        if mechanism_ids is None:
             self.prior_mll_cache.clear()
         else:
-            for key in keys:
-                if key in self.prior_mll_cache:
-                    del self.prior_mll_cache[key]
+            for mechanism_id in mechanism_ids:
+                if mechanism_id in self.prior_mll_cache:
+                    del self.prior_mll_cache[mechanism_id]
 
-    def clear_posterior_mll_cache(self, keys: List[str] = None):
-        if keys is None:
+    def clear_posterior_mll_cache(self, mechanism_ids: List[int] = None):
+        if mechanism_ids is None:
             self.posterior_mll_cache.clear()
         else:
-            for key in keys:
-                if key in self.posterior_mll_cache:
-                    del self.posterior_mll_cache[key]
+            for mechanism_id in mechanism_ids:
+                if mechanism_id in self.posterior_mll_cache:
+                    del self.posterior_mll_cache[mechanism_id]
 
-    def clear_rmse_cache(self, keys: List[str] = None):
-        if keys is None:
+    def clear_rmse_cache(self, mechanism_ids: List[int] = None):
+        if mechanism_ids is None:
             self.rmse_cache.clear()
         else:
-            for key in keys:
-                if key in self.rmse_cache:
-                    del self.rmse_cache[key]
-
-    def apply_mechanism(self, inputs: torch.Tensor, key: str) -> torch.Tensor:
-        node, parents = resolve_mechanism_key(key)
-        if len(parents) == 0:
+            for mechanism_id in mechanism_ids:
+                if mechanism_id in self.rmse_cache:
+                    del self.rmse_cache[mechanism_id]
+
+    def apply_mechanism(self, inputs: torch.Tensor, mechanism_id: int) -> torch.Tensor:
+        node_id, _ = resolve_mechanism_id(mechanism_id)
+        node = self.node_labels[node_id]
+        if is_root_mechanism(mechanism_id):
             return self.root_mechs[node](inputs)
         else:
-            return self.gps[node](inputs, key)
+            return self.gps[node](inputs, mechanism_id)
 
     def mechanism_rmse(self, experiments: List[Experiment], node: str, parents: List[str],
                        use_cache=False) -> torch.Tensor:
         # return cache value if available
-        key = get_mechanism_key(node, parents)
-        if use_cache and key in self.rmse_cache:
-            return self.rmse_cache[key]
+        mechanism_id = self.get_mechanism_id(node, parents)
+        if use_cache and mechanism_id in self.rmse_cache:
+            return self.rmse_cache[mechanism_id]
 
         # compute rmse value otherwise
         rmse = torch.tensor(0.)
         if len(parents) == 0:
-            inputs, targets = gather_data(experiments, node, parents=parents, mode='independent_samples')
+            _, targets = self.gather_node_data(experiments, node, mode='independent_samples')
             if targets is not None:
                 prediction = self.root_mechs[node](targets.unsqueeze(-1)).squeeze()
                 rmse = vector_norm(targets.squeeze() - prediction) / vector_norm(targets)
         else:
-            inputs, targets = gather_data(experiments, node, parents=self.node_labels, mode='independent_samples')
+            inputs, targets = self.gather_node_data(experiments, node, mode='independent_samples')
             if targets is not None:
-                prediction = self.gps[node](inputs, key).squeeze()
+                prediction = self.gps[node](inputs, mechanism_id).squeeze()
                 rmse = vector_norm(targets.squeeze() - prediction) / vector_norm(targets)
 
         # cache rmse value
         if use_cache:
-            self.rmse_cache[key] = rmse
+            self.rmse_cache[mechanism_id] = rmse
 
         return rmse
 
@@ -236,35 +279,108 @@ class SharedDataGaussianProcessModel:
 
     def node_mll(self, experiments: List[Experiment], node: str, parents: List[str], prior_mode=False,
                  use_cache=False, mode='joint', reduce=True) -> torch.Tensor:
+        mechanism_id = self.get_mechanism_id(node, parents)
+        return self.mechanism_mll(experiments, mechanism_id, prior_mode, use_cache, mode, reduce)
+
+    def mechanism_mll(self, experiments: List[Experiment], mechanism_id: int, prior_mode=False, use_cache=False,
+                      mode='joint', reduce=True) -> torch.Tensor:
         cache = self.prior_mll_cache if prior_mode else self.posterior_mll_cache
-        key = get_mechanism_key(node, parents)
-        if not use_cache or key not in cache:
+        if not use_cache or mechanism_id not in cache:
             # gather data from the experiments
-            inputs, targets = gather_data(experiments, node, parents=self.node_labels, mode=mode)
+            node_id, _ = resolve_mechanism_id(mechanism_id)
+            node = self.node_labels[node_id]
+            inputs, targets = self.gather_node_data(experiments, node, mode=mode)
 
             # check if we have any data for this node
             mll = torch.tensor(0.)
             if targets is not None:
                 # compute log-likelihood
-                if len(parents):
+                if not is_root_mechanism(mechanism_id):
                     try:
-                        mll = self.gps[node].mll(inputs, targets, key, prior_mode, reduce=reduce)
+                        mll = self.gps[node].mll(inputs, targets, mechanism_id, prior_mode, reduce=reduce)
                     except Exception as e:
                         print(
-                            f'Exception occured in GaussianProcessModel.mll() when computing MLL for mechanism {key} '
-                            f'with prior mode {prior_mode} and use cache {use_cache}:')
+                            f'Exception occured in GaussianProcessModel.mll() when computing MLL for mechanism '
+                            f'{self.get_mechanism_key(mechanism_id)} with prior mode {prior_mode} and use cache '
+                            f'{use_cache}:')
                         print(e)
                 else:
                     mll = self.root_mechs[node].mll(None, targets, prior_mode, reduce=reduce)
 
             # cache mll
             if use_cache:
-                cache[key] = mll
+                cache[mechanism_id] = mll
         else:
-            mll = cache[key].clone()
+            mll = cache[mechanism_id].clone()
 
         return mll
 
+    def gather_node_data(self, experiments: List[Experiment], node: str, mode: str = 'joint'):
+        # the data of all nodes as inputs, served from the columnar data store instead of concatenating the experiments
+        if mode == 'independent_batches':
+            return gather_data(experiments, node, parents=self.node_labels, mode=mode)
+        self.data_store.update(experiments)
+        return self.data_store.gather(node, mode)
+
+    def update_statistics(self, experiments: List[Experiment]):
+        for node in self.node_labels:
+            self.node_statistics[node].update(experiments)
+
+    def batched_gp_mlls(self, node: str, inputs: Optional[torch.Tensor], targets: Optional[torch.Tensor],
+                        mechanism_ids: List[int], raw_values: Dict[str, torch.Tensor] = None) -> torch.Tensor:
+        # linear mechanisms only need the accumulated data statistics
+        if self.cfg.linear:
+            return self.gps[node].batched_statistics_mll(self.node_statistics[node], mechanism_ids, raw_values)
+        return self.gps[node].batched_mll(inputs, targets, mechanism_ids, raw_values)
+
+    def mechanism_mlls(self, experiments: List[Experiment], mechanism_ids: List[int]) -> torch.Tensor:
+        """Computes the prior-mode marginal log-likelihoods of many mechanisms, batching the GPs of each target node.
+
+        Parameters
+        ----------
+        experiments : List[Experiment]
+            The experimental data.
+        mechanism_ids : List[int]
+            The ids of the mechanisms to evaluate.
+
+        Returns
+        ------
+        torch.Tensor
+            The marginal log-likelihoods of shape (num_mechanisms,).
+        """
+        self.update_statistics(experiments)
+
+        mlls = torch.zeros(len(mechanism_ids))
+        idc_by_node = {node: [] for node in self.node_labels}
+        for midx, mechanism_id in enumerate(mechanism_ids):
+            node = self.node_labels[resolve_mechanism_id(mechanism_id)[0]]
+            if is_root_mechanism(mechanism_id):
+                # root node scores only depend on the moments of the node's data
+                statistics = self.node_statistics[node]
+                if statistics.num_samples > 0:
+                    mlls[midx] = self.root_mechs[node].prior_mll_from_moments(*statistics.target_moments)
+            else:
+                idc_by_node[node].append(midx)
+
+        for node, node_idc in idc_by_node.items():
+            if len(node_idc) == 0 or self.node_statistics[node].num_samples == 0:
+                continue
+
+            inputs, targets = None, None
+            if not self.cfg.linear:
+                inputs, targets = self.gather_node_data(experiments, node)
+
+            for batch in split_batches(node_idc, self.cfg.opt_batch_size):
+                batch_ids = [mechanism_ids[midx] for midx in batch]
+                try:
+                    mlls[batch] = self.batched_gp_mlls(node, inputs, targets, batch_ids)
+                except Exception:
+                    # fall back to single mechanisms
+                    for midx, mechanism_id in zip(batch, batch_ids):
+                        mlls[midx] = self.mechanism_mll(experiments, mechanism_id, prior_mode=True)
+
+        return mlls
+
     def mll(self, experiments: List[Experiment], graph: nx.DiGraph, prior_mode=False, use_cache=False,
             mode='joint', reduce=True) -> torch.Tensor:
         mll = torch.tensor(0.)
@@ -274,20 +390,24 @@ class SharedDataGaussianProcessModel:
         return mll
 
     def log_hp_prior(self, graph: nx.DiGraph) -> torch.Tensor:
-        keys = []
-        for node in self.node_labels:
-            parents = get_parents(node, graph)
-            keys.append(get_mechanism_key(node, parents))
-
-        return self.mechanism_log_hp_priors(keys)
-
-    def mechanism_log_hp_priors(self, keys: List[str]) -> torch.Tensor:
-        log_priors = torch.tensor(0.)
-        for key in keys:
-            node, parents = resolve_mechanism_key(key)
-            if self.gps[node].exists(key):
-                log_priors += self.gps[node].hyperparam_log_prior(key)
-
+        mechanism_ids = [self.get_mechanism_id(node, get_parents(node, graph)) for node in self.node_labels]
+        return self.mechanism_log_hp_priors(mechanism_ids)
+
+    def mechanism_log_hp_priors(self, mechanism_ids: List[int], reduce=True) -> torch.Tensor:
+        # evaluate the hyperparameter priors of all existing GPs of a node at once
+        log_priors = torch.zeros(len(mechanism_ids))
+        midc_by_node = {node: [] for node in self.node_labels}
+        for midx, mechanism_id in enumerate(mechanism_ids):
+            node = self.node_labels[resolve_mechanism_id(mechanism_id)[0]]
+            if self.gps[node].exists(mechanism_id):
+                midc_by_node[node].append(midx)
+
+        for node, midc in midc_by_node.items():
+            if len(midc) > 0:
+                log_priors[midc] = self.gps[node].hyperparam_log_priors([mechanism_ids[midx] for midx in midc])
+
+        if reduce:
+            return log_priors.sum()
         return log_priors
 
     def get_num_gps(self, sample_time: int = None):
@@ -304,18 +424,18 @@ class SharedDataGaussianProcessModel:
             tmp = [None for time in self.topological_order_sample_times.values() if time == sample_time]
             return len(tmp)
 
-    def gp_mlls(self, experiments: List[Experiment], keys: List[str] = None, prior_mode=False) -> torch.Tensor:
-        # if no keys are given compute mlls for all mechanisms
-        if keys is None:
-            keys = [self.gps[node].get_keys() for node in self.node_labels]
-            keys = list(itertools.chain(*keys))
+    def gp_mlls(self, experiments: List[Experiment], mechanism_ids: List[int] = None,
+                prior_mode=False) -> torch.Tensor:
+        # if no ids are given compute mlls for all mechanisms
+        if mechanism_ids is None:
+            mechanism_ids = [self.gps[node].get_mechanism_ids() for node in self.node_labels]
+            mechanism_ids = list(itertools.chain(*mechanism_ids))
 
-        # sort keys by target node and filter out non-gps
+        # sort ids by target node and filter out non-gps
         keys_by_target = {node: [] for node in self.node_labels}
-        for key in keys:
-            node, parents = resolve_mechanism_key(key)
-            if len(parents) > 0:
-                keys_by_target[node].append((key, parents))
+        for mechanism_id in mechanism_ids:
+            if not is_root_mechanism(mechanism_id):
+                keys_by_target[self.node_labels[resolve_mechanism_id(mechanism_id)[0]]].append(mechanism_id)
 
         mlls = torch.tensor(0.)
         for node in self.node_labels:
@@ -324,29 +444,30 @@ class SharedDataGaussianProcessModel:
                 continue
 
             # gather data from the experiments
-            inputs, targets = gather_data(experiments, node, parents=self.node_labels, mode='joint')
+            inputs, targets = self.gather_node_data(experiments, node)
 
             # check if we have any data for this node
             if targets is None:
                 continue
 
-            for key, parents in keys_by_target[node]:
+            for mechanism_id in keys_by_target[node]:
                 # compute marginal log-likelihood
                 try:
-                    mlls += self.gps[node].mll(inputs, targets, key, prior_mode) / targets.numel()
+                    mlls += self.gps[node].mll(inputs, targets, mechanism_id, prior_mode) / targets.numel()
                 except Exception as e:
                     print(
                         f'Exception occured in SharedDataGaussianProcessModel.gp_mlls() when computing MLL for '
-                        f'mechanism {key} with prior mode {prior_mode}:')
+                        f'mechanism {self.get_mechanism_key(mechanism_id)} with prior mode {prior_mode}:')
                     print(e)
                     print('Resampling GP hyperparameters...')
-                    self.gps[node].init_hyperparams(key)
+                    self.gps[node].init_hyperparams(mechanism_id)
         return mlls
 
     def set_data(self, experiments: List[Experiment]):
+        self.update_statistics(experiments)
         for node in self.node_labels:
             # gather data from the experiments
-            inputs, targets = gather_data(experiments, node, parents=self.node_labels, mode='joint')
+            inputs, targets = self.gather_node_data(experiments, node)
 
             # check if we have any data for this node
             if targets is None:
@@ -354,14 +475,14 @@ class SharedDataGaussianProcessModel:
 
             # set mechanism data
             self.gps[node].set_data(inputs, targets)
-            self.root_mechs[node].set_data(inputs, targets)
+            self.root_mechs[node].set_moments(*self.node_statistics[node].target_moments)
 
         self.eval()
 
     def sample(self, interventions: dict, batch_size: int, num_batches: int, graph: nx.DiGraph) -> Experiment:
         data = dict()
         x = torch.zeros(num_batches, batch_size, len(self.node_labels))
-        for node in self.topological_orders[get_graph_key(graph)]:
+        for node in self.topological_orders[self.get_graph_hash(graph)]:
             # check if node is intervened upon
             if node in interventions:
                 node_samples = torch.ones(num_batches, batch_size, 1) * interventions[node]
@@ -371,7 +492,7 @@ class SharedDataGaussianProcessModel:
                 if not parents:
                     node_samples = self.root_mechs[node].sample(torch.empty(num_batches, batch_size, 1))
                 else:
-                    node_samples = self.gps[node].sample(x, get_mechanism_key(node, parents))
+                    node_samples = self.gps[node].sample(x, self.get_mechanism_id(node, parents))
 
             # store samples
             x[:, :, self.node_to_dim_map[node]] = node_samples.squeeze(-1)
@@ -391,10 +512,10 @@ class SharedDataGaussianProcessModel:
 
         # otherwise, perform ancestral sampling to estimate the ATE
         x = torch.zeros(num_samples, 1, len(self.node_labels))
-        for node in self.topological_orders[get_graph_key(graph)]:
+        for node in self.topological_orders[self.get_graph_hash(graph)]:
             if node == target:
                 # if we sampled all ancestors we can compute the ATE for each ancestral sample
-                return self.gps[node](x, get_mechanism_key(target, parents_target)).squeeze()
+                return self.gps[node](x, self.get_mechanism_id(target, parents_target)).squeeze()
             elif node in interventions:
                 # check if node is intervened upon
                 node_samples = torch.ones(num_samples, 1, 1) * interventions[node]
@@ -404,7 +525,7 @@ class SharedDataGaussianProcessModel:
                 if not parents:
                     node_samples = self.root_mechs[node].sample(torch.empty(num_samples, 1, 1))
                 else:
-                    node_samples = self.gps[node].sample(x, get_mechanism_key(node, parents))
+                    node_samples = self.gps[node].sample(x, self.get_mechanism_id(node, parents))
 
             # store samples
             x[:, :, self.node_to_dim_map[node]] = node_samples.squeeze(-1)
@@ -415,7 +536,7 @@ class SharedDataGaussianProcessModel:
         # perform ancestral sampling to estimate the ACEs
         x = torch.zeros(num_samples, 1, len(self.node_labels))
         aces = torch.ones(len(self.node_labels), num_samples)
-        for node in self.topological_orders[get_graph_key(graph)]:
+        for node in self.topological_orders[self.get_graph_hash(graph)]:
             if node in interventions:
                 # check if node is intervened upon
                 node_samples = torch.ones(num_samples, 1, 1) * interventions[node]
@@ -427,8 +548,9 @@ class SharedDataGaussianProcessModel:
                     node_samples = self.root_mechs[node].sample(torch.empty(num_samples, 1, 1))
                     ace_samples = self.root_mechs[node](torch.empty(num_samples, 1, 1)).squeeze()
                 else:
-                    node_samples = self.gps[node].sample(x, get_mechanism_key(node, parents))
-                    ace_samples = self.gps[node](x, get_mechanism_key(node, parents)).squeeze()
+                    ace_samples, node_samples = self.gps[node].predict(x, self.get_mechanism_id(node, parents),
+                                                                       return_samples=True)
+                    ace_samples = ace_samples.squeeze()
 
             # store samples
             x[:, :, self.node_to_dim_map[node]] = node_samples.squeeze(-1)
@@ -436,6 +558,104 @@ class SharedDataGaussianProcessModel:
 
         return aces
 
+    def get_topological_orders(self, adj_mats: torch.Tensor, init_time: int = 0) -> torch.LongTensor:
+        """Returns a topological order (as node indices) for each of the given graphs of shape
+        (num_graphs, num_nodes, num_nodes).
+        """
+        return self.init_topological_orders(adj_mats, init_time)[0]
+
+    def sample_mechanism_batch(self, node: str, parents: List[str], inputs: torch.Tensor, interventions: dict,
+                               compute_means=False) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        # samples (and predictive means) of one mechanism given inputs of shape (num_graphs, num_samples, num_nodes)
+        num_graphs, num_samples, num_nodes = inputs.shape
+        if node in interventions:
+            values = torch.ones(num_graphs, num_samples) * interventions[node]
+            return values, values
+
+        if not parents:
+            empty = torch.empty(num_graphs * num_samples, 1, 1)
+            samples = self.root_mechs[node].sample(empty).view(num_graphs, num_samples)
+            means = self.root_mechs[node](empty).view(num_graphs, num_samples) if compute_means else None
+            return samples, means
+
+        # the samples of all graphs are independent test points of the same GP
+        x = inputs.reshape(num_graphs * num_samples, 1, num_nodes)
+        mechanism_id = self.get_mechanism_id(node, parents)
+        means, samples = self.gps[node].predict(x, mechanism_id, return_samples=True)
+        means = means.view(num_graphs, num_samples) if compute_means else None
+        return samples.view(num_graphs, num_samples), means
+
+    def batched_ancestral_sampling(self, adj_mats: torch.Tensor, orders: torch.LongTensor, interventions: dict,
+                                   num_samples: int, mean_nodes: List[str] = None):
+        """Performs ancestral sampling for a batch of graphs at once. At each position of the topological orders, the
+        graphs are grouped by the mechanism of the node at that position, such that each mechanism is evaluated once
+        on the stacked samples of all graphs that use it.
+
+        Parameters
+        ----------
+        adj_mats : torch.Tensor
+            Adjacency matrices of shape (num_graphs, num_nodes, num_nodes), entry (i, j) indicates the edge i -> j.
+        orders : torch.LongTensor
+            Topological orders (node indices) of shape (num_graphs, num_nodes), or of shape (num_nodes,) if the order is
+            shared by all graphs.
+        interventions : dict
+            The interventions.
+        num_samples : int
+            Number of independent samples per graph.
+        mean_nodes : List[str]
+            Nodes for which to additionally compute the predictive means given the sampled parents (e.g., for ACEs).
+
+        Returns
+        ------
+        Tuple[torch.Tensor, Optional[torch.Tensor]]
+            The samples of shape (num_graphs, num_samples, num_nodes) and the predictive means of the mean_nodes (zero
+            for all other nodes) of the same shape, or None if no mean_nodes are given.
+        """
+        num_graphs, num_nodes = adj_mats.shape[0], len(self.node_labels)
+        orders = orders.expand(num_graphs, -1) if orders.dim() == 1 else orders
+        mean_nodes = set() if mean_nodes is None else set(mean_nodes)
+
+        x = torch.zeros(num_graphs, num_samples, num_nodes)
+        means = torch.zeros(num_graphs, num_samples, num_nodes) if mean_nodes else None
+        parent_masks = adj_mats.transpose(-1, -2).bool()
+        graph_idc = torch.arange(num_graphs)
+        for position in range(num_nodes):
+            # group the graphs by the mechanism (node and parent set) at the current position
+            node_idc = orders[:, position]
+            mechanisms = torch.cat((node_idc.unsqueeze(-1), parent_masks[graph_idc, node_idc].long()), dim=-1)
+            unique_mechanisms, group_idc = mechanisms.unique(dim=0, return_inverse=True)
+            for uidx, mechanism in enumerate(unique_mechanisms.tolist()):
+                group = (group_idc == uidx).nonzero().squeeze(-1)
+                node_idx = mechanism[0]
+                node = self.node_labels[node_idx]
+                parents = [self.node_labels[pidx] for pidx, is_parent in enumerate(mechanism[1:]) if is_parent]
+                node_samples, node_means = self.sample_mechanism_batch(node, parents, x[group], interventions,
+                                                                       node in mean_nodes)
+                x[group, :, node_idx] = node_samples
+                if node in mean_nodes:
+                    means[group, :, node_idx] = node_means
+
+        return x, means
+
+    def batched_sample(self, interventions: dict, num_samples: int, adj_mats: torch.Tensor,
+                       orders: torch.LongTensor) -> Dict[str, torch.Tensor]:
+        # returns the samples of each node of shape (num_graphs, num_samples)
+        x, _ = self.batched_ancestral_sampling(adj_mats, orders, interventions, num_samples)
+        return {node: x[..., self.node_to_dim_map[node]] for node in self.node_labels}
+
+    def batched_sample_ace(self, target: str, interventions: dict, num_samples: int, adj_mats: torch.Tensor,
+                           orders: torch.LongTensor) -> torch.Tensor:
+        # returns the ACE samples of the target of shape (num_graphs, num_samples), see `sample_ace`
+        _, means = self.batched_ancestral_sampling(adj_mats, orders, interventions, num_samples, mean_nodes=[target])
+        return means[..., self.node_to_dim_map[target]]
+
+    def batched_sample_aces(self, interventions: dict, num_samples: int, adj_mats: torch.Tensor,
+                            orders: torch.LongTensor) -> torch.Tensor:
+        # returns the ACE samples of all nodes of shape (num_graphs, num_nodes, num_samples), see `sample_aces`
+        _, means = self.batched_ancestral_sampling(adj_mats, orders, interventions, num_samples,
+                                                   mean_nodes=self.node_labels)
+        return means.transpose(-1, -2)
+
     def interventional_mll(self, targets, node: str, interventions: dict, graph: nx.DiGraph, reduce=True):
         assert targets.dim() == 2, print(f'Invalid shape {targets.shape}')
         num_batches, batch_size = targets.shape
@@ -457,8 +677,8 @@ class SharedDataGaussianProcessModel:
         targets = targets.unsqueeze(1).expand(-1, num_mc_samples, -1)
         assert targets.shape == (num_batches, num_mc_samples, batch_size)
         # compute interventional mll
-        key = get_mechanism_key(node, parents)
-        mll = self.gps[node].mll(inputs, targets, key, prior_mode=False, reduce=False)
+        mechanism_id = self.get_mechanism_id(node, parents)
+        mll = self.gps[node].mll(inputs, targets, mechanism_id, prior_mode=False, reduce=False)
         assert mll.shape == (num_batches, num_mc_samples), print(f'Invalid shape {mll.shape}!')
         mll = mll.logsumexp(dim=1) - math.log(num_mc_samples)
         return mll.sum() if reduce else mll
@@ -493,29 +713,28 @@ class SharedDataGaussianProcessModel:
 
         return query_lls.sum(dim=1)
 
-    def update_gp_hyperparameters(self, experiments: List[Experiment], keys: Optional[List[str]] = None):
-        # if no keys are given update all gps' hyperparams
-        if keys is None:
-            keys = [self.gps[node].get_keys() for node in self.node_labels]
-            keys = list(itertools.chain(*keys))
+    def update_gp_hyperparameters(self, experiments: List[Experiment], mechanism_ids: Optional[List[int]] = None):
+        # if no ids are given update all gps' hyperparams
+        if mechanism_ids is None:
+            mechanism_ids = [self.gps[node].get_mechanism_ids() for node in self.node_labels]
+            mechanism_ids = list(itertools.chain(*mechanism_ids))
 
-        # gather keys with older update times
+        # gather mechanisms with older update times
         update_time = len(experiments)
-        keys = [key for key in keys if self.mechanism_update_times[key] != update_time]
+        keys = [mid for mid in mechanism_ids if self.mechanism_update_times[mid] != update_time]
         if not keys:
             return
 
         with torch.no_grad():
             self.set_data(experiments)
 
-        # keep only GP keys and sort by node
+        # keep only GP ids and sort by node
         keys_by_node = {node: [] for node in self.node_labels}
-        for key in keys:
-            node, parents = resolve_mechanism_key(key)
-            if len(parents) == 0:
-                self.mechanism_update_times[key] = update_time
+        for mechanism_id in keys:
+            if is_root_mechanism(mechanism_id):
+                self.mechanism_update_times[mechanism_id] = update_time
             else:
-                keys_by_node[node].append(key)
+                keys_by_node[self.node_labels[resolve_mechanism_id(mechanism_id)[0]]].append(mechanism_id)
 
         num_total_gps = sum([len(keys_by_node[node]) for node in self.node_labels])
         print(f'Updating {num_total_gps} GP\'s hyperparams on {len(experiments)} experiments...', flush=True)
@@ -527,37 +746,50 @@ class SharedDataGaussianProcessModel:
             if len(keys_by_node[node]) == 0:
                 continue
 
-            inputs, targets = gather_data(experiments, node, parents=self.node_labels, mode='joint')
-            if targets is None:
+            num_targets = self.node_statistics[node].num_samples
+            if num_targets == 0:
                 continue
 
+            inputs, targets = None, None
+            if not self.cfg.linear:
+                inputs, targets = self.gather_node_data(experiments, node)
+
             # batch all mechanisms to avoid out of mem
-            batch_size = self.cfg.opt_batch_size
-            num_full_batches = len(keys_by_node[node]) // batch_size
-            key_batches = [keys_by_node[node][i * batch_size:(i + 1) * batch_size] for i in range(num_full_batches)]
-            if len(keys_by_node[node]) % batch_size > 0:
-                key_batches.append(keys_by_node[node][batch_size * num_full_batches:])
+            key_batches = split_batches(keys_by_node[node], self.cfg.opt_batch_size)
 
             # update GP hyperparams
             for bidx, batch in enumerate(key_batches):
-                optimizer = torch.optim.RMSprop(self.get_parameters(batch), lr=self.cfg.lr)
+                # optimise the raw hyperparameters of the whole batch as one leaf tensor per hyperparameter type
+                raw_hps = self.gps[node].gather_raw_hyperparameters(batch)
+                optimizer = self.get_optimizer(raw_hps.values())
                 losses = []
                 for i in range(self.cfg.num_steps):
 
-                    mlls = torch.tensor(0.)
-                    for key in batch:
-                        node, parents = resolve_mechanism_key(key)
-                        # compute marginal log-likelihood
-                        try:
-                            mlls += self.gps[node].mll(inputs, targets, key, True) / targets.numel()
-                        except Exception as e:
-                            print('Exception occured in SharedDataGaussianProcessModel.update_gp_hyperparameters() '
-                                  f'when computing MLL for mechanism {key} in prior mode:')
-                            print(e)
-                            print('Resampling GP hyperparameters...')
-                            self.gps[node].init_hyperparams(key)
-
-                    loss = -(mlls + self.mechanism_log_hp_priors(batch)) / len(batch)
+                    # compute marginal log-likelihoods of the whole batch at once
+                    try:
+                        mlls = self.batched_gp_mlls(node, inputs, targets, batch, raw_hps).sum() / num_targets
+                    except Exception:
+                        # fall back to single mechanisms to find and resample the failing ones
+                        mlls = torch.tensor(0.)
+                        for midx, mechanism_id in enumerate(batch):
+                            try:
+                                single_raw_hps = {name: values[midx:midx + 1] for name, values in raw_hps.items()}
+                                mlls = mlls + self.batched_gp_mlls(node, inputs, targets, [mechanism_id],
+                                                                   single_raw_hps).sum() / num_targets
+                            except Exception as e:
+                                print('Exception occured in SharedDataGaussianProcessModel.update_gp_hyperparameters() '
+                                      f'when computing MLL for mechanism {self.get_mechanism_key(mechanism_id)} in '
+                                      f'prior mode:')
+                                print(e)
+                                print('Resampling GP hyperparameters...')
+                                self.gps[node].init_hyperparams(mechanism_id)
+                                resampled_hps = self.gps[node].gather_raw_hyperparameters([mechanism_id])
+                                with torch.no_grad():
+                                    for name, values in raw_hps.items():
+                                        values[midx] = resampled_hps[name][0]
+
+                    log_hp_priors = self.gps[node].hyperparam_log_priors(batch, raw_hps).sum()
+                    loss = -(mlls + log_hp_priors) / len(batch)
 
                     optimizer.zero_grad()
                     loss.backward()
@@ -575,14 +807,15 @@ class SharedDataGaussianProcessModel:
                     if self.cfg.log_interval > 0 and i % self.cfg.log_interval == 0:
                         print(f'Step {i + 1} of {self.cfg.num_steps}, GP loss is {losses[-1]}...', flush=True)
 
+                self.gps[node].scatter_raw_hyperparameters(batch, raw_hps)
                 num_finished_gps += len(batch)
                 print(f'Updated {num_finished_gps}/{num_total_gps} GPs... ', flush=True)
 
         # put mechanisms back into eval mode
         self.eval()
 
-        for key in keys:
-            self.mechanism_update_times[key] = update_time
+        for mechanism_id in keys:
+            self.mechanism_update_times[mechanism_id] = update_time
 
     def submodel(self, graphs):
         return self
@@ -591,8 +824,9 @@ class SharedDataGaussianProcessModel:
         gp_param_dict = {node: gp.param_dict() for node, gp in self.gps.items()}
         root_mech_param_dict = {node: m.param_dict() for node, m in self.root_mechs.items()}
         params = {'node_labels': self.node_labels,
-                  'mechanism_update_times': self.mechanism_update_times,
-                  'gp_sample_times': self.gp_sample_times,
+                  'mechanism_update_times': {self.get_mechanism_key(mid): t for mid, t in
+                                             self.mechanism_update_times.items()},
+                  'gp_sample_times': {self.get_mechanism_key(mid): t for mid, t in self.gp_sample_times.items()},
                   'topological_orders': self.topological_orders,
                   'topological_order_sample_times': self.topological_order_sample_times,
                   'gp_param_dict': gp_param_dict,
@@ -603,16 +837,22 @@ class SharedDataGaussianProcessModel:
     def load_param_dict(self, param_dict):
         self.node_labels = param_dict['node_labels']
         self.node_to_dim_map = {node: idx for idx, node in enumerate(self.node_labels)}
-        self.mechanism_update_times = param_dict['mechanism_update_times']
-        self.gp_sample_times = param_dict['gp_sample_times']
-        self.topological_orders = param_dict['topological_orders']
-        self.topological_order_sample_times = param_dict['topological_order_sample_times']
+        self.mechanism_update_times = {mechanism_key_to_id(key, self.node_to_dim_map): t for key, t in
+                                       param_dict['mechanism_update_times'].items()}
+        self.gp_sample_times = {mechanism_key_to_id(key, self.node_to_dim_map): t for key, t in
+                                param_dict['gp_sample_times'].items()}
+        # older param dicts use string graph keys
+        self.topological_orders = {graph_key_to_hash(key, self.node_labels) if isinstance(key, str) else key: order
+                                   for key, order in param_dict['topological_orders'].items()}
+        self.topological_order_sample_times = {
+            graph_key_to_hash(key, self.node_labels) if isinstance(key, str) else key: t for key, t in
+            param_dict['topological_order_sample_times'].items()}
         self.cfg = GPModelConfig()
         self.cfg.load_param_dict(param_dict['cfg_param_dict'])
 
         self.gps = {}
         for node, d in param_dict['gp_param_dict'].items():
-            self.gps[node] = SharedDataGaussianProcess(len(self.node_labels), param_dict=d)
+            self.gps[node] = SharedDataGaussianProcess(len(self.node_labels), param_dict=d, model_cfg=self.cfg)
             self.gps[node].load_param_dict(d)
         self.root_mechs = {}
         for node, d in param_dict['root_mech_param_dict'].items():
@@ -0,0 +1,106 @@
+from typing import List, Tuple, Optional
+
+import torch
+
+from src.environments.experiment import Experiment
+
+
+def compute_moments(values: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Computes the number of samples, the mean and the sum of squared deviations along the last dimension.
+    """
+    num_samples = torch.tensor(float(values.shape[-1]), dtype=values.dtype)
+    means = values.mean(dim=-1)
+    sq_devs = (values - means.unsqueeze(-1)).pow(2).sum(dim=-1)
+    return num_samples.expand(means.shape), means, sq_devs
+
+
+def merge_moments(num_samples_a: torch.Tensor, means_a: torch.Tensor, sq_devs_a: torch.Tensor,
+                  num_samples_b: torch.Tensor, means_b: torch.Tensor, sq_devs_b: torch.Tensor):
+    """Merges the moments of two disjoint sample sets (Chan et al.'s parallel variance algorithm).
+    """
+    num_samples = num_samples_a + num_samples_b
+    deltas = means_b - means_a
+    means = means_a + deltas * num_samples_b / num_samples
+    sq_devs = sq_devs_a + sq_devs_b + deltas.pow(2) * num_samples_a * num_samples_b / num_samples
+    return num_samples, means, sq_devs
+
+
+class NodeStatistics:
+    """Running sufficient statistics of the joint data of one target node, i.e., of all samples of experiments where
+    the node was not intervened upon (see `gather_data`). The statistics are accumulated in double precision and are
+    updated incrementally as experiments are appended.
+
+    The augmented Gram matrix A^T A is stored for A = [X, 0, y, 1], where X holds the data of all nodes in the order
+    of node_labels and the zero column serves as padding index for parent sets (as in `get_parent_index_matrix`).
+    """
+    node: str
+    node_labels: List[str]
+    num_experiments: int
+    last_experiment: Optional[Experiment]
+    gram: torch.Tensor
+
+    def __init__(self, node: str, node_labels: List[str]):
+        """
+        Parameters
+        ----------
+        node : str
+            The target node.
+        node_labels : List[str]
+            The sorted node labels determining the input dimensions.
+        """
+        self.node = node
+        self.node_labels = node_labels
+        self.num_dims = len(node_labels)
+        self.reset()
+
+    def reset(self):
+        self.num_experiments = 0
+        self.last_experiment = None
+        self.gram = torch.zeros(self.num_dims + 3, self.num_dims + 3, dtype=torch.double)
+        self.target_moments = tuple(torch.tensor(0., dtype=torch.double) for _ in range(3))
+
+    @property
+    def num_samples(self) -> int:
+        return int(self.gram[-1, -1].item())
+
+    def update(self, experiments: List[Experiment]):
+        # start over if the experiments are not an extension of the ingested ones
+        if len(experiments) < self.num_experiments or \
+                (self.num_experiments > 0 and experiments[self.num_experiments - 1] is not self.last_experiment):
+            self.reset()
+
+        for experiment in experiments[self.num_experiments:]:
+            if self.node in experiment.interventions:
+                continue
+
+            inputs = torch.cat([experiment.data[node] for node in self.node_labels], dim=-1).view(-1, self.num_dims)
+            targets = experiment.data[self.node].reshape(-1, 1)
+            augmented = torch.cat((inputs, torch.zeros_like(targets), targets, torch.ones_like(targets)), dim=-1)
+            augmented = augmented.double()
+            self.gram += augmented.t() @ augmented
+            self.target_moments = merge_moments(*self.target_moments, *compute_moments(targets.squeeze(-1).double()))
+
+        self.num_experiments = len(experiments)
+        self.last_experiment = experiments[-1] if experiments else None
+
+    def linear_statistics(self, parent_idc: torch.LongTensor):
+        """Extracts the statistics of the linear regression of the target on each parent set.
+
+        Parameters
+        ----------
+        parent_idc : torch.LongTensor
+            Padded parent indices of shape (num_mechanisms, max_num_parents), where the padding index is num_dims.
+
+        Returns
+        ------
+        Tuple[torch.Tensor, ...]
+            X^T X of shape (num_mechanisms, max_num_parents, max_num_parents), X^T y and X^T 1 of shape
+            (num_mechanisms, max_num_parents), and the scalars y^T y, 1^T y and the number of samples.
+        """
+        target_idx, ones_idx = self.num_dims + 1, self.num_dims + 2
+        xtx = self.gram[parent_idc.unsqueeze(-1), parent_idc.unsqueeze(-2)]
+        xty = self.gram[parent_idc, target_idx]
+        xt1 = self.gram[parent_idc, ones_idx]
+        yty = self.gram[target_idx, target_idx]
+        y_sum = self.gram[target_idx, ones_idx]
+        return xtx, xty, xt1, yty, y_sum, self.gram[ones_idx, ones_idx]
@@ -99,14 +99,13 @@ def co_eval(abci, output_dir: str):
         mc_cos, _ = abci.sample_mc_cos(num_cos=num_mc_cos)
 
         # count number of unique cos
-        unique = [cos.__repr__() for cos in mc_cos]
-        num_unique_cos.append(len(set(unique)))
+        num_unique_cos.append(len(mc_cos))
 
-        # compute log co weights
+        # compute log co weights of all sampled cos
         with torch.no_grad():
             weights = abci.co_weights.sum(dim=1)
-            weights -= weights.logsumexp(dim=0)
-            co_log_weights[i] = weights
+            weights -= (weights + abci.co_counts.log()).logsumexp(dim=0)
+            co_log_weights[i] = weights.repeat_interleave(abci.co_counts.long())
 
     df = pd.DataFrame(co_log_weights)
     df.columns = [f'sweight{i}' for i in range(num_mc_cos)]
@@ -1,10 +1,10 @@
-from itertools import chain, combinations, product, permutations
-from typing import List, Set, Optional
+import operator
+from itertools import product, permutations
+from typing import List, Set, Optional, Tuple
 
 import networkx as nx
 import torch
 
-from src.mechanism_models.mechanisms import get_mechanism_key
 from src.utils.graphs import adj_mat_to_graph
 
 
@@ -82,6 +82,18 @@ class CausalOrder:
     def get_co_mat(self):
         return self.co_mat
 
+    def get_perm(self):
+        """Returns the causal order as permutation, i.e., as vector of node ids where the i-th entry is the id of the
+        node at position i. Only valid for total orders.
+
+        Returns
+        ------
+        torch.LongTensor
+            The permutation vector.
+        """
+        assert self.num_layers == self.num_elements, print('Only total orders can be represented as permutation!')
+        return torch.LongTensor([self.node_label_to_id_dict[next(iter(layer))] for layer in self.layers])
+
     def get_co_cum_mat(self):
         """Returns a matrix representation of the causal order as a (d+1) x d matrix: entry (i,j) is 1 if
         element j belongs to the (i-1)-th or any of it's preceeding layers, and is 0 otherwise. In words, the i-th row
@@ -105,6 +117,99 @@ class CausalOrder:
         return co_mat
 
 
+class CausalOrderBatch:
+    """Compact, tensor-native representation of a batch of total causal orders (i.e., permutations of nodes).
+    Adjacency masks and hash keys are derived lazily and CausalOrder objects are only created on request, e.g., when
+    indexing or iterating over the batch.
+    """
+    num_cos: int
+    num_nodes: int
+    node_labels: List[str]
+    perms: torch.LongTensor
+
+    def __init__(self, perms: torch.LongTensor, node_labels: List[str]):
+        """
+        Parameters
+        ----------
+        perms : torch.LongTensor
+            Permutation tensor of shape (num_cos, num_nodes), where entry (c, i) is the index of the node at position
+            i in the c-th order.
+        node_labels : List[str]
+            List of node labels determining the node indices.
+        """
+        assert perms.dim() == 2 and perms.shape[1] == len(node_labels), print(perms.shape)
+        self.perms = perms
+        self.node_labels = node_labels
+        self.num_cos, self.num_nodes = perms.shape
+        self._adjacency_masks = None
+        self._keys = None
+
+    def __len__(self):
+        return self.num_cos
+
+    def __getitem__(self, idx):
+        # scalar indices (python or numpy integers and 0-dim tensors) return a single order, all others a batch
+        if not torch.is_tensor(idx) or idx.dim() == 0:
+            try:
+                idx = operator.index(idx)
+            except TypeError:
+                pass
+        if isinstance(idx, int):
+            return self.get_causal_order(idx)
+        return CausalOrderBatch(self.perms[idx], self.node_labels)
+
+    def __iter__(self):
+        for cidx in range(self.num_cos):
+            yield self.get_causal_order(cidx)
+
+    def get_causal_order(self, idx: int) -> CausalOrder:
+        return CausalOrder([{self.node_labels[nidx]} for nidx in self.perms[idx].tolist()])
+
+    def to_causal_orders(self) -> List[CausalOrder]:
+        return list(iter(self))
+
+    def get_positions(self) -> torch.LongTensor:
+        """Returns the inverse permutations, i.e., entry (c, j) is the position of node j in the c-th order.
+        """
+        return self.perms.argsort(dim=-1)
+
+    def get_adjacency_masks(self) -> torch.Tensor:
+        if self._adjacency_masks is None:
+            self._adjacency_masks = adjacency_masks_from_perms(self.perms)
+        return self._adjacency_masks
+
+    def get_co_mats(self) -> torch.Tensor:
+        co_mats = torch.zeros(self.num_cos, self.num_nodes, self.num_nodes)
+        co_mats.scatter_(2, self.perms.unsqueeze(-1), 1.)
+        return co_mats
+
+    def keys(self) -> List[bytes]:
+        """Returns a compact bytes key per causal order that can be used for caching and hashing.
+        """
+        if self._keys is None:
+            perms = self.perms.to(torch.int16 if self.num_nodes < 2 ** 15 else torch.int32).cpu().numpy()
+            self._keys = [perm.tobytes() for perm in perms]
+        return self._keys
+
+    def unique(self):
+        """Collapses duplicate orders.
+
+        Returns
+        ------
+        Tuple[CausalOrderBatch, torch.LongTensor, torch.LongTensor]
+            The batch of unique orders, the index of the unique order for each order in this batch and the number of
+            occurrences of each unique order in this batch.
+        """
+        perms, inverse_idc, counts = torch.unique(self.perms, dim=0, return_inverse=True, return_counts=True)
+        return CausalOrderBatch(perms, self.node_labels), inverse_idc, counts
+
+    @classmethod
+    def from_causal_orders(cls, cos: List[CausalOrder], node_labels: List[str]):
+        node_label_to_id_dict = {node: nidx for nidx, node in enumerate(node_labels)}
+        perms = [[node_label_to_id_dict[next(iter(layer))] for layer in co.layers] for co in cos]
+        return CausalOrderBatch(torch.LongTensor(perms).view(len(cos), len(node_labels)), node_labels)
+
+
 def resolve_co_key(key: str) -> CausalOrder:
     """Return a CausalOrder object according to the given key.
 
@@ -159,6 +264,25 @@ def co_from_co_mat(co_mat: torch.Tensor, node_labels: List[str]) -> CausalOrder:
     return CausalOrder(layers)
 
 
+def adjacency_masks_from_perms(perms: torch.LongTensor) -> torch.Tensor:
+    """Return the adjacency masks of a batch of total causal orders given as permutations.
+
+    Parameters
+    ----------
+    perms : torch.LongTensor
+        Permutation tensor of shape (batch_size, num_nodes), where entry (b, i) is the index of the node at position i
+        in the b-th order.
+
+    Returns
+    ------
+    torch.Tensor
+        The adjacency masks of shape (batch_size, num_nodes, num_nodes), where entry (b, i, j) is 1 if node i precedes
+        node j in the b-th order and 0 otherwise.
+    """
+    positions = perms.argsort(dim=-1)
+    return (positions.unsqueeze(-1) < positions.unsqueeze(-2)).float()
+
+
 def co_from_graph(dag: nx.DiGraph) -> Optional[CausalOrder]:
     if not nx.is_directed_acyclic_graph(dag):
         return None
@@ -172,28 +296,25 @@ def generate_all_permutations(node_labels: List[str]) -> List[CausalOrder]:
     return [CausalOrder(list(p)) for p in perm]
 
 
-def generate_all_parent_sets(node_labels: List[str], max_parent_set_size: int, adj_mask: torch.Tensor):
-    num_nodes = len(node_labels)
-
-    # generate for each node the possible parent sets given the adjeceny mask and the size constraint
-    parent_sets_per_node = dict()
-    for nidx in range(num_nodes):
-        possible_parents = adj_mask[:, nidx].nonzero().view(-1).tolist()
-        possible_parents = [node_labels[i] for i in possible_parents]
-        possible_parent_sets = [combinations(possible_parents, size) for size in range(max_parent_set_size + 1)]
-        possible_parent_sets = chain(*possible_parent_sets)
-        parent_sets_per_node[node_labels[nidx]] = [list(ps) for ps in possible_parent_sets]
-
-    return parent_sets_per_node
+def enumerate_parent_sets(max_parent_set_size: int, predecessor_mask: int) -> List[Tuple[int, ...]]:
+    """Enumerates all parent sets up to the given size that can be formed from the nodes in the predecessor bitmask.
+    The enumeration is built incrementally by adding the possible parents in ascending order.
 
+    Parameters
+    ----------
+    max_parent_set_size : int
+        Maximum parent set size.
+    predecessor_mask : int
+        Bitmask of the possible parents, where bit i is set if node i is a possible parent.
 
-def generate_all_mechanisms(node_labels: List[str], max_parent_set_size: int, adj_mask: torch.Tensor):
-    mechanisms = []
-    for nidx, node in enumerate(node_labels):
-        possible_parents = adj_mask[:, nidx].nonzero().view(-1).tolist()
-        possible_parents = [node_labels[i] for i in possible_parents]
-        possible_parent_sets = [combinations(possible_parents, size) for size in range(max_parent_set_size + 1)]
-        possible_parent_sets = chain(*possible_parent_sets)
-        mechanisms.extend([get_mechanism_key(node, list(ps)) for ps in possible_parent_sets])
+    Returns
+    ------
+    List[Tuple[int, ...]]
+        The parent sets as sorted tuples of node indices.
+    """
+    parent_sets = [()]
+    for node in range(predecessor_mask.bit_length()):
+        if (predecessor_mask >> node) & 1:
+            parent_sets += [ps + (node,) for ps in parent_sets if len(ps) < max_parent_set_size]
+    return parent_sets
 
-    return mechanisms
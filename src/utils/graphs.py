@@ -1,4 +1,4 @@
-from typing import List, Union
+from typing import List, Union, Tuple
 
 import networkx as nx
 import pandas as pd
@@ -103,6 +103,86 @@ def resolve_graph_key(key: str) -> nx.DiGraph:
     return graph
 
 
+# 64-bit FNV-1a constants (the offset basis as signed int64) for stable graph hashes
+FNV_OFFSET_BASIS = 0xcbf29ce484222325 - 2 ** 64
+FNV_PRIME = 0x100000001b3
+
+
+def topological_sort_batch(adj_mats: torch.Tensor) -> Tuple[torch.LongTensor, torch.BoolTensor]:
+    """Sorts a batch of directed graphs topologically (Kahn's algorithm on all graphs at once, picking the
+    lowest-index source first).
+
+    Parameters
+    ----------
+    adj_mats : torch.Tensor
+        Adjacency matrices of shape (batch_size, num_nodes, num_nodes), where entry (i, j) indicates the edge i -> j.
+
+    Returns
+    ------
+    Tuple[torch.LongTensor, torch.BoolTensor]
+        The topological orders (node indices) of shape (batch_size, num_nodes) and a mask of shape (batch_size,)
+        indicating which graphs are acyclic. The orders of cyclic graphs are only valid up to the first cycle and
+        contain the remaining nodes in index order.
+    """
+    adj_mats = adj_mats.bool()
+    batch_size, num_nodes = adj_mats.shape[0], adj_mats.shape[-1]
+    batch_idc = torch.arange(batch_size)
+    node_idc = torch.arange(num_nodes)
+
+    in_degrees = adj_mats.sum(dim=-2)
+    visited = torch.zeros(batch_size, num_nodes, dtype=torch.bool)
+    orders = torch.zeros(batch_size, num_nodes, dtype=torch.long)
+    acyclic = torch.ones(batch_size, dtype=torch.bool)
+    for position in range(num_nodes):
+        sources = (in_degrees == 0) & ~visited
+        acyclic &= sources.any(dim=-1)
+
+        # rank sources before other unvisited nodes (only picked if stuck in a cycle) before visited nodes
+        ranks = ((~sources).long() + visited.long()) * num_nodes + node_idc
+        nodes = ranks.argmin(dim=-1)
+        orders[:, position] = nodes
+        visited[batch_idc, nodes] = True
+        in_degrees -= adj_mats[batch_idc, nodes].long()
+
+    return orders, acyclic
+
+
+def is_dag_batch(adj_mats: torch.Tensor) -> torch.BoolTensor:
+    """Returns a mask of shape (batch_size,) indicating which of the given graphs of shape
+    (batch_size, num_nodes, num_nodes) are acyclic.
+    """
+    return topological_sort_batch(adj_mats)[1]
+
+
+def graph_hash_batch(adj_mats: torch.Tensor) -> torch.LongTensor:
+    """Computes stable integer hashes of a batch of graphs given their adjacency matrices of shape
+    (batch_size, num_nodes, num_nodes). The adjacency bits are packed into 32-bit words, which are combined with the
+    64-bit FNV-1a hash. Unlike `get_graph_key`, the hashes depend on the node order of the adjacency matrices.
+    """
+    batch_size, num_nodes = adj_mats.shape[0], adj_mats.shape[-1]
+    bits = adj_mats.reshape(batch_size, -1).bool().long()
+    bits = torch.cat((bits, bits.new_zeros(batch_size, -bits.shape[-1] % 32)), dim=-1)
+    words = (bits.view(batch_size, -1, 32) << torch.arange(32)).sum(dim=-1)
+
+    hashes = torch.full((batch_size,), FNV_OFFSET_BASIS, dtype=torch.long)
+    hashes = (hashes ^ num_nodes) * FNV_PRIME
+    for word in words.unbind(dim=-1):
+        hashes = (hashes ^ word) * FNV_PRIME
+    return hashes
+
+
+def get_graph_hash(graph: nx.DiGraph, node_labels: List[str]) -> int:
+    """Returns the integer hash of a graph (see `graph_hash_batch`) w.r.t. the given node order.
+    """
+    return graph_hash_batch(graph_to_adj_mat(graph, node_labels).unsqueeze(0)).item()
+
+
+def graph_key_to_hash(key: str, node_labels: List[str]) -> int:
+    """Converts a graph key as returned by `get_graph_key` into the integer hash of the graph.
+    """
+    return get_graph_hash(resolve_graph_key(key), node_labels)
+
+
 def get_parents(node: str, graph: nx.DiGraph) -> List[str]:
     """Returns a list of parents for a given node in a given graph.
 
@@ -163,14 +243,19 @@ def dag_to_cpdag(dag: Union[nx.DiGraph, torch.Tensor], node_labels: List[str]):
         torch.Tensor
             The adjacency matrix of the CPDAG representing the MEC of the input DAG.
     """
-    # convert adjacency matrix to dag if necessary
-    dag = adj_mat_to_graph(dag, node_labels) if isinstance(dag, torch.Tensor) else dag
+    # convert the dag to an adjacency matrix if necessary
+    adj_mat = graph_to_adj_mat(dag, node_labels) if isinstance(dag, nx.DiGraph) else dag
+    adj_mat = adj_mat.bool().cpu()
+    num_nodes = adj_mat.shape[-1]
+    predecessors = [set(adj_mat[:, node].nonzero().view(-1).tolist()) for node in range(num_nodes)]
 
     # order edges
     ordered_edges = []
-    topo_order = list(nx.topological_sort(dag))
-    for sink in reversed(list(topo_order)):
-        ordered_parents = [node for node in topo_order if node in dag.predecessors(sink)]
+    topo_orders, acyclic = topological_sort_batch(adj_mat.unsqueeze(0))
+    assert acyclic[0], print('Cannot compute the CPDAG of a cyclic graph!')
+    topo_order = topo_orders[0].tolist()
+    for sink in reversed(topo_order):
+        ordered_parents = [node for node in topo_order if node in predecessors[sink]]
         ordered_edges.extend([(parent, sink) for parent in ordered_parents])
 
     # label edges
@@ -186,8 +271,8 @@ def dag_to_cpdag(dag: Union[nx.DiGraph, torch.Tensor], node_labels: List[str]):
         compelled_into_x = {edge for edge in compelled_edges if edge[1] == x}
         for edge in compelled_into_x:
             w = edge[0]
-            if w not in dag.predecessors(y):
-                edges = {(parent, y) for parent in dag.predecessors(y)}
+            if w not in predecessors[y]:
+                edges = {(parent, y) for parent in predecessors[y]}
                 compelled_edges.update(edges)
                 unknown_edges.difference_update(edges)
                 cycle_constraint = True
@@ -202,21 +287,20 @@ def dag_to_cpdag(dag: Union[nx.DiGraph, torch.Tensor], node_labels: List[str]):
         # check v-structures
         edges = {edge for edge in unknown_edges if edge[1] == y}
         unknown_edges.difference_update(edges)
-        tmp = {(z, y) for z in dag.predecessors(y) if z != x and z not in dag.predecessors(x)}
+        tmp = {(z, y) for z in predecessors[y] if z != x and z not in predecessors[x]}
         if len(tmp) > 0:
             compelled_edges.update(edges)
         else:
             reversible_edges.update(edges)
 
     # return cpdag
-    cpdag = nx.DiGraph()
-    cpdag.add_nodes_from(dag.nodes)
-    cpdag.add_edges_from(compelled_edges)
-    cpdag.add_edges_from(reversible_edges)
-    cpdag.add_edges_from([(y, x) for x, y in reversible_edges])
-    adj_mat = graph_to_adj_mat(cpdag, node_labels)
-
-    return adj_mat
+    cpdag = torch.zeros(num_nodes, num_nodes)
+    for x, y in compelled_edges | reversible_edges:
+        cpdag[x, y] = 1.
+    for x, y in reversible_edges:
+        cpdag[y, x] = 1.
+
+    return cpdag
 
 
 def graph_from_csv(file: str):
@@ -0,0 +1,201 @@
+from typing import List, Tuple, Dict, Optional
+
+import torch
+
+from src.mechanism_models.mechanisms import get_mechanism_id, get_mechanism_ids, MECHANISM_ID_MAX_INT64_NODES
+from src.utils.causal_orders import enumerate_parent_sets
+from src.utils.utils import inf_tensor
+
+
+class ParentSetIndex:
+    """Combinatorial index of all parent sets up to a maximum size over a given number of nodes. The parent sets are
+    shared across all target nodes and causal orders, i.e., a parent set is identified by the same index for any
+    node and order.
+    """
+    num_nodes: int
+    max_ps_size: int
+    num_parent_sets: int
+    parent_sets: List[Tuple[int, ...]]
+    ps_to_idx: Dict[Tuple[int, ...], int]
+    ps_members: torch.LongTensor
+    ps_mat: torch.Tensor
+    ps_masks: Optional[torch.LongTensor]
+
+    def __init__(self, num_nodes: int, max_ps_size: int):
+        """
+        Parameters
+        ----------
+        num_nodes : int
+            Number of nodes.
+        max_ps_size : int
+            Maximum parent set size.
+        """
+        self.num_nodes = num_nodes
+        self.max_ps_size = max_ps_size
+
+        # enumerate all parent sets
+        self.parent_sets = enumerate_parent_sets(max_ps_size, (1 << num_nodes) - 1)
+        self.num_parent_sets = len(self.parent_sets)
+        self.ps_to_idx = {ps: idx for idx, ps in enumerate(self.parent_sets)}
+
+        # padded member matrix of shape (num_parent_sets, max_ps_size), where the padding index is num_nodes
+        self.ps_members = torch.full((self.num_parent_sets, max(max_ps_size, 1)), num_nodes, dtype=torch.long)
+        for idx, ps in enumerate(self.parent_sets):
+            self.ps_members[idx, :len(ps)] = torch.LongTensor(ps)
+
+        # parent set x node incidence matrix of shape (num_parent_sets, num_nodes)
+        self.ps_mat = torch.zeros(self.num_parent_sets, num_nodes + 1)
+        self.ps_mat.scatter_(1, self.ps_members, 1.)
+        self.ps_mat = self.ps_mat[:, :num_nodes]
+
+        # parent set bitmasks of shape (num_parent_sets,), only if they fit into int64
+        self.ps_masks = None
+        if num_nodes <= MECHANISM_ID_MAX_INT64_NODES:
+            self.ps_masks = (self.ps_mat.long() * 2 ** torch.arange(num_nodes)).sum(dim=1)
+
+    def get_index(self, parent_ids: List[int]) -> int:
+        return self.ps_to_idx[tuple(sorted(parent_ids))]
+
+    def order_chunks(self, num_cos: int, max_elements: int) -> List[slice]:
+        """Splits a batch of orders into chunks whose (num_cos, num_nodes, num_parent_sets) tensors have at most
+        max_elements entries, such that the peak memory of per-order parent set computations stays bounded.
+        """
+        chunk_size = max(1, max_elements // (self.num_nodes * self.num_parent_sets))
+        return [slice(start, start + chunk_size) for start in range(0, num_cos, chunk_size)]
+
+    def consistent_parent_sets(self, positions: torch.LongTensor) -> torch.Tensor:
+        """Determines which parent sets are consistent with a batch of causal orders, i.e., which parent sets consist
+        only of predecessors of a node.
+
+        Parameters
+        ----------
+        positions : torch.LongTensor
+            Position tensor of shape (num_cos, num_nodes), where entry (c, j) is the position of node j in the c-th
+            order.
+
+        Returns
+        ------
+        torch.Tensor
+            Boolean tensor of shape (num_cos, num_nodes, num_parent_sets), where entry (c, j, s) is True if parent set s
+            is admissible for node j in the c-th order.
+        """
+        # the padding node precedes all nodes
+        num_cos = positions.shape[0]
+        positions = torch.cat((positions, -torch.ones(num_cos, 1, dtype=torch.long)), dim=1)
+
+        # a parent set is consistent with a node if its last member precedes the node
+        ps_positions = positions[:, self.ps_members.view(-1)].view(num_cos, self.num_parent_sets, -1)
+        ps_last_positions = ps_positions.max(dim=-1)[0]
+        return ps_last_positions.unsqueeze(1) < positions[:, :self.num_nodes].unsqueeze(-1)
+
+
+class ParentSetScoreTable:
+    """Dense table of the log-scores log p(D_j | pa_j) of all (node, parent set) combinations indexed by a
+    ParentSetIndex. Scores are filled lazily, missing entries are marked as NaN.
+    """
+    node_labels: List[str]
+    num_nodes: int
+    index: ParentSetIndex
+    scores: torch.Tensor
+
+    def __init__(self, node_labels: List[str], max_ps_size: int):
+        """
+        Parameters
+        ----------
+        node_labels : List[str]
+            List of node labels determining the node indices.
+        max_ps_size : int
+            Maximum parent set size.
+        """
+        self.node_labels = node_labels
+        self.num_nodes = len(node_labels)
+        self.node_label_to_id_dict = {node: nidx for nidx, node in enumerate(node_labels)}
+        self.index = ParentSetIndex(self.num_nodes, max_ps_size)
+        self.scores = torch.full((self.num_nodes, self.index.num_parent_sets), float('nan'))
+
+    def clear(self):
+        self.scores.fill_(float('nan'))
+
+    def get_parents(self, ps_idx: int) -> List[str]:
+        return [self.node_labels[i] for i in self.index.parent_sets[ps_idx]]
+
+    def get_score(self, node: str, parents: List[str]) -> torch.Tensor:
+        ps_idx = self.index.get_index([self.node_label_to_id_dict[parent] for parent in parents])
+        return self.scores[self.node_label_to_id_dict[node], ps_idx]
+
+    def missing_scores(self, admissible: torch.Tensor) -> torch.LongTensor:
+        """Returns the (node, parent set) index pairs that are admissible in any of the orders but have no score yet.
+
+        Parameters
+        ----------
+        admissible : torch.Tensor
+            Boolean tensor of shape (num_nodes, num_parent_sets), e.g., the consistency tensor as returned by
+            `ParentSetIndex.consistent_parent_sets` reduced over the orders.
+
+        Returns
+        ------
+        torch.LongTensor
+            Index tensor of shape (num_missing, 2).
+        """
+        return (admissible & self.scores.isnan()).nonzero()
+
+    def get_mechanism_ids(self, node_ps_idc: torch.LongTensor) -> List[int]:
+        """Returns the mechanism ids of the given (node, parent set) index pairs of shape (num_pairs, 2).
+        """
+        if self.index.ps_masks is not None:
+            return get_mechanism_ids(node_ps_idc[:, 0], self.index.ps_masks[node_ps_idc[:, 1]]).tolist()
+
+        # the ids of larger graphs exceed int64 and are computed as python ints
+        return [get_mechanism_id(nidx, self.index.parent_sets[ps_idx]) for nidx, ps_idx in node_ps_idc.tolist()]
+
+    def set_scores(self, node_idc: torch.LongTensor, ps_idc: torch.LongTensor, scores: torch.Tensor):
+        self.scores[node_idc, ps_idc] = scores
+
+    @staticmethod
+    def log_ps_priors(consistent: torch.Tensor) -> torch.Tensor:
+        """Computes the log of the uniform prior p(pa_j | L) over the parent sets consistent with an order.
+
+        Parameters
+        ----------
+        consistent : torch.Tensor
+            Boolean consistency tensor of shape (num_cos, num_nodes, num_parent_sets).
+
+        Returns
+        ------
+        torch.Tensor
+            The log-prior of each node's parent sets in each order of shape (num_cos, num_nodes).
+        """
+        return -consistent.sum(dim=-1).float().log()
+
+    def ps_log_weights(self, consistent: torch.Tensor) -> torch.Tensor:
+        """Computes the unnormalised log-weights log p(D_j | pa_j) + log p(pa_j | L) of all parent sets for a batch
+        of orders. Inconsistent parent sets get weight -inf.
+
+        Parameters
+        ----------
+        consistent : torch.Tensor
+            Boolean consistency tensor of shape (num_cos, num_nodes, num_parent_sets).
+
+        Returns
+        ------
+        torch.Tensor
+            The parent set log-weights of shape (num_cos, num_nodes, num_parent_sets).
+        """
+        log_weights = self.scores.unsqueeze(0) + self.log_ps_priors(consistent).unsqueeze(-1)
+        return torch.where(consistent, log_weights, -inf_tensor())
+
+    def co_log_weights(self, consistent: torch.Tensor) -> torch.Tensor:
+        """Computes the per-node order log-weights log p(D_j | L) by marginalising over all parent sets consistent
+        with each order.
+
+        Parameters
+        ----------
+        consistent : torch.Tensor
+            Boolean consistency tensor of shape (num_cos, num_nodes, num_parent_sets).
+
+        Returns
+        ------
+        torch.Tensor
+            The order log-weights of shape (num_cos, num_nodes).
+        """
+        return self.ps_log_weights(consistent).logsumexp(dim=-1)